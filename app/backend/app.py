@@ -5,7 +5,7 @@ import logging
 import mimetypes
 import os
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Union, cast
+from typing import Any, AsyncGenerator, Dict, List, Union, cast
 
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
@@ -36,6 +36,7 @@ from quart_cors import cors
 from approaches.approach import Approach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
+from approaches.localsearch import LocalSearchBackend
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
 from config import (
@@ -46,12 +47,22 @@ from config import (
     CONFIG_CHAT_APPROACH,
     CONFIG_CHAT_VISION_APPROACH,
     CONFIG_GPT4V_DEPLOYED,
+    CONFIG_LATENCY_TRACER,
     CONFIG_OPENAI_CLIENT,
+    CONFIG_REQUEST_COALESCER,
     CONFIG_SEARCH_CLIENT,
     CONFIG_SEMANTIC_RANKER_DEPLOYED,
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
 from core.authentication import AuthenticationHelper
+from core.latency import (
+    ConsoleSink,
+    LatencySink,
+    LatencyTracer,
+    OpenTelemetrySink,
+    PrometheusSink,
+)
+from core.singleflight import RequestCoalescer
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
 
@@ -130,8 +141,8 @@ async def ask(auth_claims: Dict[str, Any]):
             approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
-        r = await approach.run(
-            request_json["messages"], context=context, session_state=request_json.get("session_state")
+        r = await cast(RequestCoalescer, current_app.config[CONFIG_REQUEST_COALESCER]).run(
+            approach, request_json["messages"], context=context, session_state=request_json.get("session_state")
         )
         return jsonify(r)
     except Exception as error:
@@ -170,7 +181,8 @@ async def chat(auth_claims: Dict[str, Any]):
         else:
             approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
 
-        result = await approach.run(
+        result = await cast(RequestCoalescer, current_app.config[CONFIG_REQUEST_COALESCER]).run(
+            approach,
             request_json["messages"],
             stream=request_json.get("stream", False),
             context=context,
@@ -205,6 +217,17 @@ def config():
     )
 
 
+# Latency histograms of each approach stage, in the Prometheus text format, when LATENCY_SINKS includes prometheus
+@bp.route("/metrics", methods=["GET"])
+async def metrics():
+    prometheus_sink = cast(LatencyTracer, current_app.config[CONFIG_LATENCY_TRACER]).get_sink(PrometheusSink)
+    if prometheus_sink is None:
+        abort(404)
+    response = await make_response(cast(PrometheusSink, prometheus_sink).render())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4"
+    return response
+
+
 @bp.before_app_serving
 async def setup_clients():
     # Replace these with your own values, either in environment variables or directly here
@@ -219,6 +242,10 @@ async def setup_clients():
     OPENAI_HOST = os.getenv("OPENAI_HOST", "azure")
     OPENAI_CHATGPT_MODEL = os.environ["AZURE_OPENAI_CHATGPT_MODEL"]
     OPENAI_EMB_MODEL = os.getenv("AZURE_OPENAI_EMB_MODEL_NAME", "text-embedding-ada-002")
+    # Only set for models that support shortened embeddings, must match the dimensions used by prepdocs
+    OPENAI_EMB_DIMENSIONS = (
+        int(os.environ["AZURE_OPENAI_EMB_DIMENSIONS"]) if os.getenv("AZURE_OPENAI_EMB_DIMENSIONS") else None
+    )
     # Used with Azure OpenAI deployments
     AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
     AZURE_OPENAI_GPT4V_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT4V_DEPLOYMENT")
@@ -246,6 +273,12 @@ async def setup_clients():
     AZURE_SEARCH_SEMANTIC_RANKER = os.getenv("AZURE_SEARCH_SEMANTIC_RANKER", "free").lower()
 
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
+    # Folder written by prepdocs --localindex, searched in this process instead of the Azure AI Search index
+    LOCAL_SEARCH_INDEX_PATH = os.getenv("LOCAL_SEARCH_INDEX_PATH")
+    # Where the timings of each approach stage go: any of console, prometheus (served on /metrics) and otlp
+    LATENCY_SINKS = [sink.strip().lower() for sink in os.getenv("LATENCY_SINKS", "").split(",") if sink.strip()]
+    # Identical questions asked while the first one is still being answered share its answer (off unless set to true)
+    COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "").lower() == "true"
 
     # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
@@ -273,6 +306,19 @@ async def setup_clients():
         index_name=AZURE_SEARCH_INDEX,
         credential=search_credential,
     )
+    search_backend = LocalSearchBackend(LOCAL_SEARCH_INDEX_PATH) if LOCAL_SEARCH_INDEX_PATH else None
+
+    latency_sinks: List[LatencySink] = []
+    if "console" in LATENCY_SINKS:
+        latency_sinks.append(ConsoleSink())
+    if "prometheus" in LATENCY_SINKS:
+        latency_sinks.append(PrometheusSink())
+    if "otlp" in LATENCY_SINKS:
+        # Sent to the collector at OTEL_EXPORTER_OTLP_ENDPOINT, or http://localhost:4318 if it isn't set,
+        # unless Azure Monitor already set up a meter provider
+        OpenTelemetrySink.use_otlp_exporter()
+        latency_sinks.append(OpenTelemetrySink())
+    latency_tracer = LatencyTracer(latency_sinks)
     search_index_client = SearchIndexClient(
         endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
         credential=search_credential,
@@ -301,7 +347,8 @@ async def setup_clients():
         token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
         # Store on app.config for later use inside requests
         openai_client = AsyncAzureOpenAI(
-            api_version="2023-07-01-preview",
+            # The first GA version that accepts the dimensions of shortened embeddings, like prepdocs uses
+            api_version="2024-02-01",
             azure_endpoint=f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com",
             azure_ad_token_provider=token_provider,
         )
@@ -317,6 +364,8 @@ async def setup_clients():
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
+    current_app.config[CONFIG_LATENCY_TRACER] = latency_tracer
+    current_app.config[CONFIG_REQUEST_COALESCER] = RequestCoalescer(enabled=COALESCE_REQUESTS)
 
     current_app.config[CONFIG_GPT4V_DEPLOYED] = bool(USE_GPT4V)
     current_app.config[CONFIG_SEMANTIC_RANKER_DEPLOYED] = AZURE_SEARCH_SEMANTIC_RANKER != "disabled"
@@ -331,11 +380,14 @@ async def setup_clients():
         chatgpt_model=OPENAI_CHATGPT_MODEL,
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         embedding_model=OPENAI_EMB_MODEL,
+        embedding_dimensions=OPENAI_EMB_DIMENSIONS,
         embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
         sourcepage_field=KB_FIELDS_SOURCEPAGE,
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        search_backend=search_backend,
+        latency_tracer=latency_tracer,
     )
 
     if USE_GPT4V:
@@ -352,11 +404,14 @@ async def setup_clients():
             gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
             gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
             embedding_model=OPENAI_EMB_MODEL,
+            embedding_dimensions=OPENAI_EMB_DIMENSIONS,
             embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
             sourcepage_field=KB_FIELDS_SOURCEPAGE,
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            search_backend=search_backend,
+            latency_tracer=latency_tracer,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -369,11 +424,14 @@ async def setup_clients():
             gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
             gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
             embedding_model=OPENAI_EMB_MODEL,
+            embedding_dimensions=OPENAI_EMB_DIMENSIONS,
             embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
             sourcepage_field=KB_FIELDS_SOURCEPAGE,
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            search_backend=search_backend,
+            latency_tracer=latency_tracer,
         )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -383,11 +441,14 @@ async def setup_clients():
         chatgpt_model=OPENAI_CHATGPT_MODEL,
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         embedding_model=OPENAI_EMB_MODEL,
+        embedding_dimensions=OPENAI_EMB_DIMENSIONS,
         embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
         sourcepage_field=KB_FIELDS_SOURCEPAGE,
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        search_backend=search_backend,
+        latency_tracer=latency_tracer,
     )
 
 
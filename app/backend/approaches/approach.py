@@ -1,4 +1,5 @@
 import os
+from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Any, AsyncGenerator, List, Optional, Union, cast
 
@@ -13,11 +14,26 @@ from azure.search.documents.models import (
 from openai import AsyncOpenAI
 
 from core.authentication import AuthenticationHelper
+from core.latency import LatencyTracer, RequestTrace
+from core.modelhelper import get_embedding_dimensions
 from text import nonewlines
 
 
 @dataclass
 class Document:
+    __slots__ = (
+        "id",
+        "content",
+        "embedding",
+        "image_embedding",
+        "category",
+        "sourcepage",
+        "sourcefile",
+        "oids",
+        "groups",
+        "captions",
+    )
+
     id: Optional[str]
     content: Optional[str]
     embedding: Optional[List[float]]
@@ -74,36 +90,47 @@ class ThoughtStep:
     props: Optional[dict[str, Any]] = None
 
 
-class Approach:
+class SearchBackend(ABC):
+    """
+    Where the approaches retrieve their sources from, given the same arguments as Approach.search
+    """
+
+    @abstractmethod
+    async def search(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: List[VectorQuery],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        use_full_search_mode: bool,
+        select_vectors: List[str],
+    ) -> List[Document]:
+        pass
+
+
+class AzureSearchBackend(SearchBackend):
+    """
+    Searches an Azure AI Search index, with its semantic ranker if requested. Only the fields of a Document are
+    returned, and of the vector fields only the ones selected, since each vector is a long list of floats to send and
+    parse for every result
+    """
+
+    SELECT_FIELDS = ["id", "content", "category", "sourcepage", "sourcefile"]
+    AUTH_FIELDS = ["oids", "groups"]
+
     def __init__(
         self,
         search_client: SearchClient,
-        openai_client: AsyncOpenAI,
-        auth_helper: AuthenticationHelper,
         query_language: Optional[str],
         query_speller: Optional[str],
-        embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
-        embedding_model: str,
-        openai_host: str,
+        has_auth_fields: bool = False,  # Indexes made without access control have no oids and groups fields
     ):
         self.search_client = search_client
-        self.openai_client = openai_client
-        self.auth_helper = auth_helper
         self.query_language = query_language
         self.query_speller = query_speller
-        self.embedding_deployment = embedding_deployment
-        self.embedding_model = embedding_model
-        self.openai_host = openai_host
-
-    def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
-        exclude_category = overrides.get("exclude_category") or None
-        security_filter = self.auth_helper.build_security_filters(overrides, auth_claims)
-        filters = []
-        if exclude_category:
-            filters.append("category ne '{}'".format(exclude_category.replace("'", "''")))
-        if security_filter:
-            filters.append(security_filter)
-        return None if len(filters) == 0 else " and ".join(filters)
+        self.has_auth_fields = has_auth_fields
 
     async def search(
         self,
@@ -114,7 +141,9 @@ class Approach:
         use_semantic_ranker: bool,
         use_semantic_captions: bool,
         use_full_search_mode: bool,
+        select_vectors: List[str],
     ) -> List[Document]:
+        select = self.SELECT_FIELDS + (self.AUTH_FIELDS if self.has_auth_fields else []) + select_vectors
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
         if use_semantic_ranker and query_text:
             search_mode = "any"
@@ -131,13 +160,19 @@ class Approach:
                 query_caption="extractive|highlight-false" if use_semantic_captions else None,
                 vector_queries=vectors,
                 search_mode=search_mode,
+                select=select,
             )
         else:
             search_mode = "any"
             if use_full_search_mode:
                 search_mode = "all"
             results = await self.search_client.search(
-                search_mode=search_mode, search_text=query_text or "", filter=filter, top=top, vector_queries=vectors
+                search_mode=search_mode,
+                search_text=query_text or "",
+                filter=filter,
+                top=top,
+                vector_queries=vectors,
+                select=select,
             )
 
         documents = []
@@ -159,6 +194,81 @@ class Approach:
                 )
         return documents
 
+
+class Approach:
+    def __init__(
+        self,
+        search_client: SearchClient,
+        openai_client: AsyncOpenAI,
+        auth_helper: AuthenticationHelper,
+        query_language: Optional[str],
+        query_speller: Optional[str],
+        embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
+        embedding_model: str,
+        openai_host: str,
+        embedding_dimensions: Optional[int] = None,  # Only for models that support shortened embeddings
+        search_backend: Optional[SearchBackend] = None,  # Searches the Azure AI Search index if not given
+        latency_tracer: Optional[LatencyTracer] = None,
+    ):
+        self.search_client = search_client
+        self.openai_client = openai_client
+        self.auth_helper = auth_helper
+        self.query_language = query_language
+        self.query_speller = query_speller
+        self.embedding_deployment = embedding_deployment
+        self.embedding_model = embedding_model
+        self.openai_host = openai_host
+        self.embedding_dimensions = embedding_dimensions
+        self.search_backend = search_backend
+        self.latency_tracer = latency_tracer or LatencyTracer()
+
+    def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
+        exclude_category = overrides.get("exclude_category") or None
+        security_filter = self.auth_helper.build_security_filters(overrides, auth_claims)
+        filters = []
+        if exclude_category:
+            filters.append("category ne '{}'".format(exclude_category.replace("'", "''")))
+        if security_filter:
+            filters.append(security_filter)
+        return None if len(filters) == 0 else " and ".join(filters)
+
+    async def search(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: List[VectorQuery],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        use_full_search_mode: bool = False,
+        select_vectors: List[str] = [],  # Vector fields to return with each document, none unless they're used
+    ) -> List[Document]:
+        search_backend = self.search_backend or AzureSearchBackend(
+            self.search_client,
+            self.query_language,
+            self.query_speller,
+            has_auth_fields=self.auth_helper is not None and self.auth_helper.has_auth_fields,
+        )
+        return await search_backend.search(
+            top,
+            query_text,
+            filter,
+            vectors,
+            use_semantic_ranker,
+            use_semantic_captions,
+            use_full_search_mode,
+            select_vectors,
+        )
+
+    def get_select_vectors(self, overrides: dict[str, Any], needed: List[str] = []) -> List[str]:
+        # The vectors of the results are only shown in the thoughts when asked for, for debugging
+        if overrides.get("include_vectors"):
+            return list(dict.fromkeys(needed + overrides.get("vector_fields", ["embedding"])))
+        return needed
+
+    def latency_thought_step(self, trace: RequestTrace) -> ThoughtStep:
+        return ThoughtStep("Latency of each stage (ms)", trace.as_milliseconds())
+
     def get_sources_content(
         self, results: List[Document], use_semantic_captions: bool, use_image_citation: bool
     ) -> list[str]:
@@ -180,18 +290,26 @@ class Approach:
             return sourcepage
         else:
             path, ext = os.path.splitext(sourcepage)
-            if ext.lower() == ".png":
+            if ext.lower() in (".png", ".jpeg", ".webp"):
                 page_idx = path.rfind("-")
                 page_number = int(path[page_idx + 1 :])
                 return f"{path[:page_idx]}.pdf#page={page_number}"
 
             return sourcepage
 
+    def get_dimensions_argument(self) -> dict[str, Any]:
+        # Query vectors must have the same number of dimensions as the vectors in the index. Like prepdocs, the
+        # dimensions are only sent for shortened vectors, since older models reject the parameter
+        if not self.embedding_dimensions or self.embedding_dimensions == get_embedding_dimensions(self.embedding_model):
+            return {}
+        return {"dimensions": self.embedding_dimensions}
+
     async def compute_text_embedding(self, q: str):
         embedding = await self.openai_client.embeddings.create(
             # Azure Open AI takes the deployment name as the model name
             model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
             input=q,
+            **self.get_dimensions_argument(),
         )
         query_vector = embedding.data[0].embedding
         return RawVectorQuery(vector=query_vector, k=50, fields="embedding")
@@ -1,17 +1,17 @@
 import json
-import logging
 import re
+import time
 from abc import ABC, abstractmethod
 from typing import Any, AsyncGenerator, Optional, Union
 
 from openai.types.chat import (
     ChatCompletion,
-    ChatCompletionContentPartParam,
-    ChatCompletionMessageParam,
+    ChatCompletionToolParam,
 )
 
 from approaches.approach import Approach
-from core.messagebuilder import MessageBuilder
+from core.latency import COMPLETION, TIME_TO_FIRST_TOKEN
+from core.promptassembler import PromptAssembler
 
 
 class ChatApproach(Approach, ABC):
@@ -53,7 +53,7 @@ class ChatApproach(Approach, ABC):
         pass
 
     @abstractmethod
-    async def run_until_final_call(self, history, overrides, auth_claims, should_stream) -> tuple:
+    async def run_until_final_call(self, history, overrides, auth_claims, should_stream, trace) -> tuple:
         pass
 
     def get_system_prompt(self, override_prompt: Optional[str], follow_up_questions_prompt: str) -> str:
@@ -68,6 +68,38 @@ class ChatApproach(Approach, ABC):
         else:
             return override_prompt.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
+    def build_prompts(self, model_id: str, query_tools: Optional[list[ChatCompletionToolParam]] = None):
+        """
+        Builds the fixed part of the query rewrite prompt, and of the answer prompt with and without follow-up
+        questions, once for all requests
+        """
+        self.query_prompt = PromptAssembler(
+            self.query_prompt_template, model_id, few_shots=self.query_prompt_few_shots, tools=query_tools
+        )
+        self.answer_prompts = {
+            suggest_followup_questions: PromptAssembler(
+                self.get_system_prompt(
+                    None, self.follow_up_questions_prompt_content if suggest_followup_questions else ""
+                ),
+                model_id,
+            )
+            for suggest_followup_questions in [False, True]
+        }
+
+    def get_answer_prompt(self, overrides: dict[str, Any]) -> PromptAssembler:
+        answer_prompt = self.answer_prompts[bool(overrides.get("suggest_followup_questions"))]
+        override_prompt = overrides.get("prompt_template")
+        if override_prompt is None:
+            return answer_prompt
+        # Allow client to replace the entire prompt, or to inject into the existing prompt using >>>
+        return PromptAssembler(
+            self.get_system_prompt(
+                override_prompt,
+                self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
+            ),
+            answer_prompt.model_id,
+        )
+
     def get_search_query(self, chat_completion: ChatCompletion, user_query: str):
         response_message = chat_completion.choices[0].message
 
@@ -84,7 +116,7 @@ class ChatApproach(Approach, ABC):
                 if function.name == "filtered_search":
                     arg = json.loads(function.arguments)
                     return arg
-                    
+
         elif query_text := response_message.content:
             if query_text.strip() != self.NO_RESPONSE:
                 return query_text
@@ -93,47 +125,22 @@ class ChatApproach(Approach, ABC):
     def extract_followup_questions(self, content: str):
         return content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
 
-    def get_messages_from_history(
-        self,
-        system_prompt: str,
-        model_id: str,
-        history: list[dict[str, str]],
-        user_content: Union[str, list[ChatCompletionContentPartParam]],
-        max_tokens: int,
-        few_shots=[],
-    ) -> list[ChatCompletionMessageParam]:
-        message_builder = MessageBuilder(system_prompt, model_id)
-
-        # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
-
-        append_index = len(few_shots) + 1
-
-        message_builder.insert_message(self.USER, user_content, index=append_index)
-        total_token_count = message_builder.count_tokens_for_message(dict(message_builder.messages[-1]))  # type: ignore
-
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(message)
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
-                break
-            message_builder.insert_message(message["role"], message["content"], index=append_index)
-            total_token_count += potential_message_count
-        return message_builder.messages
-
     async def run_without_streaming(
         self,
         history: list[dict[str, str]],
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
-    ) -> dict[str, Any]: 
+    ) -> dict[str, Any]:
+        trace = self.latency_tracer.start(type(self).__name__)
         extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=False
+            history, overrides, auth_claims, should_stream=False, trace=trace
         )
-        chat_completion_response: ChatCompletion = await chat_coroutine
+        with trace.stage(COMPLETION):
+            chat_completion_response: ChatCompletion = await chat_coroutine
+        trace.finish()
+        if overrides.get("include_latency"):
+            extra_info["thoughts"].append(self.latency_thought_step(trace))
         chat_resp = chat_completion_response.model_dump()  # Convert to dict to make it JSON serializable
         chat_resp["choices"][0]["context"] = extra_info
         if overrides.get("suggest_followup_questions"):
@@ -150,8 +157,9 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> AsyncGenerator[dict, None]:
+        trace = self.latency_tracer.start(type(self).__name__)
         extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=True
+            history, overrides, auth_claims, should_stream=True, trace=trace
         )
         yield {
             "choices": [
@@ -168,6 +176,7 @@ class ChatApproach(Approach, ABC):
 
         followup_questions_started = False
         followup_content = ""
+        completion_start_time = time.perf_counter()
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
             event = event_chunk.model_dump()  # Convert pydantic model to dict
@@ -175,6 +184,8 @@ class ChatApproach(Approach, ABC):
                 # if event contains << and not >>, it is start of follow-up question, truncate
                 content = event["choices"][0]["delta"].get("content")
                 content = content or ""  # content may either not exist in delta, or explicitly be None
+                if content and TIME_TO_FIRST_TOKEN not in trace.timings:
+                    trace.record(TIME_TO_FIRST_TOKEN, trace.since_start())
                 if overrides.get("suggest_followup_questions") and "<<" in content:
                     followup_questions_started = True
                     earlier_content = content[: content.index("<<")]
@@ -199,6 +210,20 @@ class ChatApproach(Approach, ABC):
                 ],
                 "object": "chat.completion.chunk",
             }
+        trace.record(COMPLETION, time.perf_counter() - completion_start_time)
+        trace.finish()
+        if overrides.get("include_latency"):
+            yield {
+                "choices": [
+                    {
+                        "delta": {"role": self.ASSISTANT},
+                        "context": {"thoughts": [self.latency_thought_step(trace)]},
+                        "finish_reason": None,
+                        "index": 0,
+                    }
+                ],
+                "object": "chat.completion.chunk",
+            }
 
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
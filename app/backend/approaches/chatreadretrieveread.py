@@ -1,6 +1,8 @@
-from typing import Any, Coroutine, List, Literal, Optional, Union, overload
 import json
+import os
 import re
+import time
+from typing import Any, Coroutine, List, Literal, Optional, Union, overload
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
@@ -11,9 +13,21 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import SearchBackend, ThoughtStep
 from approaches.chatapproach import ChatApproach
+from approaches.keywordquery import KeywordQueryClassifier
+from approaches.sourcereducer import SourceReducer
 from core.authentication import AuthenticationHelper
+from core.contextpacker import ContextPacker
+from core.latency import (
+    EMBEDDING,
+    PROMPT_BUILD,
+    QUERY_REWRITE,
+    QUERY_RULES,
+    SEARCH,
+    LatencyTracer,
+    RequestTrace,
+)
 from core.modelhelper import get_token_limit
 
 
@@ -24,6 +38,106 @@ class ChatReadRetrieveReadApproach(ChatApproach):
     original user question, and search results to OpenAI to generate a response.
     """
 
+    # Bit i of the meetingDays field is set when a class meets on WEEK_DAYS[i]
+    WEEK_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+    # Share of the prompt, after its fixed part, that the sources can take up, leaving the rest for the history
+    sources_token_share = 0.75
+
+    # Tools the query rewrite can call, to search the sources, the degree requirements, or the classes with filters
+    query_tools: List[ChatCompletionToolParam] = [
+        {
+            "type": "function",
+            "function": {
+                "name": "search_sources",
+                "description": "Retrieve sources from the Azure AI Search index that do not require extra filtering",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "search_query": {
+                            "type": "string",
+                            "description": "Query string to retrieve documents from azure search eg: 'Health care plan'",
+                        }
+                    },
+                    "required": ["search_query"],
+                },
+            },
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "search_degree_requirements",
+                "description": "Answer quesions based off of degree requirements",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "search_query": {
+                            "type": "string",
+                            "description": "Query string to ask about degree requirements eg: 'What are the CSE degree requirements'",
+                        }
+                    },
+                    "required": ["search_query"],
+                },
+            },
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "filtered_search",
+                "description": "Filter search with more specific fields",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "search_query": {
+                            "type": "string",
+                            "description": "If the ask is related to a specific major and/or a specific level eg: 'Show me some 300 level cse classes' put the whole query here.",
+                        },
+                        "major": {
+                            "type": "string",
+                            "description": "If the ask is related to a specific majors eg: 'Plan me a schedule with 1 communications class and 1 anthropology class' set to a list of majors they are querying. Set to a list if there are multiple majors.",
+                        },
+                        "level": {
+                            "type": "string",
+                            "description": "If the ask contains the word level eg: 'I want to take a 300 level CSE class' set to the level they are querying. ONLY set this if the word 'level' is explicitly stated in the message.",
+                        },
+                        "instructor": {
+                            "type": "string",
+                            "description": "If the ask is related to a specific instructor/professor/teacher eg: 'What CSE classes does Jane Doe teach?' set to the instructor they are querying.",
+                        },
+                        "days": {
+                            "type": "array",
+                            "items": {"type": "string", "enum": WEEK_DAYS},
+                            "description": "If the ask is for classes that meet on specific days eg: 'Show me Monday classes' set to the days they must meet on.",
+                        },
+                        "exclude_days": {
+                            "type": "array",
+                            "items": {"type": "string", "enum": WEEK_DAYS},
+                            "description": "If the ask is for classes that don't meet on specific days eg: 'I don't want class on Friday' set to the days they must not meet on.",
+                        },
+                        "start_after": {
+                            "type": "string",
+                            "description": "If the ask is for classes that start at or after a time eg: 'classes after 1pm' set to that time as HH:MM in 24 hour time.",
+                        },
+                        "end_before": {
+                            "type": "string",
+                            "description": "If the ask is for classes that end by a time eg: 'classes that finish before noon' set to that time as HH:MM in 24 hour time.",
+                        },
+                        "credits": {
+                            "type": "integer",
+                            "description": "If the ask is for classes worth a number of credits eg: '5 credit classes' set to the number of credits.",
+                        },
+                        "section_types": {
+                            "type": "array",
+                            "items": {"type": "string", "enum": ["lecture", "quiz", "lab"]},
+                            "description": "If the ask is for classes that have a kind of section eg: 'classes with a lab' set to the kinds of sections they must have.",
+                        },
+                    },
+                    "required": ["search_query", "level", "major", "instructor"],
+                },
+            },
+        },
+    ]
+
     def __init__(
         self,
         *,
@@ -34,10 +148,13 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
+        embedding_dimensions: Optional[int] = None,  # Only for models that support shortened embeddings
         sourcepage_field: str,
         content_field: str,
         query_language: str,
         query_speller: str,
+        search_backend: Optional[SearchBackend] = None,  # Searches the Azure AI Search index if not given
+        latency_tracer: Optional[LatencyTracer] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -46,11 +163,19 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.chatgpt_deployment = chatgpt_deployment
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
+        self.embedding_dimensions = embedding_dimensions
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.search_backend = search_backend
+        self.latency_tracer = latency_tracer or LatencyTracer()
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        with open(os.path.join(os.path.dirname(__file__), "major_abv.json")) as file:
+            self.keyword_query_classifier = KeywordQueryClassifier(json.load(file))
+        self.build_prompts(chatgpt_model, self.query_tools)
+        self.context_packer = ContextPacker(chatgpt_model)
+        self.source_reducer = SourceReducer()
 
     @property
     def system_message_chat_conversation(self):
@@ -63,6 +188,81 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         {injected_prompt}
         """
 
+    def build_course_filter(self, arguments: dict[str, Any]) -> Optional[str]:
+        """
+        Builds an OData filter on the indexed fields of the classes from the arguments of the filtered_search tool
+        """
+        filters = []
+        level = arguments.get("level")
+        # only do a level filter if it was specifically asked for, in any case ("300 Level classes")
+        if level and "level" in (arguments.get("search_query") or "").lower():
+            try:
+                filters.append(f"level ge {int(level)} and level lt {int(level) + 100}")
+            except ValueError:
+                pass
+        majors = arguments.get("major")
+        if majors:
+            if not isinstance(majors, list):
+                majors = [majors]
+            with open(os.path.join(os.path.dirname(__file__), "major_abv.json")) as file:
+                abv_dict = json.load(file)
+            # switch to abrev
+            majors = [abv_dict.get(major.lower(), major).lower() for major in majors]
+            filters.append("(" + " or ".join(f"major eq '{self.escape(major)}'" for major in majors) + ")")
+        instructor = arguments.get("instructor")
+        if instructor:
+            # Names are indexed as "Last,First", so every word of the name has to match but not in order
+            words = re.sub(r"[^\w\s'.]", " ", instructor)
+            filters.append(f"search.ismatch('{self.escape(words)}', 'instructors', 'simple', 'all')")
+        required_days = self.day_mask(arguments.get("days"))
+        excluded_days = self.day_mask(arguments.get("exclude_days"))
+        if required_days or excluded_days:
+            # OData has no bitwise operators, so the filter lists every combination of days that matches
+            masks = [
+                mask
+                for mask in range(1, 1 << len(self.WEEK_DAYS))
+                if mask & required_days == required_days and mask & excluded_days == 0
+            ]
+            filters.append("(" + " or ".join(f"meetingDays eq {mask}" for mask in masks) + ")" if masks else "false")
+        start_after = self.minutes_after_midnight(arguments.get("start_after"))
+        if start_after is not None:
+            filters.append(f"startMinutes ge {start_after}")
+        end_before = self.minutes_after_midnight(arguments.get("end_before"))
+        if end_before is not None:
+            filters.append(f"endMinutes le {end_before}")
+        credits = arguments.get("credits")
+        if isinstance(credits, int) and not isinstance(credits, bool):
+            filters.append(f"minCredits le {credits} and maxCredits ge {credits}")
+        for section_type in arguments.get("section_types") or []:
+            filters.append(f"sectionTypes/any(t: t eq '{self.escape(section_type)}')")
+        return " and ".join(filters) if filters else None
+
+    @classmethod
+    def escape(cls, value: str) -> str:
+        return value.replace("'", "''")
+
+    @classmethod
+    def day_mask(cls, days: Optional[list[str]]) -> int:
+        if not isinstance(days, list):
+            return 0
+        mask = 0
+        for day in days:
+            if isinstance(day, str) and day.capitalize() in cls.WEEK_DAYS:
+                mask |= 1 << cls.WEEK_DAYS.index(day.capitalize())
+        return mask
+
+    @classmethod
+    def minutes_after_midnight(cls, time: Optional[str]) -> Optional[int]:
+        # Times are asked for as HH:MM, but "2pm" or "2:30 PM" are understood too
+        match = re.fullmatch(r"\s*(\d{1,2})(?::(\d{2}))?\s*([AaPp][Mm])?\s*", time) if isinstance(time, str) else None
+        if not match:
+            return None
+        hours = int(match.group(1)) % 12 if match.group(3) else int(match.group(1))
+        if match.group(3) and match.group(3).lower() == "pm":
+            hours += 12
+        minutes = hours * 60 + int(match.group(2) or 0)
+        return minutes if minutes <= 24 * 60 else None
+
     @overload
     async def run_until_final_call(
         self,
@@ -70,6 +270,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[False],
+        trace: Optional[RequestTrace] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]: ...
 
     @overload
@@ -79,6 +280,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[True],
+        trace: Optional[RequestTrace] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]: ...
 
     async def run_until_final_call(
@@ -87,7 +289,9 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        trace: Optional[RequestTrace] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
+        trace = trace or self.latency_tracer.start(type(self).__name__)
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
@@ -98,193 +302,98 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         original_user_query = history[-1]["content"]
         user_query_request = "Generate search query for: " + original_user_query
 
-
-        tools: List[ChatCompletionToolParam] = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "search_sources",
-                    "description": "Retrieve sources from the Azure AI Search index that do not require extra filtering",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "search_query": {
-                                "type": "string",
-                                "description": "Query string to retrieve documents from azure search eg: 'Health care plan'",
-                            }
-                        },
-                        "required": ["search_query"],
-                    },
-                },
-                "type": "function",
-                "function": {
-                    "name": "search_degree_requirements",
-                    "description": "Answer quesions based off of degree requirements",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "search_query": {
-                                "type": "string",
-                                "description": "Query string to ask about degree requirements eg: 'What are the CSE degree requirements'",
-                            }
-                        },
-                        "required": ["search_query"],
-                    },
-                },
-                "type": "function",
-                "function": {
-                    "name": "filtered_search",
-                    "description": "Filter search with more specific fields",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "search_query": {
-                                "type": "string",
-                                "description": "If the ask is related to a specific major and/or a specific level eg: 'Show me some 300 level cse classes' put the whole query here.",
-                            },
-                            "major": {
-                                "type": "string",
-                                "description": "If the ask is related to a specific majors eg: 'Plan me a schedule with 1 communications class and 1 anthropology class' set to a list of majors they are querying. Set to a list if there are multiple majors.",
-                            },
-                            "level": {
-                                "type": "string",
-                                "description": "If the ask contains the word level eg: 'I want to take a 300 level CSE class' set to the level they are querying. ONLY set this if the word 'level' is explicitly stated in the message.",
-                            },
-                            "instructor": {
-                                "type": "string",
-                                "description": "If the ask is related to a specific instructor/professor/teacher eg: 'What CSE classes does Jane Doe teach?' set to the instructor they are querying.",
-                            }
-                        },
-                        "required": ["search_query", "level", "major", "instructor"],
-                    },
-                },
-            }
-        ]
-
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
+        # First questions that are only course codes, levels and majors get their query from rules, saving a model call
+        query_rewrite_start_time = time.perf_counter()
+        query_text: Any = self.keyword_query_classifier.classify(history)
+        if query_text is not None:
+            trace.record(QUERY_RULES, time.perf_counter() - query_rewrite_start_time)
+        else:
+            # Setting too low risks malformed JSON, setting too high may affect performance
+            query_response_token_limit = 100
+            messages = self.query_prompt.build_messages(
+                history, user_query_request, max_tokens=self.chatgpt_token_limit - query_response_token_limit
+            )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=messages,  # type: ignore
-            # Azure Open AI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            tools=tools,
-            tool_choice="auto",
-        )
+            chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+                messages=messages,  # type: ignore
+                # Azure Open AI takes the deployment name as the model name
+                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                temperature=0.0,
+                max_tokens=query_response_token_limit,
+                n=1,
+                tools=self.query_tools,
+                tool_choice="auto",
+            )
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+            query_text = self.get_search_query(chat_completion, original_user_query)
+            trace.record(QUERY_REWRITE, time.perf_counter() - query_rewrite_start_time)
 
         # Good examples:
         # i just finished CSE 333 and I like operating systems, what should I take next
         # Can't do:
         # how often is CSE 333 offered
         # how often is a class filled
-        
+
         # are there MUSIC theory classes for non majors
 
         use_full_search_mode = False
         if isinstance(query_text, dict):
-            # update the filters to narrow down class by level
-            level = query_text.get("level")
-            majors = query_text.get("major")
-            instructor = query_text.get("instructor")
-            if level:
-                # only do a level filter if it was specifically asked for
-                if 'level' in query_text.get("search_query"):
-                    try:
-                        if not filter:
-                            filter = "level ge " + str(level) + " and level lt " + str(int(level) + 100)
-                        else:
-                            filter += "and level ge " + str(level) + " and level lt " + str(level + 100)
-                    except:
-                        filter = None
-            if majors:
-                if not isinstance(majors, list):
-                    majors = [majors]
-                first_major = True
-                for major in majors:
-                    with open("./approaches/major_abv.json") as file:
-                        abv_dict = json.load(file)
-                        # switch to abrev
-                        if major.lower() in abv_dict:
-                            major = abv_dict[major.lower()]
-                        # for key in sorted(abv_dict):
-                        #     # need to fix when majors have similar names
-                        #     if major.lower() in key: 
-                        #         break
-                    if not filter:
-                        filter = "(major eq " + "'" + major.lower() + "'"
-                        first_major = False
-                    elif first_major:
-                        filter += " and (major eq " + "'" + major.lower() + "'"
-                        first_major = False
-                    else:
-                        filter += " or major eq " + "'" + major.lower() + "'"
-                filter += ")"
-            if instructor:
-                use_full_search_mode = True
-                has_vector = False
-                query_text = instructor
-            else:
-                query_text = query_text.get("search_query")
-        
-        # normalize week days and do/not
-        original_user_query = original_user_query.replace("monday", "Monday")
-        original_user_query = original_user_query.replace("tuesday", "Tuesday")
-        original_user_query = original_user_query.replace("wednesday", "Wednesday")
-        original_user_query = original_user_query.replace("thursday", "Thursday")
-        original_user_query = original_user_query.replace("friday", "Friday")
-        original_user_query = original_user_query.replace(" do ", " DO ")
-        original_user_query = original_user_query.replace(" not ", " NOT ")
+            # Push the structured parts of the ask into filters on the indexed fields of the classes
+            course_filter = self.build_course_filter(query_text)
+            if course_filter:
+                filter = f"{filter} and {course_filter}" if filter else course_filter
+            query_text = query_text.get("search_query") or original_user_query
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
         if has_vector:
-            vectors.append(await self.compute_text_embedding(query_text))
+            with trace.stage(EMBEDDING):
+                vectors.append(await self.compute_text_embedding(query_text))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions, use_full_search_mode)
+        with trace.stage(SEARCH):
+            results = await self.search(
+                self.source_reducer.candidates(top),
+                query_text,
+                filter,
+                vectors,
+                use_semantic_ranker,
+                use_semantic_captions,
+                use_full_search_mode,
+                select_vectors=self.get_select_vectors(overrides, self.source_reducer.VECTOR_FIELDS),
+            )
+            results = self.source_reducer.reduce(results, top)
 
+        prompt_build_start_time = time.perf_counter()
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
-        content = "\n".join(sources_content)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
-        # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
-        system_message = self.get_system_prompt(
-            overrides.get("prompt_template"),
-            self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
-        )
-
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
-        messages = self.get_messages_from_history(
-            system_prompt=system_message,
-            model_id=self.chatgpt_model,
-            history=history,
+        answer_prompt = self.get_answer_prompt(overrides)
+        # The sources get their share of what the fixed part of the prompt leaves, so there's room for the history
+        packed_sources = self.context_packer.pack(
+            sources_content, int((messages_token_limit - answer_prompt.token_count) * self.sources_token_share)
+        )
+        sources_content = packed_sources.sources
+        content = "\n".join(sources_content)
+        messages = answer_prompt.build_messages(
+            history,
             # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
-            user_content=original_user_query + "\n\nSources:\n" + content,
+            original_user_query + "\n\nSources:\n" + content,
             max_tokens=messages_token_limit,
         )
 
         data_points = {"text": sources_content}
 
-        extra_info = {
+        extra_info: dict[str, Any] = {
             "data_points": data_points,
             "thoughts": [
                 ThoughtStep(
@@ -300,6 +409,16 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 ThoughtStep("Prompt", [str(message) for message in messages]),
             ],
         }
+        if packed_sources.truncated or packed_sources.dropped:
+            extra_info["thoughts"].insert(
+                3,
+                ThoughtStep(
+                    "Sources cut to fit the prompt",
+                    {"truncated": packed_sources.truncated, "dropped": packed_sources.dropped},
+                    {"token_count": packed_sources.token_count},
+                ),
+            )
+        trace.record(PROMPT_BUILD, time.perf_counter() - prompt_build_start_time)
 
         chat_coroutine = self.openai_client.chat.completions.create(
             # Azure Open AI takes the deployment name as the model name
@@ -310,4 +429,4 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             n=1,
             stream=should_stream,
         )
-        return (extra_info, chat_coroutine)
\ No newline at end of file
+        return (extra_info, chat_coroutine)
@@ -1,3 +1,4 @@
+import time
 from typing import Any, Coroutine, Optional, Union
 
 from azure.search.documents.aio import SearchClient
@@ -10,10 +11,18 @@ from openai.types.chat import (
     ChatCompletionContentPartParam,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import SearchBackend, ThoughtStep
 from approaches.chatapproach import ChatApproach
 from core.authentication import AuthenticationHelper
 from core.imageshelper import fetch_image
+from core.latency import (
+    EMBEDDING,
+    PROMPT_BUILD,
+    QUERY_REWRITE,
+    SEARCH,
+    LatencyTracer,
+    RequestTrace,
+)
 from core.modelhelper import get_token_limit
 
 
@@ -35,10 +44,13 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         gpt4v_model: str,
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
+        embedding_dimensions: Optional[int] = None,  # Only for models that support shortened embeddings
         sourcepage_field: str,
         content_field: str,
         query_language: str,
         query_speller: str,
+        search_backend: Optional[SearchBackend] = None,  # Searches the Azure AI Search index if not given
+        latency_tracer: Optional[LatencyTracer] = None,
         vision_endpoint: str,
         vision_key: str,
     ):
@@ -50,13 +62,17 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.gpt4v_model = gpt4v_model
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
+        self.embedding_dimensions = embedding_dimensions
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.search_backend = search_backend
+        self.latency_tracer = latency_tracer or LatencyTracer()
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
         self.chatgpt_token_limit = get_token_limit(gpt4v_model)
+        self.build_prompts(gpt4v_model)
 
     @property
     def system_message_chat_conversation(self):
@@ -81,7 +97,9 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        trace: Optional[RequestTrace] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
+        trace = trace or self.latency_tracer.start(type(self).__name__)
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         vector_fields = overrides.get("vector_fields", ["embedding"])
@@ -97,25 +115,23 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
         user_query_request = "Generate search query for: " + original_user_query
+        query_rewrite_start_time = time.perf_counter()
 
-        messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.gpt4v_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(" ".join(user_query_request)),
-            few_shots=self.query_prompt_few_shots,
+        query_response_token_limit = 100
+        messages = self.query_prompt.build_messages(
+            history, user_query_request, max_tokens=self.chatgpt_token_limit - query_response_token_limit
         )
 
         chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
             model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.0,
-            max_tokens=100,
+            max_tokens=query_response_token_limit,
             n=1,
         )
 
         query_text = self.get_search_query(chat_completion, original_user_query)
+        trace.record(QUERY_REWRITE, time.perf_counter() - query_rewrite_start_time)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
@@ -123,29 +139,34 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         vectors = []
         if has_vector:
             for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(query_text)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(query_text, self.vision_endpoint, self.vision_key)
-                )
+                with trace.stage(EMBEDDING):
+                    vector = (
+                        await self.compute_text_embedding(query_text)
+                        if field == "embedding"
+                        else await self.compute_image_embedding(query_text, self.vision_endpoint, self.vision_key)
+                    )
                 vectors.append(vector)
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
+        with trace.stage(SEARCH):
+            results = await self.search(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_semantic_ranker,
+                use_semantic_captions,
+                select_vectors=self.get_select_vectors(overrides),
+            )
+        prompt_build_start_time = time.perf_counter()
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
         content = "\n".join(sources_content)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
-        # Allow client to replace the entire prompt, or to inject into the existing prompt using >>>
-        system_message = self.get_system_prompt(
-            overrides.get("prompt_template"),
-            self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
-        )
-
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
 
@@ -161,12 +182,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                     image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
 
-        messages = self.get_messages_from_history(
-            system_prompt=system_message,
-            model_id=self.gpt4v_model,
-            history=history,
-            user_content=user_content,
-            max_tokens=messages_token_limit,
+        messages = self.get_answer_prompt(overrides).build_messages(
+            history, user_content, max_tokens=messages_token_limit
         )
 
         data_points = {
@@ -190,6 +207,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                 ThoughtStep("Prompt", [str(message) for message in messages]),
             ],
         }
+        trace.record(PROMPT_BUILD, time.perf_counter() - prompt_build_start_time)
 
         chat_coroutine = self.openai_client.chat.completions.create(
             model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
@@ -0,0 +1,102 @@
+import re
+from typing import Any, Optional
+
+
+class KeywordQueryClassifier:
+    """
+    Recognizes first questions made only of course codes, course levels and majors, like "CSE 333" or "300 level
+    music classes", and builds the arguments of the filtered_search tool for them without asking the chat model.
+    Follow-up questions and questions with anything else in them, like a time or an instructor, are left to the model
+    """
+
+    # Words around the course codes, levels and majors of a question that don't change what it asks for
+    FILLER_WORDS = {
+        "a",
+        "about",
+        "all",
+        "an",
+        "and",
+        "any",
+        "are",
+        "available",
+        "can",
+        "class",
+        "classes",
+        "course",
+        "courses",
+        "find",
+        "i",
+        "in",
+        "is",
+        "level",
+        "list",
+        "me",
+        "of",
+        "offered",
+        "or",
+        "show",
+        "some",
+        "take",
+        "the",
+        "there",
+        "what",
+        "which",
+    }
+    # Longer questions are rarely just keywords, and are worth the model call
+    MAX_WORDS = 10
+
+    def __init__(self, major_abbreviations: dict[str, str]):
+        # Major names and abbreviations, in lower case, to the abbreviation the classes are indexed with
+        self.majors: dict[str, str] = {}
+        for name, abbreviation in major_abbreviations.items():
+            self.majors[name.strip().lower()] = abbreviation
+            self.majors[abbreviation.lower()] = abbreviation
+        abbreviations = {abbreviation.lower() for abbreviation in major_abbreviations.values()}
+        # Course codes are written with or without the spaces, like "B STR 301" or "cse333"
+        self.course_abbreviations = {abbreviation.replace(" ", ""): abbreviation for abbreviation in abbreviations}
+        self.course_pattern = re.compile(
+            r"(?<!\w)("
+            + "|".join(
+                r"\s?".join(map(re.escape, abbreviation.split()))
+                for abbreviation in sorted(abbreviations, key=len, reverse=True)
+            )
+            + r")\s?(\d{3})(?!\w)"
+        )
+        self.level_pattern = re.compile(r"(?<!\w)([1-9])00s?[\s-]*level(?!\w)")
+        # On their own, abbreviations like "I S" or "M E" are ordinary words, so only names and one word
+        # abbreviations are majors
+        names = [
+            name
+            for name in self.majors
+            if not (" " in name and name in abbreviations) and name not in self.FILLER_WORDS
+        ]
+        self.major_pattern = re.compile(
+            r"(?<!\w)(" + "|".join(map(re.escape, sorted(names, key=len, reverse=True))) + r")(?!\w)"
+        )
+
+    def classify(self, history: list[dict[str, str]]) -> Optional[dict[str, Any]]:
+        question = history[-1].get("content")
+        if len(history) != 1 or not isinstance(question, str) or len(question.split()) > self.MAX_WORDS:
+            return None
+        text = question.lower()
+        # Levels go first, so "show me 200 level" isn't read as the course M E 200
+        levels = self.level_pattern.findall(text)
+        text = self.level_pattern.sub(" ", text)
+        majors = [
+            self.majors[self.course_abbreviations[re.sub(r"\s", "", match.group(1))]]
+            for match in self.course_pattern.finditer(text)
+        ]
+        text = self.course_pattern.sub(" ", text)
+        majors += [self.majors[match.group(1)] for match in self.major_pattern.finditer(text)]
+        text = self.major_pattern.sub(" ", text)
+        if (
+            not majors
+            or len(set(levels)) > 1
+            or any(word not in self.FILLER_WORDS for word in re.findall(r"\w+", text))
+        ):
+            return None
+        return {
+            "search_query": question.strip(),
+            "major": list(dict.fromkeys(majors)),
+            "level": f"{levels[0]}00" if levels else None,
+        }
@@ -0,0 +1,367 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from azure.search.documents.models import VectorQuery
+
+from approaches.approach import Document, SearchBackend
+
+# A compiled filter, called with a search document and the values of the lambda variables in scope
+Predicate = Callable[[Dict[str, Any], Dict[str, Any]], bool]
+
+
+class ODataFilter:
+    """
+    Evaluates the subset of OData filters that the approaches build: comparisons, and/or/not, collection any()
+    lambdas, search.in and search.ismatch
+    See https://learn.microsoft.com/azure/search/search-query-odata-filter
+    """
+
+    token_pattern = re.compile(
+        r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<number>-?\d+(?:\.\d+)?)|(?P<name>[A-Za-z_][\w./]*)|(?P<symbol>[(),:]))"
+    )
+    comparisons: Dict[str, Callable[[Any, Any], bool]] = {
+        "eq": lambda left, right: left == right,
+        "ne": lambda left, right: left != right,
+        "gt": lambda left, right: left > right,
+        "ge": lambda left, right: left >= right,
+        "lt": lambda left, right: left < right,
+        "le": lambda left, right: left <= right,
+    }
+
+    def __init__(self, filter: str):
+        self.tokens = self.tokenize(filter)
+        self.position = 0
+        self.predicate = self.parse_or()
+        if self.position < len(self.tokens):
+            raise ValueError(f"Unexpected '{self.tokens[self.position][1]}' in filter: {filter}")
+
+    def __call__(self, document: Dict[str, Any]) -> bool:
+        return self.predicate(document, {})
+
+    @classmethod
+    def tokenize(cls, filter: str) -> List[Tuple[str, str]]:
+        tokens = []
+        position = 0
+        while position < len(filter.rstrip()):
+            match = cls.token_pattern.match(filter, position)
+            if not match or match.lastgroup is None:
+                raise ValueError(f"Can't parse filter at '{filter[position:]}'")
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        return tokens
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position][1] if self.position < len(self.tokens) else None
+
+    def take(self, expected: Optional[str] = None) -> Tuple[str, str]:
+        if self.position >= len(self.tokens):
+            raise ValueError("Filter ended unexpectedly")
+        token = self.tokens[self.position]
+        if expected is not None and token[1] != expected:
+            raise ValueError(f"Expected '{expected}' in filter but found '{token[1]}'")
+        self.position += 1
+        return token
+
+    def parse_or(self) -> Predicate:
+        operands = [self.parse_and()]
+        while self.peek() == "or":
+            self.take()
+            operands.append(self.parse_and())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda document, variables: any(operand(document, variables) for operand in operands)
+
+    def parse_and(self) -> Predicate:
+        operands = [self.parse_not()]
+        while self.peek() == "and":
+            self.take()
+            operands.append(self.parse_not())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda document, variables: all(operand(document, variables) for operand in operands)
+
+    def parse_not(self) -> Predicate:
+        if self.peek() == "not":
+            self.take()
+            operand = self.parse_not()
+            return lambda document, variables: not operand(document, variables)
+        return self.parse_primary()
+
+    def parse_primary(self) -> Predicate:
+        kind, value = self.take()
+        if value == "(":
+            predicate = self.parse_or()
+            self.take(")")
+            return predicate
+        if kind == "name" and value in ("true", "false"):
+            constant = value == "true"
+            return lambda document, variables: constant
+        if kind == "name" and value.lower() == "search.in":
+            return self.parse_search_in()
+        if kind == "name" and value.lower() == "search.ismatch":
+            return self.parse_search_ismatch()
+        if kind == "name" and value.endswith("/any"):
+            return self.parse_any(value[: -len("/any")])
+        left = self.operand(kind, value)
+        operator = self.take()[1]
+        if operator not in self.comparisons:
+            raise ValueError(f"Unsupported operator '{operator}' in filter")
+        right = self.operand(*self.take())
+        compare = self.comparisons[operator]
+
+        def comparison(document: Dict[str, Any], variables: Dict[str, Any]) -> bool:
+            left_value, right_value = left(document, variables), right(document, variables)
+            if left_value is None or right_value is None:
+                # Only equality is defined for null, like in Azure AI Search
+                return compare(left_value, right_value) if operator in ("eq", "ne") else False
+            return compare(left_value, right_value)
+
+        return comparison
+
+    def operand(self, kind: str, value: str) -> Callable[[Dict[str, Any], Dict[str, Any]], Any]:
+        if kind == "string":
+            text = value[1:-1].replace("''", "'")
+            return lambda document, variables: text
+        if kind == "number":
+            number = float(value) if "." in value else int(value)
+            return lambda document, variables: number
+        if kind == "name":
+            if value == "null":
+                return lambda document, variables: None
+            if value in ("true", "false"):
+                constant = value == "true"
+                return lambda document, variables: constant
+            return lambda document, variables: variables[value] if value in variables else document.get(value)
+        raise ValueError(f"Unexpected '{value}' in filter")
+
+    def parse_any(self, field: str) -> Predicate:
+        self.take("(")
+        if self.peek() == ")":
+            self.take()
+            return lambda document, variables: bool(document.get(field))
+        variable = self.take()[1]
+        self.take(":")
+        predicate = self.parse_or()
+        self.take(")")
+        return lambda document, variables: any(
+            predicate(document, {**variables, variable: item}) for item in document.get(field) or []
+        )
+
+    def parse_search_in(self) -> Predicate:
+        self.take("(")
+        value = self.operand(*self.take())
+        self.take(",")
+        values_token = self.take()
+        delimiters = " ,"
+        if self.peek() == ",":
+            self.take()
+            delimiters = self.string(self.take())
+        self.take(")")
+        values = {item for item in re.split(f"[{re.escape(delimiters)}]", self.string(values_token)) if item}
+        return lambda document, variables: value(document, variables) in values
+
+    def parse_search_ismatch(self) -> Predicate:
+        self.take("(")
+        arguments = [self.string(self.take())]
+        while self.peek() == ",":
+            self.take()
+            arguments.append(self.string(self.take()))
+        self.take(")")
+        words = set(BM25Index.tokenize(arguments[0]))
+        fields = [field.strip() for field in arguments[1].split(",")] if len(arguments) > 1 else ["content"]
+        match_all = len(arguments) > 3 and arguments[3] == "all"
+
+        def ismatch(document: Dict[str, Any], variables: Dict[str, Any]) -> bool:
+            field_words = set()
+            for field in fields:
+                value = document.get(field)
+                for text in value if isinstance(value, list) else [value]:
+                    if isinstance(text, str):
+                        field_words.update(BM25Index.tokenize(text))
+            return words <= field_words if match_all else bool(words & field_words)
+
+        return ismatch
+
+    @classmethod
+    def string(cls, token: Tuple[str, str]) -> str:
+        if token[0] != "string":
+            raise ValueError(f"Expected a string in filter but found '{token[1]}'")
+        return token[1][1:-1].replace("''", "'")
+
+
+class BM25Index:
+    """
+    Inverted index over the content of the documents, which ranks them by their Okapi BM25 score
+    """
+
+    word_pattern = re.compile(r"\w+")
+
+    def __init__(self, texts: List[str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.document_lengths = np.zeros(len(texts), dtype=np.float32)
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        for document_index, text in enumerate(texts):
+            words = self.tokenize(text)
+            self.document_lengths[document_index] = len(words)
+            for word, count in Counter(words).items():
+                document_indexes, counts = postings.setdefault(word, ([], []))
+                document_indexes.append(document_index)
+                counts.append(count)
+        # Each word points to the documents it's in and how often, as arrays so a query scores them all at once
+        self.postings = {
+            word: (np.array(document_indexes, dtype=np.int64), np.array(counts, dtype=np.float32))
+            for word, (document_indexes, counts) in postings.items()
+        }
+        self.average_length = float(self.document_lengths.mean()) if texts else 0.0
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls.word_pattern.findall(text.lower())
+
+    def scores(self, query_text: str, match_all: bool = False) -> np.ndarray:
+        """
+        Scores every document against the query, with NaN for the documents that don't match it
+        """
+        scores = np.zeros(len(self.document_lengths), dtype=np.float32)
+        matched_words = np.zeros(len(self.document_lengths), dtype=np.int32)
+        words = set(self.tokenize(query_text))
+        length_norms = self.k1 * (1 - self.b + self.b * self.document_lengths / max(self.average_length, 1e-6))
+        for word in words:
+            if word not in self.postings:
+                continue
+            document_indexes, counts = self.postings[word]
+            idf = math.log(1 + (len(scores) - len(document_indexes) + 0.5) / (len(document_indexes) + 0.5))
+            scores[document_indexes] += idf * counts * (self.k1 + 1) / (counts + length_norms[document_indexes])
+            matched_words[document_indexes] += 1
+        matches = matched_words == len(words) if match_all else matched_words > 0
+        return np.where(matches & (len(words) > 0), scores, np.nan)
+
+
+class LocalSearchBackend(SearchBackend):
+    """
+    Searches an index that prepdocs wrote to a folder with --localindex, in the app's own process
+    The embeddings are memory-mapped and searched exhaustively, the content is ranked with BM25, and hybrid queries
+    combine the rankings with Reciprocal Rank Fusion like Azure AI Search does
+    """
+
+    # Must match the files that prepdocslib.localindex.LocalIndex writes
+    DOCUMENTS_FILE = "documents.json"
+    VECTOR_FIELDS = {"embedding": "embedding.npy", "imageEmbedding": "imageEmbedding.npy"}
+    # Constant of Reciprocal Rank Fusion, see https://learn.microsoft.com/azure/search/hybrid-search-ranking
+    RRF_K = 60
+    # Matches of the keyword query that are fused with the vector matches, like the k of the vector queries
+    TEXT_K = 50
+    MAX_CACHED_FILTERS = 256
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, self.DOCUMENTS_FILE), encoding="utf-8") as documents_file:
+            self.documents: List[Dict[str, Any]] = json.load(documents_file)
+        self.vectors: Dict[str, np.ndarray] = {}
+        self.vector_norms: Dict[str, np.ndarray] = {}
+        for field, file_name in self.VECTOR_FIELDS.items():
+            vectors_path = os.path.join(path, file_name)
+            if not os.path.exists(vectors_path):
+                continue
+            vectors = np.load(vectors_path, mmap_mode="r")
+            if vectors.shape[0] != len(self.documents):
+                raise ValueError(f"{vectors_path} has {vectors.shape[0]} rows for {len(self.documents)} documents")
+            self.vectors[field] = vectors
+            # Rows of documents without a vector are all zeros, and are never matched
+            self.vector_norms[field] = np.linalg.norm(vectors, axis=1)
+        self.text_index = BM25Index([document.get("content") or "" for document in self.documents])
+        self.filter_masks: Dict[str, np.ndarray] = {}
+
+    async def search(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: List[VectorQuery],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        use_full_search_mode: bool,
+        select_vectors: List[str],
+    ) -> List[Document]:
+        # There's no semantic ranker or captions locally, so those queries are ranked like hybrid ones
+        mask = self.filter_mask(filter)
+        rankings = []
+        if query_text:
+            scores = self.text_index.scores(query_text, match_all=use_full_search_mode)
+            rankings.append(self.top_k(np.where(mask, scores, np.nan), self.TEXT_K))
+        for vector_query in vectors:
+            rankings.append(self.vector_ranking(vector_query, mask))
+
+        if not rankings:
+            indexes = list(np.flatnonzero(mask)[:top])
+        elif len(rankings) == 1:
+            indexes = list(rankings[0][:top])
+        else:
+            fused_scores: Dict[int, float] = {}
+            for ranking in rankings:
+                for rank, index in enumerate(ranking):
+                    fused_scores[index] = fused_scores.get(index, 0.0) + 1 / (self.RRF_K + rank + 1)
+            indexes = sorted(fused_scores, key=lambda index: fused_scores[index], reverse=True)[:top]
+        return [self.to_document(int(index), select_vectors) for index in indexes]
+
+    def filter_mask(self, filter: Optional[str]) -> np.ndarray:
+        if not filter:
+            return np.ones(len(self.documents), dtype=bool)
+        # The same filters come back on every question of a user, so they're only evaluated once
+        mask = self.filter_masks.get(filter)
+        if mask is None:
+            predicate = ODataFilter(filter)
+            mask = np.fromiter((predicate(document) for document in self.documents), dtype=bool)
+            if len(self.filter_masks) >= self.MAX_CACHED_FILTERS:
+                self.filter_masks.clear()
+            self.filter_masks[filter] = mask
+        return mask
+
+    def vector_ranking(self, vector_query: VectorQuery, mask: np.ndarray) -> np.ndarray:
+        field = vector_query.fields or "embedding"
+        if field not in self.vectors:
+            raise ValueError(f"The local index has no vectors for '{field}'")
+        query_vector = np.asarray(vector_query.vector, dtype=np.float32)  # type: ignore[attr-defined]
+        norms = self.vector_norms[field]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            similarities = (self.vectors[field] @ query_vector) / (norms * np.linalg.norm(query_vector))
+        return self.top_k(np.where(mask & (norms > 0), similarities, np.nan), vector_query.k or self.TEXT_K)
+
+    @classmethod
+    def top_k(cls, scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Indexes of the k highest scores, highest first, leaving out NaN scores
+        """
+        candidates = np.flatnonzero(~np.isnan(scores))
+        if k <= 0:
+            return candidates[:0]
+        if len(candidates) > k:
+            # Only the k best candidates are sorted
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def to_document(self, index: int, select_vectors: List[str]) -> Document:
+        document = self.documents[index]
+        # Like the Azure backend, only the selected vectors are copied out of the memory map
+        return Document(
+            id=document.get("id"),
+            content=document.get("content"),
+            embedding=self.vector(index, "embedding") if "embedding" in select_vectors else None,
+            image_embedding=self.vector(index, "imageEmbedding") if "imageEmbedding" in select_vectors else None,
+            category=document.get("category"),
+            sourcepage=document.get("sourcepage"),
+            sourcefile=document.get("sourcefile"),
+            oids=document.get("oids"),
+            groups=document.get("groups"),
+            captions=[],
+        )
+
+    def vector(self, index: int, field: str) -> Optional[List[float]]:
+        if field not in self.vectors or not self.vector_norms[field][index]:
+            return None
+        return self.vectors[field][index].tolist()
@@ -1,12 +1,21 @@
 import os
+import time
 from typing import Any, AsyncGenerator, Optional, Union
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
 from openai import AsyncOpenAI
 
-from approaches.approach import Approach, ThoughtStep
+from approaches.approach import Approach, SearchBackend, ThoughtStep
+from approaches.sourcereducer import SourceReducer
 from core.authentication import AuthenticationHelper
+from core.latency import (
+    COMPLETION,
+    EMBEDDING,
+    PROMPT_BUILD,
+    SEARCH,
+    LatencyTracer,
+)
 from core.messagebuilder import MessageBuilder
 
 # Replace these with your own values, either in environment variables or directly here
@@ -51,11 +60,14 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         chatgpt_model: str,
         chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         embedding_model: str,
+        embedding_dimensions: Optional[int] = None,  # Only for models that support shortened embeddings
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         sourcepage_field: str,
         content_field: str,
         query_language: str,
         query_speller: str,
+        search_backend: Optional[SearchBackend] = None,  # Searches the Azure AI Search index if not given
+        latency_tracer: Optional[LatencyTracer] = None,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -63,12 +75,16 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.auth_helper = auth_helper
         self.chatgpt_model = chatgpt_model
         self.embedding_model = embedding_model
+        self.embedding_dimensions = embedding_dimensions
         self.chatgpt_deployment = chatgpt_deployment
         self.embedding_deployment = embedding_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.search_backend = search_backend
+        self.latency_tracer = latency_tracer or LatencyTracer()
+        self.source_reducer = SourceReducer()
 
     async def run(
         self,
@@ -77,6 +93,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         session_state: Any = None,
         context: dict[str, Any] = {},
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
+        trace = self.latency_tracer.start(type(self).__name__)
         q = messages[-1]["content"]
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
@@ -90,12 +107,24 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
         if has_vector:
-            vectors.append(await self.compute_text_embedding(q))
+            with trace.stage(EMBEDDING):
+                vectors.append(await self.compute_text_embedding(q))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
+        with trace.stage(SEARCH):
+            results = await self.search(
+                self.source_reducer.candidates(top),
+                query_text,
+                filter,
+                vectors,
+                use_semantic_ranker,
+                use_semantic_captions,
+                select_vectors=self.get_select_vectors(overrides, self.source_reducer.VECTOR_FIELDS),
+            )
+            results = self.source_reducer.reduce(results, top)
+        prompt_build_start_time = time.perf_counter()
 
         user_content = [q]
 
@@ -113,6 +142,9 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         message_builder.insert_message("assistant", self.answer)
         message_builder.insert_message("user", self.question)
 
+        trace.record(PROMPT_BUILD, time.perf_counter() - prompt_build_start_time)
+
+        completion_start_time = time.perf_counter()
         chat_completion = (
             await self.openai_client.chat.completions.create(
                 # Azure Open AI takes the deployment name as the model name
@@ -123,9 +155,11 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
                 n=1,
             )
         ).model_dump()
+        trace.record(COMPLETION, time.perf_counter() - completion_start_time)
+        trace.finish()
 
         data_points = {"text": sources_content}
-        extra_info = {
+        extra_info: dict[str, Any] = {
             "data_points": data_points,
             "thoughts": [
                 ThoughtStep(
@@ -140,6 +174,8 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
             ],
         }
 
+        if overrides.get("include_latency"):
+            extra_info["thoughts"].append(self.latency_thought_step(trace))
         chat_completion["choices"][0]["context"] = extra_info
         chat_completion["choices"][0]["session_state"] = session_state
         return chat_completion
@@ -1,4 +1,5 @@
 import os
+import time
 from typing import Any, AsyncGenerator, Optional, Union
 
 from azure.search.documents.aio import SearchClient
@@ -9,9 +10,16 @@ from openai.types.chat import (
     ChatCompletionContentPartParam,
 )
 
-from approaches.approach import Approach, ThoughtStep
+from approaches.approach import Approach, SearchBackend, ThoughtStep
 from core.authentication import AuthenticationHelper
 from core.imageshelper import fetch_image
+from core.latency import (
+    COMPLETION,
+    EMBEDDING,
+    PROMPT_BUILD,
+    SEARCH,
+    LatencyTracer,
+)
 from core.messagebuilder import MessageBuilder
 
 # Replace these with your own values, either in environment variables or directly here
@@ -48,10 +56,13 @@ class RetrieveThenReadVisionApproach(Approach):
         gpt4v_model: str,
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
+        embedding_dimensions: Optional[int] = None,  # Only for models that support shortened embeddings
         sourcepage_field: str,
         content_field: str,
         query_language: str,
         query_speller: str,
+        search_backend: Optional[SearchBackend] = None,  # Searches the Azure AI Search index if not given
+        latency_tracer: Optional[LatencyTracer] = None,
         vision_endpoint: str,
         vision_key: str,
     ):
@@ -60,6 +71,7 @@ class RetrieveThenReadVisionApproach(Approach):
         self.openai_client = openai_client
         self.auth_helper = auth_helper
         self.embedding_model = embedding_model
+        self.embedding_dimensions = embedding_dimensions
         self.embedding_deployment = embedding_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
@@ -67,6 +79,8 @@ class RetrieveThenReadVisionApproach(Approach):
         self.gpt4v_model = gpt4v_model
         self.query_language = query_language
         self.query_speller = query_speller
+        self.search_backend = search_backend
+        self.latency_tracer = latency_tracer or LatencyTracer()
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
 
@@ -77,6 +91,7 @@ class RetrieveThenReadVisionApproach(Approach):
         session_state: Any = None,
         context: dict[str, Any] = {},
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
+        trace = self.latency_tracer.start(type(self).__name__)
         q = messages[-1]["content"]
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
@@ -97,17 +112,28 @@ class RetrieveThenReadVisionApproach(Approach):
         vectors = []
         if has_vector:
             for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(q)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(q, self.vision_endpoint, self.vision_key)
-                )
+                with trace.stage(EMBEDDING):
+                    vector = (
+                        await self.compute_text_embedding(q)
+                        if field == "embedding"
+                        else await self.compute_image_embedding(q, self.vision_endpoint, self.vision_key)
+                    )
                 vectors.append(vector)
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
+        with trace.stage(SEARCH):
+            results = await self.search(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_semantic_ranker,
+                use_semantic_captions,
+                select_vectors=self.get_select_vectors(overrides),
+            )
+        prompt_build_start_time = time.perf_counter()
 
         image_list: list[ChatCompletionContentPartImageParam] = []
         user_content: list[ChatCompletionContentPartParam] = [{"text": q, "type": "text"}]
@@ -133,6 +159,9 @@ class RetrieveThenReadVisionApproach(Approach):
         # Append user message
         message_builder.insert_message("user", user_content)
 
+        trace.record(PROMPT_BUILD, time.perf_counter() - prompt_build_start_time)
+
+        completion_start_time = time.perf_counter()
         chat_completion = (
             await self.openai_client.chat.completions.create(
                 model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
@@ -142,13 +171,15 @@ class RetrieveThenReadVisionApproach(Approach):
                 n=1,
             )
         ).model_dump()
+        trace.record(COMPLETION, time.perf_counter() - completion_start_time)
+        trace.finish()
 
         data_points = {
             "text": sources_content,
             "images": [d["image_url"] for d in image_list],
         }
 
-        extra_info = {
+        extra_info: dict[str, Any] = {
             "data_points": data_points,
             "thoughts": [
                 ThoughtStep(
@@ -160,6 +191,8 @@ class RetrieveThenReadVisionApproach(Approach):
                 ThoughtStep("Prompt", [str(message) for message in message_builder.messages]),
             ],
         }
+        if overrides.get("include_latency"):
+            extra_info["thoughts"].append(self.latency_thought_step(trace))
         chat_completion["choices"][0]["context"] = extra_info
         chat_completion["choices"][0]["session_state"] = session_state
         return chat_completion
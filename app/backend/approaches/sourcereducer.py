@@ -0,0 +1,73 @@
+from typing import List, Optional
+
+import numpy as np
+
+from approaches.approach import Document
+
+
+class SourceReducer:
+    """
+    Picks the results that go into the prompt from more candidates than are needed, so that sections saying nearly the
+    same thing, like overlapping chunks or the lab and quiz sections of one class, don't take up several of the slots.
+    A candidate whose embedding is nearly the same as that of a better ranked one is dropped, and the rest are picked
+    by maximal marginal relevance, trading the rank of each candidate against its similarity to the ones already picked.
+    Candidates without an embedding are never taken for duplicates
+    """
+
+    # Candidates searched for per result that goes into the prompt
+    CANDIDATES_PER_RESULT = 2
+    # Vector fields the candidates have to be searched with
+    VECTOR_FIELDS = ["embedding"]
+
+    def __init__(self, duplicate_similarity: float = 0.97, relevance_weight: float = 0.7):
+        self.duplicate_similarity = duplicate_similarity
+        self.relevance_weight = relevance_weight
+
+    def candidates(self, top: int) -> int:
+        return top * self.CANDIDATES_PER_RESULT
+
+    def reduce(self, results: List[Document], top: int) -> List[Document]:
+        if len(results) <= 1:
+            return results[:top]
+        similarities = self.cosine_similarities(results)
+        # The search rank already combines the text, vector and semantic ranking, so it's the relevance
+        relevances = 1 - np.arange(len(results)) / len(results)
+
+        kept: List[int] = []
+        for index in range(len(results)):
+            if not kept or similarities[index, np.array(kept)].max() < self.duplicate_similarity:
+                kept.append(index)
+
+        picked: List[int] = []
+        candidates = np.array(kept)
+        # Similarity of each candidate to the closest one already picked
+        closest_similarities = np.zeros(len(candidates))
+        while len(picked) < top and len(candidates):
+            scores = self.relevance_weight * relevances[candidates] - (1 - self.relevance_weight) * closest_similarities
+            best = int(np.argmax(scores))
+            picked.append(int(candidates[best]))
+            candidates = np.delete(candidates, best)
+            closest_similarities = np.maximum(
+                np.delete(closest_similarities, best), similarities[candidates, picked[-1]]
+            )
+        return [results[index] for index in picked]
+
+    @classmethod
+    def cosine_similarities(cls, results: List[Document]) -> np.ndarray:
+        # Results without a usable embedding are given a zero vector, so they aren't similar to anything
+        embeddings = [cls.embedding_array(result.embedding) for result in results]
+        dimensions = max((len(embedding) for embedding in embeddings if embedding is not None), default=0)
+        matrix = np.zeros((len(results), dimensions), dtype=np.float32)
+        for index, embedding in enumerate(embeddings):
+            if embedding is not None and len(embedding) == dimensions:
+                norm = np.linalg.norm(embedding)
+                if norm:
+                    matrix[index] = embedding / norm
+        return matrix @ matrix.T
+
+    @classmethod
+    def embedding_array(cls, embedding: Optional[List[float]]) -> Optional[np.ndarray]:
+        try:
+            return np.asarray(embedding, dtype=np.float32) if embedding else None
+        except (TypeError, ValueError):
+            return None
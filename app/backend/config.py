@@ -11,3 +11,5 @@ CONFIG_SEMANTIC_RANKER_DEPLOYED = "semantic_ranker_deployed"
 CONFIG_VECTOR_SEARCH_ENABLED = "vector_search_enabled"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+CONFIG_LATENCY_TRACER = "latency_tracer"
+CONFIG_REQUEST_COALESCER = "request_coalescer"
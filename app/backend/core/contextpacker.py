@@ -0,0 +1,61 @@
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+import tiktoken
+
+from .modelhelper import get_oai_chatmodel_tiktok
+
+
+@dataclass
+class PackedSources:
+    sources: list[str]  # The sources that fit, in the order of their rank, some of them cut short
+    truncated: list[str]  # Citations of the sources that were cut short
+    dropped: list[str]  # Citations of the sources that were left out
+    token_count: int
+
+
+class ContextPacker:
+    """
+    Fits the sources of an answer into a token budget, so the size of the prompt, and with it the time the model takes
+    to answer, doesn't grow with the number of results. Sources are taken whole in the order of their rank while they
+    fit, a source that doesn't is cut at the end of its last sentence that does, and sources left without enough room
+    to cut them are dropped
+    """
+
+    # Cutting a source shorter than this leaves too little of it to answer from
+    MIN_TRUNCATED_TOKENS = 64
+    sentence_end_pattern = re.compile(r"[.!?](?=\s|$)")
+
+    def __init__(self, model_id: str):
+        self.model_id = model_id
+
+    def pack(self, sources: list[str], max_tokens: int) -> PackedSources:
+        encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(self.model_id))
+        packed = PackedSources(sources=[], truncated=[], dropped=[], token_count=0)
+        for source, tokens in zip(sources, encoding.encode_batch(sources)):
+            # Sources are joined by newlines, which take a token each
+            remaining_tokens = max_tokens - packed.token_count - 1
+            citation = source.split(": ", 1)[0]
+            if len(tokens) <= remaining_tokens:
+                packed.sources.append(source)
+                packed.token_count += len(tokens) + 1
+                continue
+            truncated_source = (
+                self.truncate(encoding.decode(tokens[:remaining_tokens]))
+                if remaining_tokens >= self.MIN_TRUNCATED_TOKENS
+                else None
+            )
+            if truncated_source:
+                packed.sources.append(truncated_source)
+                packed.truncated.append(citation)
+                packed.token_count += len(encoding.encode(truncated_source)) + 1
+            else:
+                packed.dropped.append(citation)
+        return packed
+
+    def truncate(self, source: str) -> Optional[str]:
+        # Keeps the citation and at least one whole sentence of the content after it
+        content_start = source.find(": ") + 2
+        sentence_ends = [match.end() for match in self.sentence_end_pattern.finditer(source, content_start)]
+        return source[: sentence_ends[-1]] if content_start > 1 and sentence_ends else None
@@ -17,13 +17,15 @@ class ImageURL(TypedDict, total=False):
 
 
 async def download_blob_as_base64(blob_container_client: ContainerClient, file_path: str) -> Optional[str]:
-    base_name, _ = os.path.splitext(file_path)
-    blob = await blob_container_client.get_blob_client(base_name + ".png").download_blob()
+    base_name, ext = os.path.splitext(file_path)
+    # Page images are stored as PNG unless prepdocs was run with another --pageimageformat
+    image_format = ext[1:].lower() if ext.lower() in (".png", ".jpeg", ".webp") else "png"
+    blob = await blob_container_client.get_blob_client(f"{base_name}.{image_format}").download_blob()
 
     if not blob.properties:
         return None
     img = base64.b64encode(await blob.readall()).decode("utf-8")
-    return f"data:image/png;base64,{img}"
+    return f"data:image/{image_format};base64,{img}"
 
 
 async def fetch_image(blob_container_client: ContainerClient, result: Document) -> Optional[ImageURL]:
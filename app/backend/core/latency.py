@@ -0,0 +1,202 @@
+import bisect
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Stages of answering a question, in the order they happen
+QUERY_REWRITE = "query_rewrite"
+# Taken instead of QUERY_REWRITE when the search query is built by rules, without asking the chat model
+QUERY_RULES = "query_rules"
+EMBEDDING = "embedding"
+SEARCH = "search"
+PROMPT_BUILD = "prompt_build"
+TIME_TO_FIRST_TOKEN = "time_to_first_token"
+COMPLETION = "completion"
+TOTAL = "total"
+
+
+class LatencySink(ABC):
+    """
+    Destination of the stage timings of every answered question
+    """
+
+    @abstractmethod
+    def record(self, approach: str, timings: Dict[str, float]):
+        pass
+
+
+class ConsoleSink(LatencySink):
+    """
+    Logs the stage timings of each question on a single line
+    """
+
+    def __init__(self, logger: Optional[logging.Logger] = None):
+        self.logger = logger or logging.getLogger("latency")
+
+    def record(self, approach: str, timings: Dict[str, float]):
+        self.logger.info(
+            "%s latency: %s",
+            approach,
+            " ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in timings.items()),
+        )
+
+
+class Histogram:
+    """
+    Counts of observations at or below each bucket boundary, like a Prometheus histogram
+    """
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> List[int]:
+        counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class PrometheusSink(LatencySink):
+    """
+    Keeps a histogram of each stage in memory, rendered in the Prometheus text format for a scrape endpoint
+    """
+
+    METRIC = "approach_stage_duration_seconds"
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+    def __init__(self, buckets: Optional[List[float]] = None):
+        self.buckets = buckets or self.BUCKETS
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+
+    def record(self, approach: str, timings: Dict[str, float]):
+        for stage, seconds in timings.items():
+            histogram = self.histograms.get((approach, stage))
+            if histogram is None:
+                histogram = self.histograms[(approach, stage)] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.METRIC} Time spent in each stage of answering a question",
+            f"# TYPE {self.METRIC} histogram",
+        ]
+        for (approach, stage), histogram in sorted(self.histograms.items()):
+            labels = f'approach="{approach}",stage="{stage}"'
+            for boundary, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                lines.append(f'{self.METRIC}_bucket{{{labels},le="{boundary}"}} {count}')
+            lines.append(f'{self.METRIC}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"{self.METRIC}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{self.METRIC}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+class OpenTelemetrySink(LatencySink):
+    """
+    Records the stage timings on an OpenTelemetry histogram, exported by the meter provider of the app
+    That's Azure Monitor when APPLICATIONINSIGHTS_CONNECTION_STRING is set, or an OTLP collector (see use_otlp_exporter)
+    """
+
+    def __init__(self):
+        from opentelemetry import metrics
+
+        self.histogram = metrics.get_meter("approaches").create_histogram(
+            "approach.stage.duration", unit="s", description="Time spent in each stage of answering a question"
+        )
+
+    def record(self, approach: str, timings: Dict[str, float]):
+        for stage, seconds in timings.items():
+            self.histogram.record(seconds, {"approach": approach, "stage": stage})
+
+    @classmethod
+    def use_otlp_exporter(cls, endpoint: Optional[str] = None) -> bool:
+        # The exporter isn't a dependency of the app, so it's only imported when a collector is configured
+        try:
+            from opentelemetry import metrics
+            from opentelemetry.exporter.otlp.proto.http.metric_exporter import (
+                OTLPMetricExporter,
+            )
+            from opentelemetry.sdk.metrics import MeterProvider
+            from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        except ImportError as error:
+            raise ImportError(
+                "Exporting latencies to an OTLP collector requires opentelemetry-exporter-otlp-proto-http"
+            ) from error
+        # A provider can only be set once, and readers can't be added to it afterwards, so a provider that's already
+        # configured (like the Azure Monitor one) is kept and exports the histogram instead of the collector
+        if isinstance(metrics.get_meter_provider(), MeterProvider):
+            logging.warning("A meter provider is already configured, so latencies won't be sent to the OTLP collector")
+            return False
+        exporter = OTLPMetricExporter(endpoint=endpoint) if endpoint else OTLPMetricExporter()
+        metrics.set_meter_provider(MeterProvider(metric_readers=[PeriodicExportingMetricReader(exporter)]))
+        return True
+
+
+class RequestTrace:
+    """
+    Stage timings of answering one question. Stages that happen more than once, like searches, add up
+    """
+
+    def __init__(self, approach: str, sinks: List[LatencySink]):
+        self.approach = approach
+        self.sinks = sinks
+        self.start_time = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self.finished = False
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+    def record(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def since_start(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def finish(self):
+        # Called once the answer is complete, which for a streamed answer is after its last chunk
+        if self.finished:
+            return
+        self.finished = True
+        self.timings[TOTAL] = self.since_start()
+        for sink in self.sinks:
+            try:
+                sink.record(self.approach, self.timings)
+            except Exception:
+                logging.exception("Failed to record latencies in %s", type(sink).__name__)
+
+    def as_milliseconds(self) -> Dict[str, Any]:
+        return {stage: round(seconds * 1000, 1) for stage, seconds in self.timings.items()}
+
+
+class LatencyTracer:
+    """
+    Starts a trace for each question and hands the timings to the configured sinks
+    """
+
+    def __init__(self, sinks: Optional[List[LatencySink]] = None):
+        self.sinks = sinks or []
+
+    def start(self, approach: str) -> RequestTrace:
+        return RequestTrace(approach, self.sinks)
+
+    def get_sink(self, sink_type: type) -> Optional[LatencySink]:
+        return next((sink for sink in self.sinks if isinstance(sink, sink_type)), None)
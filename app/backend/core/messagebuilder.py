@@ -1,3 +1,4 @@
+import copy
 import unicodedata
 from typing import List, Union
 
@@ -22,6 +23,7 @@ class MessageBuilder:
     Methods:
         __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
         insert_message(self, role: str, content: str, index: int = 1): Inserts a new message to the conversation.
+        copy(self): Returns a builder with the same messages, to insert into without changing this one.
     """
 
     def __init__(self, system_content: str, chatgpt_model: str):
@@ -52,6 +54,14 @@ class MessageBuilder:
             raise ValueError(f"Invalid role: {role}")
         self.messages.insert(index, message)
 
+    def copy(self) -> "MessageBuilder":
+        """
+        Returns a builder with the same messages, which messages can be inserted into without changing this one.
+        """
+        message_builder = copy.copy(self)
+        message_builder.messages = list(self.messages)
+        return message_builder
+
     def count_tokens_for_message(self, message: dict[str, str]):
         return num_tokens_from_messages(message, self.model)
 
@@ -13,6 +13,16 @@ MODELS_2_TOKEN_LIMITS = {
 }
 
 
+# Native vector size of each embedding model, must match SUPPORTED_EMBEDDING_MODELS in scripts/prepdocslib/embeddings.py
+EMBEDDING_MODELS_2_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+# Vector size of models that aren't in EMBEDDING_MODELS_2_DIMENSIONS
+DEFAULT_EMBEDDING_DIMENSIONS = 1536
+
+
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k", "gpt-4v": "gpt-4-turbo-vision"}
 
 
@@ -22,6 +32,10 @@ def get_token_limit(model_id: str) -> int:
     return MODELS_2_TOKEN_LIMITS[model_id]
 
 
+def get_embedding_dimensions(model_id: str) -> int:
+    return EMBEDDING_MODELS_2_DIMENSIONS.get(model_id, DEFAULT_EMBEDDING_DIMENSIONS)
+
+
 def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
     """
     Calculate the number of tokens required to encode a message.
@@ -50,6 +64,14 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
     return num_tokens
 
 
+def num_tokens_from_text(text: str, model: str) -> int:
+    """
+    Calculate the number of tokens required to encode text outside of a message, such as the tools offered to the model.
+    """
+    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    return len(encoding.encode(text))
+
+
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
@@ -0,0 +1,77 @@
+import json
+import logging
+from functools import cached_property
+from typing import Optional, Union
+
+from openai.types.chat import (
+    ChatCompletionContentPartParam,
+    ChatCompletionMessageParam,
+    ChatCompletionToolParam,
+)
+
+from .messagebuilder import MessageBuilder
+from .modelhelper import num_tokens_from_text
+
+
+class PromptAssembler:
+    """
+    The part of a prompt that is the same for every request: the system prompt, the few-shot examples and the tools
+    offered to the model. It's built once, and each request only adds the conversation history and the new question.
+    Attributes:
+        tools (list): The tools to offer with the prompt, if any.
+        token_count (int): The tokens taken by the fixed part of the prompt, out of the token budget of each request.
+    Methods:
+        build_messages(self, history, user_content, max_tokens): Returns the messages of the prompt for a request.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        model_id: str,
+        few_shots: list[dict[str, str]] = [],
+        tools: Optional[list[ChatCompletionToolParam]] = None,
+    ):
+        self.message_builder = MessageBuilder(system_prompt, model_id)
+        # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
+        for shot in reversed(few_shots):
+            self.message_builder.insert_message(shot["role"], shot["content"])
+        self.model_id = model_id
+        self.tools = tools
+
+    @cached_property
+    def token_count(self) -> int:
+        # Counted on first use rather than when the app starts, as counting loads the tokenizer
+        token_count = sum(
+            self.message_builder.count_tokens_for_message(dict(message))  # type: ignore
+            for message in self.message_builder.messages
+        )
+        if self.tools:
+            # The model sees the tools in its own format, which the JSON of their schemas is close to in size
+            token_count += num_tokens_from_text(json.dumps(self.tools), self.model_id)
+        return token_count
+
+    def build_messages(
+        self,
+        history: list[dict[str, str]],
+        user_content: Union[str, list[ChatCompletionContentPartParam]],
+        max_tokens: int,
+    ) -> list[ChatCompletionMessageParam]:
+        """
+        Adds the new question, and as much of the conversation history before it as fits in max_tokens along with the
+        fixed part of the prompt, the most recent messages first.
+        """
+        message_builder = self.message_builder.copy()
+        append_index = len(message_builder.messages)
+        message_builder.insert_message("user", user_content, index=append_index)
+        total_token_count = self.token_count + message_builder.count_tokens_for_message(
+            dict(message_builder.messages[-1])  # type: ignore
+        )
+
+        for message in reversed(history[:-1]):
+            potential_message_count = message_builder.count_tokens_for_message(message)
+            if (total_token_count + potential_message_count) > max_tokens:
+                logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
+                break
+            message_builder.insert_message(message["role"], message["content"], index=append_index)
+            total_token_count += potential_message_count
+        return message_builder.messages
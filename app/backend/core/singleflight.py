@@ -0,0 +1,119 @@
+import asyncio
+import json
+import re
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Union
+
+from approaches.approach import Approach
+
+
+class SharedStream:
+    """
+    Events of one streamed answer, read by every request asking the same question
+    The answer is generated in its own task, so it isn't cut short when the request that started it goes away, and
+    requests that join late get the events that were already generated before the new ones
+    """
+
+    def __init__(self, upstream: Callable[[], Awaitable[AsyncGenerator[dict, None]]], on_finished: Callable[[], None]):
+        self.events: List[dict] = []
+        self.error: Optional[BaseException] = None
+        self.finished = False
+        self.updated = asyncio.Event()
+        self.on_finished = on_finished
+        self.task = asyncio.create_task(self.pump(upstream))
+
+    async def pump(self, upstream: Callable[[], Awaitable[AsyncGenerator[dict, None]]]):
+        try:
+            async for event in await upstream():
+                self.events.append(event)
+                self.notify()
+        except Exception as error:
+            self.error = error
+        finally:
+            self.finished = True
+            self.on_finished()
+            self.notify()
+
+    def notify(self):
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    async def subscribe(self) -> AsyncGenerator[dict, None]:
+        index = 0
+        while True:
+            if index < len(self.events):
+                yield self.events[index]
+                index += 1
+            elif self.finished:
+                if self.error:
+                    raise self.error
+                return
+            else:
+                await self.updated.wait()
+
+
+class RequestCoalescer:
+    """
+    Runs an approach once for identical questions asked at the same time, and gives each of them the same answer
+    Questions are identical when their messages (ignoring case and spacing), overrides and search filter, including
+    the access control filter of the user, are the same. Requests with a session state are always run on their own
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.results: Dict[str, asyncio.Task[Any]] = {}
+        self.streams: Dict[str, SharedStream] = {}
+
+    async def run(
+        self,
+        approach: Approach,
+        messages: list[dict],
+        stream: bool = False,
+        session_state: Any = None,
+        context: dict[str, Any] = {},
+    ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
+        key = self.get_key(approach, messages, stream, session_state, context)
+        if key is None:
+            return await approach.run(messages, stream=stream, session_state=session_state, context=context)
+
+        def upstream():
+            return approach.run(messages, stream=stream, session_state=session_state, context=context)
+
+        if stream:
+            shared_stream = self.streams.get(key)
+            if shared_stream is None:
+                shared_stream = self.streams[key] = SharedStream(upstream, lambda: self.forget(self.streams, key))
+            return shared_stream.subscribe()
+
+        task = self.results.get(key)
+        if task is None:
+            task = self.results[key] = asyncio.create_task(upstream())
+            task.add_done_callback(lambda _: self.forget(self.results, key))
+        # Shielded so a request that goes away doesn't cancel the answer for the others
+        return await asyncio.shield(task)
+
+    def forget(self, in_flight: Dict[str, Any], key: str):
+        in_flight.pop(key, None)
+
+    def get_key(
+        self, approach: Approach, messages: list[dict], stream: bool, session_state: Any, context: dict[str, Any]
+    ) -> Optional[str]:
+        if not self.enabled or session_state is not None:
+            return None
+        overrides = context.get("overrides", {})
+        return json.dumps(
+            [
+                id(approach),
+                stream,
+                [{**message, "content": self.normalize(message.get("content"))} for message in messages],
+                overrides,
+                approach.build_filter(overrides, context.get("auth_claims", {})),
+            ],
+            sort_keys=True,
+            default=str,
+        )
+
+    @staticmethod
+    def normalize(content: Any) -> Any:
+        if isinstance(content, str):
+            return re.sub(r"\s+", " ", content).strip().casefold()
+        return content
@@ -72,7 +72,7 @@ export const AnalysisPanel = ({ answer, activeTab, activeCitation, citationHeigh
                 headerText="Citation"
                 headerButtonProps={isDisabledCitationTab ? pivotItemDisabledStyle : undefined}
             >
-                {activeCitation?.endsWith(".png") ? (
+                {activeCitation && /\.(png|jpeg|webp)$/.test(activeCitation) ? (
                     <img src={citation} className={styles.citationImg} />
                 ) : (
                     <iframe title="Citation" src={citation} width="100%" height={citationHeight} />
@@ -1,63 +1,162 @@
+import json
 import random
 import time
 
 from locust import HttpUser, between, task
 
+OVERRIDES = {
+    "retrieval_mode": "hybrid",
+    "semantic_ranker": True,
+    "semantic_captions": False,
+    "top": 3,
+    "suggest_followup_questions": False,
+}
 
-class ChatUser(HttpUser):
+# Questions that the query rewrite turns into level and department filters
+FILTER_QUESTIONS = [
+    "What 300 level CSE classes are offered?",
+    "Show me 200 level MATH classes",
+    "Are there any 400 level INFO classes?",
+    "What 100 level CHEM classes can I take?",
+    "Plan me a schedule with 1 communications class and 1 anthropology class",
+    "Which BIOL classes have a lab section?",
+    "What 5 credit PHYS classes meet on Mondays and Wednesdays?",
+    "I don't want class on Friday, what STAT classes are there?",
+]
+
+INSTRUCTOR_QUESTIONS = [
+    "Which classes does Matt Wang teach?",
+    "What is Brett Wortzman teaching this quarter?",
+    "Who teaches CSE 332?",
+    "When does Hunter Schafer's class meet?",
+]
+
+# Conversations where the later questions only make sense with the earlier ones
+CONVERSATIONS = [
+    ["What should I take after CSE 143?", "Which of those meet in the morning?", "Do any of them have a quiz section?"],
+    ["Show me 300 level ECON classes", "Which ones are 5 credits?", "Who teaches them?"],
+    ["I like data structures, what CSE classes should I take?", "What are the prerequisites for the first one?"],
+    ["Are there any music theory classes for non majors?", "Do any of them end before noon?"],
+]
+
+
+def chat_request(messages, stream=False):
+    return {"messages": messages, "context": {"overrides": OVERRIDES}, "stream": stream}
+
+
+class AskUser(HttpUser):
+    """
+    Asks single questions on the Ask tab
+    """
+
+    weight = 1
     wait_time = between(5, 20)
 
     @task
     def ask_question(self):
-        self.client.get("/")
-        time.sleep(5)
-        self.client.post(
-            "/chat",
-            json={
-                "messages": [
-                    {
-                        "content": random.choice(
-                            [
-                                "What is included in my Northwind Health Plus plan that is not in standard?",
-                                "What does a Product Manager do?",
-                                "What happens in a performance review?",
-                                "Whats your whistleblower policy?",
-                            ]
-                        ),
-                        "role": "user",
-                    },
-                ],
-                "context": {
-                    "overrides": {
-                        "retrieval_mode": "hybrid",
-                        "semantic_ranker": True,
-                        "semantic_captions": False,
-                        "top": 3,
-                        "suggest_followup_questions": False,
-                    },
-                },
-            },
-        )
-        time.sleep(5)
-        self.client.post(
-            "/chat",
-            json={
-                "messages": [
-                    {"content": "What happens in a performance review?", "role": "user"},
-                    {
-                        "content": "During a performance review, employees will receive feedback on their performance over the past year, including both successes and areas for improvement. The feedback will be provided by the employee's supervisor and is intended to help the employee develop and grow in their role [employee_handbook-3.pdf]. The review is a two-way dialogue between the employee and their manager, so employees are encouraged to be honest and open during the process [employee_handbook-3.pdf]. The employee will also have the opportunity to discuss their goals and objectives for the upcoming year [employee_handbook-3.pdf]. A written summary of the performance review will be provided to the employee, which will include a rating of their performance, feedback, and goals and objectives for the upcoming year [employee_handbook-3.pdf].",
-                        "role": "assistant",
-                    },
-                    {"content": "Does my plan cover eye exams?", "role": "user"},
-                ],
-                "context": {
-                    "overrides": {
-                        "retrieval_mode": "hybrid",
-                        "semantic_ranker": True,
-                        "semantic_captions": False,
-                        "top": 3,
-                        "suggest_followup_questions": False,
-                    },
-                },
-            },
+        question = random.choice(FILTER_QUESTIONS + INSTRUCTOR_QUESTIONS)
+        self.client.post("/ask", json=chat_request([{"content": question, "role": "user"}]))
+
+
+class ChatUser(HttpUser):
+    """
+    Asks about classes on the Chat tab, following up on its answers, with the answers returned all at once
+    """
+
+    weight = 2
+    wait_time = between(5, 20)
+
+    @task(3)
+    def filter_question(self):
+        self.client.post("/chat", json=chat_request([{"content": random.choice(FILTER_QUESTIONS), "role": "user"}]))
+
+    @task(1)
+    def instructor_question(self):
+        self.client.post("/chat", json=chat_request([{"content": random.choice(INSTRUCTOR_QUESTIONS), "role": "user"}]))
+
+    @task(2)
+    def conversation(self):
+        messages = []
+        for turn, question in enumerate(random.choice(CONVERSATIONS)):
+            messages.append({"content": question, "role": "user"})
+            with self.client.post(
+                "/chat", json=chat_request(messages), name=f"/chat turn {turn + 1}", catch_response=True
+            ) as response:
+                if response.status_code != 200:
+                    response.failure(f"Status {response.status_code}")
+                    return
+                messages.append({"content": response.json()["choices"][0]["message"]["content"], "role": "assistant"})
+            # Users read the answer before asking the next question, which gevent can switch away from
+            self.wait()
+
+
+class StreamingChatUser(HttpUser):
+    """
+    Asks on the Chat tab with streamed answers, like the web app does by default
+    Besides the time until the response starts, it records the time to the first chunk of the answer, the time to
+    the end of the answer and the chunks (roughly tokens) per second as separate entries of the statistics
+    """
+
+    weight = 3
+    wait_time = between(5, 20)
+
+    @task(3)
+    def filter_question(self):
+        self.stream_chat([{"content": random.choice(FILTER_QUESTIONS), "role": "user"}])
+
+    @task(1)
+    def instructor_question(self):
+        self.stream_chat([{"content": random.choice(INSTRUCTOR_QUESTIONS), "role": "user"}])
+
+    @task(2)
+    def conversation(self):
+        messages = []
+        for question in random.choice(CONVERSATIONS):
+            messages.append({"content": question, "role": "user"})
+            answer = self.stream_chat(messages)
+            if answer is None:
+                return
+            messages.append({"content": answer, "role": "assistant"})
+            self.wait()
+
+    def stream_chat(self, messages):
+        start_time = time.perf_counter()
+        first_chunk_time = None
+        chunks = []
+        with self.client.post(
+            "/chat", json=chat_request(messages, stream=True), name="/chat stream", stream=True, catch_response=True
+        ) as response:
+            if response.status_code != 200:
+                response.failure(f"Status {response.status_code}")
+                return None
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                # Errors while streaming come after the response has started with a 200
+                if "error" in event:
+                    response.failure(event["error"])
+                    return None
+                content = (event.get("choices") or [{}])[0].get("delta", {}).get("content")
+                if content:
+                    if first_chunk_time is None:
+                        first_chunk_time = time.perf_counter()
+                    chunks.append(content)
+        end_time = time.perf_counter()
+        if first_chunk_time is not None:
+            self.record("STREAM", "time to first chunk", (first_chunk_time - start_time) * 1000)
+            self.record("STREAM", "time to last chunk", (end_time - start_time) * 1000)
+            if end_time > first_chunk_time:
+                # Reported in the response time columns, but in chunks per second rather than milliseconds
+                self.record("RATE", "chunks per second", len(chunks) / (end_time - first_chunk_time))
+        return "".join(chunks)
+
+    def record(self, request_type, name, value):
+        self.environment.events.request.fire(
+            request_type=request_type,
+            name=name,
+            response_time=value,
+            response_length=0,
+            exception=None,
+            context={},
         )
@@ -0,0 +1,448 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import sys
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+
+# Questions like the ones students ask about the time schedule
+QUESTIONS = [
+    "What 300 level CSE classes are offered?",
+    "Which classes does Matt Wang teach?",
+    "Show me MATH classes that meet on Tuesdays and Thursdays",
+    "Are there any INFO classes with a lab?",
+    "I don't want class on Friday, what CHEM classes can I take?",
+    "What 5 credit PHYS classes start after 1pm?",
+    "What should I take after CSE 143 if I like data structures?",
+    "Are there STAT classes that end before noon?",
+    "Which BIOL classes have a quiz section?",
+    "What are the prerequisites for CSE 332?",
+    "Plan me a schedule with 1 communications class and 1 anthropology class",
+    "What 200 level ECON classes are taught on Mondays?",
+]
+
+SCENARIOS = ["ask", "chat", "chat-stream"]
+STUB_OPENAI_URL = "http://openai.stub/v1"
+EMBEDDING_DIMENSIONS = 1536
+
+
+class Latency:
+    """
+    Distribution of the delay of a stand-in, given as fixed:MS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA in ms
+    """
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, *values = spec.split(":")
+        if kind not in ("fixed", "uniform", "lognormal") or len(values) != {"fixed": 1}.get(kind, 2):
+            raise ValueError(f"Invalid latency '{spec}', expected fixed:MS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+        self.kind = kind
+        self.values = [float(value) for value in values]
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            milliseconds = self.values[0]
+        elif self.kind == "uniform":
+            milliseconds = rng.uniform(self.values[0], self.values[1])
+        else:
+            milliseconds = rng.lognormvariate(0, self.values[1]) * self.values[0]
+        return milliseconds / 1000
+
+
+class TokenStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: List[bytes], first_token_delay: float, token_delay: float):
+        self.chunks = chunks
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        await asyncio.sleep(self.first_token_delay)
+        for chunk in self.chunks:
+            yield chunk
+            await asyncio.sleep(self.token_delay)
+        yield b"data: [DONE]\n\n"
+
+
+class StubOpenAITransport(httpx.AsyncBaseTransport):
+    """
+    Answers chat completions and embeddings after a delay, streaming answers at a fixed number of tokens per second
+    """
+
+    ANSWER = (
+        "CSE 332 Data Structures and Parallelism [cse.html] meets MWF 10:30-11:20 with a quiz section on Thursdays. "
+    )
+
+    def __init__(self, args, rng: random.Random):
+        self.completion_latency = Latency(args.completion_latency)
+        self.embedding_latency = Latency(args.embedding_latency)
+        self.token_delay = 1 / args.tokens_per_second
+        self.rng = rng
+        words = re.findall(r"\S+\s*", self.ANSWER)
+        self.answer_tokens = [words[index % len(words)] for index in range(args.answer_tokens)]
+        embedding = [round(rng.uniform(-0.05, 0.05), 6) for _ in range(EMBEDDING_DIMENSIONS)]
+        self.embedding_response = json.dumps(
+            {
+                "object": "list",
+                "data": [{"object": "embedding", "index": 0, "embedding": embedding}],
+                "model": "text-embedding-ada-002",
+                "usage": {"prompt_tokens": 8, "total_tokens": 8},
+            }
+        ).encode("utf-8")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        body = json.loads(request.content)
+        if request.url.path.endswith("/embeddings"):
+            await asyncio.sleep(self.embedding_latency.sample(self.rng))
+            return httpx.Response(200, headers={"content-type": "application/json"}, content=self.embedding_response)
+        if body.get("stream"):
+            chunks = [
+                self.chunk({"role": "assistant", "content": token if index else ""})
+                for index, token in enumerate([""] + self.answer_tokens)
+            ]
+            stream = TokenStream(chunks, self.completion_latency.sample(self.rng), self.token_delay)
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=stream)
+        await asyncio.sleep(self.completion_latency.sample(self.rng))
+        if body.get("tools"):
+            message = {"role": "assistant", "content": None, "tool_calls": [self.search_tool_call(body["messages"])]}
+        else:
+            # Answers aren't streamed, but they take as long to generate
+            await asyncio.sleep(self.token_delay * len(self.answer_tokens))
+            message = {"role": "assistant", "content": "".join(self.answer_tokens)}
+        completion = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1000, "completion_tokens": len(self.answer_tokens), "total_tokens": 1000},
+        }
+        return httpx.Response(200, headers={"content-type": "application/json"}, json=completion)
+
+    def chunk(self, delta: Dict[str, Any]) -> bytes:
+        chunk = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "gpt-35-turbo",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        }
+        return f"data: {json.dumps(chunk)}\n\n".encode()
+
+    def search_tool_call(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        # Fills in the filtered_search arguments the way the model does for simple questions
+        question = messages[-1]["content"]
+        major = re.search(r"\b[A-Z]{2,}\b", question)
+        level = re.search(r"\b(\d)00 level\b", question)
+        arguments = {
+            "search_query": question,
+            "major": major.group() if major else "",
+            "level": f"{level.group(1)}00" if level else "",
+            "instructor": "",
+        }
+        return {
+            "id": "call_stub",
+            "type": "function",
+            "function": {"name": "filtered_search", "arguments": json.dumps(arguments)},
+        }
+
+
+class StubSearchResults:
+    def __init__(self, documents: List[Dict[str, Any]]):
+        self.documents = documents
+
+    def by_page(self):
+        return self.pages()
+
+    async def pages(self):
+        yield self.page()
+
+    async def page(self):
+        for document in self.documents:
+            yield document
+
+
+def stub_search(args, rng: random.Random):
+    search_latency = Latency(args.search_latency)
+    documents = [
+        {
+            "id": f"file-cse_html-page-{index}",
+            "content": f"Class: CSE {300 + index} Data structures and parallelism 4 credits MWF 1030-1120 lecture "
+            f"quiz Wang,Matt {'x' * 800}",
+            "sourcepage": "cse.html",
+            "sourcefile": "cse.html",
+            "@search.score": 1.0 / (index + 1),
+        }
+        for index in range(50)
+    ]
+
+    async def search(self, *args, top: Optional[int] = None, **kwargs):
+        await asyncio.sleep(search_latency.sample(rng))
+        return StubSearchResults(documents[: top or 50])
+
+    return search
+
+
+def request_body(scenario: str, question: str, args) -> Dict[str, Any]:
+    return {
+        "messages": [{"content": question, "role": "user"}],
+        "context": {
+            "overrides": {
+                "retrieval_mode": args.retrieval_mode,
+                "semantic_ranker": True,
+                "semantic_captions": False,
+                "top": args.top,
+                "suggest_followup_questions": False,
+            }
+        },
+        "stream": scenario == "chat-stream",
+    }
+
+
+async def call_app(quart_app, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    # Drives the app the way an ASGI server does, so the time of the first streamed line can be measured
+    payload = json.dumps(body).encode("utf-8")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode("ascii"),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 50505),
+        "extensions": {},
+    }
+    start_time = time.perf_counter()
+    result: Dict[str, Any] = {"status": 0, "ttft": None}
+    received = False
+    finished = asyncio.Event()
+    buffer = b""
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal buffer
+        if message["type"] == "http.response.start":
+            result["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            buffer += message.get("body", b"")
+            if body["stream"]:
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    event = json.loads(line)
+                    choices = event.get("choices") or [{}]
+                    if result["ttft"] is None and choices[0].get("delta", {}).get("content"):
+                        result["ttft"] = time.perf_counter() - start_time
+                    if "error" in event:
+                        # Errors while streaming come after the response has started with a 200
+                        result["status"] = 500
+            if not message.get("more_body", False):
+                finished.set()
+
+    await quart_app(scope, receive, send)
+    if body["stream"] and buffer.strip() and "error" in json.loads(buffer):
+        result["status"] = 500
+    result["latency"] = time.perf_counter() - start_time
+    return result
+
+
+async def run_worker(args, worker: int, barrier, results) -> None:
+    rng = random.Random(args.seed + worker)
+    # The app is imported from app/backend, which is only on the path when this script runs
+    from azure.search.documents.aio import SearchClient
+
+    import app  # type: ignore[import-not-found]
+
+    openai_transport = StubOpenAITransport(args, rng)
+    async_openai = app.AsyncOpenAI
+    app.AsyncOpenAI = lambda **kwargs: async_openai(http_client=httpx.AsyncClient(transport=openai_transport), **kwargs)
+    SearchClient.search = stub_search(args, rng)  # type: ignore[method-assign]
+
+    quart_app = app.create_app()
+    samples = []
+    async with quart_app.test_app():
+        jobs = []
+        for index in range(args.warmup + args.requests):
+            scenario = args.scenarios[index % len(args.scenarios)]
+            jobs.append((index >= args.warmup, scenario, rng.choice(args.questions)))
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def run_jobs():
+            while not queue.empty():
+                measured, scenario, question = queue.get_nowait()
+                path = "/ask" if scenario == "ask" else "/chat"
+                sample = await call_app(quart_app, path, request_body(scenario, question, args))
+                if measured:
+                    samples.append({"scenario": scenario, **sample})
+
+        for job in jobs[: args.warmup]:
+            queue.put_nowait(job)
+        await asyncio.gather(*(run_jobs() for _ in range(args.concurrency)))
+
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+        for job in jobs[args.warmup :]:
+            queue.put_nowait(job)
+        start_time = time.time()
+        start_cpu = time.process_time()
+        await asyncio.gather(*(run_jobs() for _ in range(args.concurrency)))
+        cpu = time.process_time() - start_cpu
+        end_time = time.time()
+    results.put({"worker": worker, "start": start_time, "end": end_time, "cpu": cpu, "samples": samples})
+
+
+def worker_main(args, worker: int, barrier, results):
+    os.environ.update(
+        {
+            "AZURE_STORAGE_ACCOUNT": "benchmark",
+            "AZURE_STORAGE_CONTAINER": "content",
+            "AZURE_SEARCH_SERVICE": "benchmark",
+            "AZURE_SEARCH_INDEX": "gptkbindex",
+            "AZURE_OPENAI_CHATGPT_MODEL": "gpt-35-turbo",
+            "OPENAI_HOST": "local",
+            "OPENAI_BASE_URL": STUB_OPENAI_URL,
+            "APP_LOG_LEVEL": "WARNING",
+        }
+    )
+    os.environ.pop("LOCAL_SEARCH_INDEX_PATH", None)
+    asyncio.run(run_worker(args, worker, barrier, results))
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(worker_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    wall = max(result["end"] for result in worker_results) - min(result["start"] for result in worker_results)
+    samples = [sample for result in worker_results for sample in result["samples"]]
+    scenarios = {}
+    for scenario in SCENARIOS:
+        scenario_samples = [sample for sample in samples if sample["scenario"] == scenario]
+        if not scenario_samples:
+            continue
+        succeeded = [sample for sample in scenario_samples if sample["status"] == 200]
+        latencies = [sample["latency"] for sample in succeeded] or [float("nan")]
+        ttfts = [sample["ttft"] for sample in succeeded if sample["ttft"] is not None]
+        scenarios[scenario] = {
+            "requests": len(scenario_samples),
+            "errors": len(scenario_samples) - len(succeeded),
+            "throughput": len(succeeded) / wall,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "ttft_p50": percentile(ttfts, 0.5) if ttfts else None,
+            "ttft_p95": percentile(ttfts, 0.95) if ttfts else None,
+        }
+    workers = [
+        {
+            "worker": result["worker"],
+            "requests": len(result["samples"]),
+            "cpu": result["cpu"],
+            "utilization": result["cpu"] / (result["end"] - result["start"]),
+            "cpu_per_request": result["cpu"] / max(1, len(result["samples"])),
+        }
+        for result in sorted(worker_results, key=lambda result: result["worker"])
+    ]
+    return {"wall": wall, "throughput": len(samples) / wall, "scenarios": scenarios, "workers": workers}
+
+
+def print_summary(summary: Dict[str, Any]):
+    def ms(seconds: Optional[float]) -> str:
+        return "-" if seconds is None else f"{seconds * 1000:.0f}"
+
+    print(f"{summary['throughput']:.1f} requests/s over {summary['wall']:.1f}s")
+    print(
+        f"{'scenario':<12} {'requests':>8} {'errors':>6} {'req/s':>7} {'p50':>6} {'p95':>6} {'p99':>6} {'ttft50':>6} {'ttft95':>6}"
+    )
+    for scenario, stats in summary["scenarios"].items():
+        print(
+            f"{scenario:<12} {stats['requests']:>8} {stats['errors']:>6} {stats['throughput']:>7.1f} "
+            f"{ms(stats['p50']):>6} {ms(stats['p95']):>6} {ms(stats['p99']):>6} "
+            f"{ms(stats['ttft_p50']):>6} {ms(stats['ttft_p95']):>6}"
+        )
+    print(f"{'worker':<12} {'requests':>8} {'cpu s':>7} {'cpu %':>6} {'cpu ms/request':>15}")
+    for worker in summary["workers"]:
+        print(
+            f"{worker['worker']:<12} {worker['requests']:>8} {worker['cpu']:>7.2f} {worker['utilization'] * 100:>6.1f} "
+            f"{worker['cpu_per_request'] * 1000:>15.2f}"
+        )
+
+
+def main(args):
+    args.scenarios = [scenario.strip() for scenario in args.scenarios.split(",")]
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            raise ValueError(f"Unknown scenario '{scenario}', expected one of {', '.join(SCENARIOS)}")
+    for spec in (args.completion_latency, args.embedding_latency, args.search_latency):
+        Latency(spec)
+    if args.questions:
+        with open(args.questions, encoding="utf-8") as questions_file:
+            args.questions = [line.strip() for line in questions_file if line.strip()]
+    else:
+        args.questions = QUESTIONS
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.workers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker_main, args=(args, worker, barrier, results)) for worker in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    worker_results = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    summary = summarize(worker_results)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump({"arguments": {k: v for k, v in vars(args).items() if k != "questions"}, **summary}, output_file)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(
+        description="Benchmark the app's /ask and /chat requests against local stand-ins for OpenAI and AI Search",
+        epilog="Example: benchmark_app.py --workers 2 --concurrency 20 --requests 300 --completion-latency lognormal:400:0.5",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Number of app processes, each with its own event loop")
+    parser.add_argument("--concurrency", type=int, default=10, help="Requests in flight at once in each worker")
+    parser.add_argument("--requests", type=int, default=200, help="Number of measured requests sent to each worker")
+    parser.add_argument(
+        "--warmup", type=int, default=10, help="Number of requests sent to each worker before measuring"
+    )
+    parser.add_argument("--scenarios", default="ask,chat,chat-stream", help="Comma-separated requests to send in turn")
+    parser.add_argument("--questions", help="File with one question per line, instead of the built-in questions")
+    parser.add_argument("--retrieval-mode", default="hybrid", choices=["text", "vectors", "hybrid"])
+    parser.add_argument("--top", type=int, default=3, help="Number of sources retrieved for each question")
+    parser.add_argument(
+        "--completion-latency", default="lognormal:300:0.4", help="Delay before a completion starts, in ms"
+    )
+    parser.add_argument("--embedding-latency", default="lognormal:40:0.3", help="Delay of an embedding, in ms")
+    parser.add_argument("--search-latency", default="lognormal:80:0.4", help="Delay of a search, in ms")
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="Rate the answers are generated at")
+    parser.add_argument("--answer-tokens", type=int, default=100, help="Length of each answer in tokens")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random delays and questions")
+    parser.add_argument("--output", help="JSON file to write the results to, to compare against a later run")
+    main(parser.parse_args())
@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+from typing import Any, Dict, List, Optional
+
+import httpx
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from openai import AsyncOpenAI
+
+from benchmark_app import Latency
+from prepdocslib.blobmanager import BlobManager
+from prepdocslib.embeddings import OpenAIEmbeddingService
+from prepdocslib.fileprocessor import FileProcessor
+from prepdocslib.filestrategy import FileStrategy
+from prepdocslib.ingestionprofile import IngestionProfile, profile_calls
+from prepdocslib.jsonparser import JsonParser
+from prepdocslib.listfilestrategy import File, LocalListFileStrategy
+from prepdocslib.pdfparser import LocalPdfParser
+from prepdocslib.schedhtmlparser import LocalHtmlParser
+from prepdocslib.strategy import SearchInfo
+from prepdocslib.textsplitter import (
+    ScheduleTextSplitter,
+    SentenceTextSplitter,
+    SimpleTextSplitter,
+)
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+class StubBlobManager(BlobManager):
+    """
+    Hashes each file like an upload does to check whether the blob changed, then waits instead of uploading it
+    """
+
+    def __init__(self, latency: Latency, rng: random.Random):
+        super().__init__(endpoint="https://benchmark.blob.core.windows.net", container="content", credential="stub")
+        self.latency = latency
+        self.rng = rng
+
+    async def upload_blob(self, file: File) -> Optional[List[str]]:
+        BlobManager.content_md5(file.content)
+        await asyncio.sleep(self.latency.sample(self.rng))
+        return None
+
+    async def close(self):
+        pass
+
+
+class UnchangedFilesListStrategy(LocalListFileStrategy):
+    """
+    Lists every file, even ones that prepdocs would skip because their .md5 file shows they haven't changed
+    """
+
+    def check_md5(self, path: str) -> bool:
+        return path.endswith(".md5")
+
+
+class StubEmbeddingsTransport(httpx.AsyncBaseTransport):
+    def __init__(self, latency: Latency, rng: random.Random):
+        self.latency = latency
+        self.rng = rng
+        self.embedding = json.dumps([round(rng.uniform(-0.05, 0.05), 6) for _ in range(EMBEDDING_DIMENSIONS)])
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        inputs = json.loads(request.content)["input"]
+        await asyncio.sleep(self.latency.sample(self.rng))
+        data = ",".join(
+            f'{{"object": "embedding", "index": {index}, "embedding": {self.embedding}}}'
+            for index in range(len(inputs))
+        )
+        content = (
+            f'{{"object": "list", "data": [{data}], "model": "text-embedding-ada-002", '
+            f'"usage": {{"prompt_tokens": 0, "total_tokens": 0}}}}'
+        )
+        return httpx.Response(200, headers={"content-type": "application/json"}, content=content.encode("utf-8"))
+
+
+class StubEmbeddingService(OpenAIEmbeddingService):
+    def __init__(self, latency: Latency, rng: random.Random, max_concurrency: int):
+        super().__init__(
+            open_ai_model_name="text-embedding-ada-002", credential="stub", max_concurrency=max_concurrency
+        )
+        self.transport = StubEmbeddingsTransport(latency, rng)
+
+    async def create_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(
+            api_key="stub", base_url="http://openai.stub/v1", http_client=httpx.AsyncClient(transport=self.transport)
+        )
+
+
+class IndexingResult:
+    def __init__(self, key: str):
+        self.key = key
+        self.succeeded = True
+        self.status_code = 201
+        self.error_message = None
+
+
+def stub_upload_documents(latency: Latency, rng: random.Random):
+    async def upload_documents(self, documents: List[Dict[str, Any]], **kwargs):
+        # The client serializes each batch before sending it, which is part of the cost of indexing
+        json.dumps(documents)
+        await asyncio.sleep(latency.sample(rng))
+        return [IndexingResult(document["id"]) for document in documents]
+
+    return upload_documents
+
+
+def check_thresholds(metrics: Dict[str, float], thresholds: Dict[str, Dict[str, float]]) -> List[str]:
+    failures = []
+    for metric, limits in thresholds.items():
+        value = metrics.get(metric)
+        if value is None:
+            failures.append(f"{metric} wasn't measured")
+            continue
+        if "min" in limits and value < limits["min"]:
+            failures.append(f"{metric} is {value:.3f}, below the minimum of {limits['min']:.3f}")
+        if "max" in limits and value > limits["max"]:
+            failures.append(f"{metric} is {value:.3f}, above the maximum of {limits['max']:.3f}")
+    return failures
+
+
+def thresholds_from(metrics: Dict[str, float], margin: float) -> Dict[str, Dict[str, float]]:
+    # Rates can't fall and times can't grow by more than the margin, and stages that took no time aren't checked
+    return {
+        metric: (
+            {"min": round(value * (1 - margin / 100), 3)}
+            if metric.endswith("_per_second")
+            else {"max": round(value * (1 + margin / 100), 3)}
+        )
+        for metric, value in metrics.items()
+        if value > 0
+    }
+
+
+async def run_benchmark(args, profile: IngestionProfile):
+    rng = random.Random(args.seed)
+    SearchClient.upload_documents = stub_upload_documents(Latency(args.index_latency), rng)  # type: ignore[method-assign]
+    sentence_text_splitter = SentenceTextSplitter(has_image_embeddings=False)
+    strategy = FileStrategy(
+        list_file_strategy=UnchangedFilesListStrategy(path_pattern=args.files),
+        blob_manager=StubBlobManager(Latency(args.blob_latency), rng),
+        file_processors={
+            ".pdf": FileProcessor(LocalPdfParser(), sentence_text_splitter),
+            ".json": FileProcessor(JsonParser(), SimpleTextSplitter()),
+            ".html": FileProcessor(LocalHtmlParser(), ScheduleTextSplitter()),
+            # The catalog pages next to the schedules are read by the HTML parser instead
+            ".1": None,
+            ".sh": None,
+        },
+        embeddings=(
+            None
+            if args.novectors
+            else StubEmbeddingService(Latency(args.embedding_latency), rng, max_concurrency=args.openaiconcurrency)
+        ),
+        profile=profile,
+    )
+    search_info = SearchInfo(
+        endpoint="https://benchmark.search.windows.net/", credential=AzureKeyCredential("stub"), index_name="benchmark"
+    )
+    await strategy.run(search_info)
+
+
+def main(args):
+    profile = IngestionProfile()
+    if args.profileoutput:
+        with profile_calls(args.profileoutput):
+            asyncio.run(run_benchmark(args, profile))
+    else:
+        asyncio.run(run_benchmark(args, profile))
+    print(profile.report())
+
+    metrics = profile.metrics()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(metrics, output_file, indent=2)
+    if args.savethresholds:
+        with open(args.savethresholds, "w", encoding="utf-8") as thresholds_file:
+            json.dump(thresholds_from(metrics, args.margin), thresholds_file, indent=2)
+    if args.thresholds:
+        with open(args.thresholds, encoding="utf-8") as thresholds_file:
+            failures = check_thresholds(metrics, json.load(thresholds_file))
+        for failure in failures:
+            print(f"Regression: {failure}")
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure where ingesting files spends its time, with local stand-ins for Blob Storage, OpenAI embeddings and AI Search",
+        epilog="Example: benchmark_ingestion.py './data/*.html' --thresholds ingestion_thresholds.json",
+    )
+    parser.add_argument(
+        "files", nargs="?", default="./data/*", help="Glob of the files to ingest, which have to be under ./data/"
+    )
+    parser.add_argument("--novectors", action="store_true", help="Don't compute embeddings for the sections")
+    parser.add_argument("--openaiconcurrency", type=int, default=4, help="Embedding batch requests in flight at once")
+    parser.add_argument("--blob-latency", default="lognormal:60:0.3", help="Delay of a blob upload, in ms")
+    parser.add_argument("--embedding-latency", default="lognormal:250:0.3", help="Delay of an embedding batch, in ms")
+    parser.add_argument("--index-latency", default="lognormal:150:0.3", help="Delay of an indexing batch, in ms")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random delays")
+    parser.add_argument("--output", help="JSON file to write the measurements to")
+    parser.add_argument(
+        "--profileoutput",
+        help="Profile every function call and write it to this file, as an HTML report if it ends in .html (requires pyinstrument) or else as cProfile statistics",
+    )
+    parser.add_argument(
+        "--thresholds", help="JSON file of the minimum or maximum of each measurement, failing if exceeded"
+    )
+    parser.add_argument("--savethresholds", help="Write the thresholds of this run to this JSON file, for later runs")
+    parser.add_argument(
+        "--margin", type=float, default=25, help="Percentage later runs can be slower by with --savethresholds"
+    )
+    main(parser.parse_args())
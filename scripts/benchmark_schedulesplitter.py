@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import glob
+import re
+import time
+from typing import Callable, Generator, List
+
+from prepdocslib.page import Page, SplitPage
+from prepdocslib.schedhtmlparser import LocalHtmlParser
+from prepdocslib.textsplitter import ScheduleTextSplitter
+
+
+class LegacyScheduleTextSplitter(ScheduleTextSplitter):
+    """
+    The splitter before the class fields were extracted: it splits with an uncompiled pattern and searches each class
+    again for its level and department, and fails on a class without any digits
+    Kept here as the baseline to measure against and to check that both splitters produce the same classes
+    """
+
+    def split_pages(self, pages: List[Page]) -> Generator[SplitPage, None, None]:
+        all_text = "".join(page.text for page in pages)
+        if len(all_text.strip()) == 0:
+            return
+
+        for chunk in re.split(self.section_ending, all_text):
+            class_location = chunk.find("Class: ")
+            if class_location > 0:
+                level = int(re.search("[0-9]+", chunk).group())  # type: ignore[union-attr]
+                major = re.search("[a-zA-Z ]+", chunk[class_location + 7 :]).group().strip()  # type: ignore[union-attr]
+            else:
+                level = 0
+                major = ""
+            yield SplitPage(page_num=0, text=chunk, level=level, major=major)
+
+
+async def parse_pages(path: str) -> List[Page]:
+    # The parser finds the catalog of the department next to the schedule, so paths have to start with ./data/
+    with open(path, encoding="utf-8") as html_file:
+        return [page async for page in LocalHtmlParser().parse(content=html_file)]
+
+
+def best_time(split: Callable[[], List[List[SplitPage]]], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        split()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def main(args):
+    legacy_splitter = LegacyScheduleTextSplitter()
+    splitter = ScheduleTextSplitter()
+    documents = [asyncio.run(parse_pages(path)) for path in sorted(glob.glob(args.files))]
+    print(f"Parsed {len(documents)} schedules")
+
+    classes = 0
+    changed_majors = set()
+    with_instructors = 0
+    for pages in documents:
+        legacy_sections = list(legacy_splitter.split_pages(pages))
+        sections = list(splitter.split_pages(pages))
+        if [(s.text, s.level) for s in sections] != [(s.text, s.level) for s in legacy_sections]:
+            raise ValueError("The splitters produced different classes")
+        for section, legacy_section in zip(sections, legacy_sections):
+            # Departments like CS&SS used to be cut short at the "&"
+            if section.major != legacy_section.major:
+                changed_majors.add((legacy_section.major, section.major))
+        classes += sum(1 for section in sections if section.course_code)
+        with_instructors += sum(1 for section in sections if section.instructors)
+
+    legacy_time = best_time(lambda: [list(legacy_splitter.split_pages(pages)) for pages in documents], args.repeat)
+    current_time = best_time(lambda: [list(splitter.split_pages(pages)) for pages in documents], args.repeat)
+    print(f"{'splitter':<10} {'classes':>8} {'ms':>8} {'us/class':>9}")
+    print(f"{'legacy':<10} {classes:>8} {legacy_time * 1000:>8.1f} {legacy_time * 1e6 / classes:>9.1f}")
+    print(f"{'current':<10} {classes:>8} {current_time * 1000:>8.1f} {current_time * 1e6 / classes:>9.1f}")
+    print(f"Classes with instructors: {with_instructors}")
+    for legacy_major, major in sorted(changed_majors):
+        print(f"Department '{legacy_major}' is now '{major}'")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the speed of the schedule text splitter against the previous implementation",
+        epilog="Example: benchmark_schedulesplitter.py './data/*.html'",
+    )
+    parser.add_argument("files", nargs="?", default="./data/*.html", help="Glob of the schedule pages to split")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs, the fastest one is reported")
+    main(parser.parse_args())
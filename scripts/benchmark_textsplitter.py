@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import glob
+import time
+from typing import Callable, Generator, List
+
+from prepdocslib.page import Page, SplitPage
+from prepdocslib.pdfparser import LocalPdfParser
+from prepdocslib.textsplitter import SentenceTextSplitter
+
+
+class LegacySentenceTextSplitter(SentenceTextSplitter):
+    """
+    The splitter before it was made incremental: it concatenates every page into one string, scans the pages linearly
+    to find the page of each section, and searches for sentence and word boundaries one character at a time
+    Kept here as the baseline to measure against and to check that both splitters produce the same sections
+    """
+
+    def split_pages(self, pages: List[Page]) -> Generator[SplitPage, None, None]:  # type: ignore[override]
+        def find_page(offset):
+            num_pages = len(pages)
+            for i in range(num_pages - 1):
+                if offset >= pages[i].offset and offset < pages[i + 1].offset:
+                    return pages[i].page_num
+            return pages[num_pages - 1].page_num
+
+        all_text = "".join(page.text for page in pages)
+        if len(all_text.strip()) == 0:
+            return
+
+        length = len(all_text)
+        if length <= self.max_section_length:
+            yield SplitPage(page_num=find_page(0), text=all_text, level=-1, major="")
+            return
+
+        start = 0
+        end = length
+        while start + self.section_overlap < length:
+            last_word = -1
+            end = start + self.max_section_length
+
+            if end > length:
+                end = length
+            else:
+                while (
+                    end < length
+                    and (end - start - self.max_section_length) < self.sentence_search_limit
+                    and all_text[end] not in self.sentence_endings
+                ):
+                    if all_text[end] in self.word_breaks:
+                        last_word = end
+                    end += 1
+                if end < length and all_text[end] not in self.sentence_endings and last_word > 0:
+                    end = last_word
+            if end < length:
+                end += 1
+
+            last_word = -1
+            while (
+                start > 0
+                and start > end - self.max_section_length - 2 * self.sentence_search_limit
+                and all_text[start] not in self.sentence_endings
+            ):
+                if all_text[start] in self.word_breaks:
+                    last_word = start
+                start -= 1
+            if all_text[start] not in self.sentence_endings and last_word > 0:
+                start = last_word
+            if start > 0:
+                start += 1
+
+            section_text = all_text[start:end]
+            yield SplitPage(page_num=find_page(start), text=section_text, level=-1, major="")
+
+            last_table_start = section_text.rfind("<table")
+            if last_table_start > 2 * self.sentence_search_limit and last_table_start > section_text.rfind("</table"):
+                start = min(end - self.section_overlap, start + last_table_start)
+            else:
+                start = end - self.section_overlap
+
+        if start + self.section_overlap < end:
+            yield SplitPage(page_num=find_page(start), text=all_text[start:end], level=-1, major="")
+
+
+async def parse_pages(path: str) -> List[Page]:
+    with open(path, "rb") as pdf_file:
+        return [page async for page in LocalPdfParser().parse(content=pdf_file)]
+
+
+def repeat_pages(pages: List[Page], times: int) -> List[Page]:
+    # Stands in for a longer document, with page numbers and offsets that keep increasing
+    repeated: List[Page] = []
+    offset = 0
+    for page in pages * times:
+        repeated.append(Page(page_num=len(repeated), offset=offset, text=page.text))
+        offset += len(page.text)
+    return repeated
+
+
+def best_time(split: Callable[[], List[SplitPage]], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        split()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def main(args):
+    legacy_splitter = LegacySentenceTextSplitter(has_image_embeddings=False)
+    splitter = SentenceTextSplitter(has_image_embeddings=False)
+    print(f"{'document':<40} {'pages':>6} {'sections':>9} {'legacy ms':>10} {'current ms':>11} {'speedup':>8}")
+    for path in sorted(glob.glob(args.files)):
+        parsed_pages = asyncio.run(parse_pages(path))
+        for times in args.scale:
+            pages = repeat_pages(parsed_pages, times)
+            legacy_sections = list(legacy_splitter.split_pages(pages))
+            sections = list(splitter.split_pages(pages))
+            if [(s.page_num, s.text) for s in sections] != [(s.page_num, s.text) for s in legacy_sections]:
+                raise ValueError(f"The splitters produced different sections for {path} repeated {times} times")
+            legacy_time = best_time(lambda: list(legacy_splitter.split_pages(pages)), args.repeat)
+            current_time = best_time(lambda: list(splitter.split_pages(pages)), args.repeat)
+            name = path if times == 1 else f"{path} x{times}"
+            print(
+                f"{name:<40} {len(pages):>6} {len(sections):>9} {legacy_time * 1000:>10.1f} "
+                f"{current_time * 1000:>11.1f} {legacy_time / current_time:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the speed of the sentence text splitter against the previous implementation",
+        epilog="Example: benchmark_textsplitter.py './data/*.pdf' --scale 1 10 100",
+    )
+    parser.add_argument("files", nargs="?", default="./data/*.pdf", help="Glob of the PDF files to split")
+    parser.add_argument(
+        "--scale",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100],
+        help="Also split each document as if its pages were repeated this many times, to measure longer documents",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs, the fastest one is reported")
+    main(parser.parse_args())
@@ -0,0 +1,63 @@
+import argparse
+import csv
+import sys
+from typing import Dict, List, Tuple
+
+# Columns of the locust --csv statistics compared between runs, all in milliseconds except the request rate
+COLUMNS = ["50%", "95%", "99%", "Requests/s"]
+
+
+def read_stats(path: str) -> Dict[Tuple[str, str], Dict[str, str]]:
+    with open(path, newline="", encoding="utf-8") as stats_file:
+        return {(row["Type"], row["Name"]): row for row in csv.DictReader(stats_file) if row["Name"] != "Aggregated"}
+
+
+def higher_is_better(request_type: str, column: str) -> bool:
+    # The chunks per second of streamed answers are reported in the response time columns
+    return column == "Requests/s" or request_type == "RATE"
+
+
+def compare(baseline_path: str, current_path: str, threshold: float) -> List[str]:
+    baseline = read_stats(baseline_path)
+    current = read_stats(current_path)
+    regressions = []
+    print(f"{'type':<8} {'name':<24} {'column':>10} {'baseline':>10} {'current':>10} {'change':>8}")
+    for key in sorted(baseline.keys() & current.keys()):
+        request_type, name = key
+        for column in COLUMNS:
+            try:
+                before = float(baseline[key][column])
+                after = float(current[key][column])
+            except ValueError:
+                # Locust writes N/A when a request never completed
+                continue
+            change = (after - before) / before * 100 if before else 0.0
+            worse = -change if higher_is_better(request_type, column) else change
+            flag = " !" if worse > threshold else ""
+            print(
+                f"{request_type:<8} {name[:24]:<24} {column:>10} {before:>10.1f} {after:>10.1f} {change:>+7.1f}%{flag}"
+            )
+            if flag:
+                regressions.append(f"{request_type} {name} {column} {change:+.1f}%")
+    for key in sorted(baseline.keys() - current.keys()):
+        print(f"Missing from the current run: {' '.join(key)}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the statistics of two locust runs, such as before and after a change",
+        epilog="Example: compare_loadtests.py results/main_stats.csv results/branch_stats.csv --threshold 10",
+    )
+    parser.add_argument("baseline", help="The _stats.csv file written by locust --csv for the baseline run")
+    parser.add_argument("current", help="The _stats.csv file written by locust --csv for the run to check")
+    parser.add_argument(
+        "--threshold", type=float, default=10, help="Percentage a statistic can get worse by before it's a regression"
+    )
+    args = parser.parse_args()
+    regressions = compare(args.baseline, args.current, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} statistics got worse by more than {args.threshold}%:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
@@ -57,6 +57,16 @@ if ($env:USE_LOCAL_PDF_PARSER -eq $true) {
   $localPdfParserArg = "--localpdfparser"
 }
 
+# Each unit of Azure OpenAI capacity allows 1,000 tokens and 6 requests per minute
+if ($env:OPENAI_HOST -eq "azure" -and $env:AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY) {
+  $embeddingCapacity = [int]$env:AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY
+  $embeddingQuotaArg = "--openaitpm $($embeddingCapacity * 1000) --openairpm $($embeddingCapacity * 6)"
+}
+
+if ($env:AZURE_OPENAI_EMB_DIMENSIONS) {
+  $embeddingDimensionsArg = "--openaidimensions $env:AZURE_OPENAI_EMB_DIMENSIONS"
+}
+
 if ($env:AZURE_TENANT_ID) {
   $tenantArg = "--tenantid $env:AZURE_TENANT_ID"
 }
@@ -71,6 +81,7 @@ $argumentList = "./scripts/prepdocs.py $dataArg --verbose " + `
 "--openaihost `"$env:OPENAI_HOST`" --openaimodelname `"$env:AZURE_OPENAI_EMB_MODEL_NAME`" " + `
 "--openaiservice `"$env:AZURE_OPENAI_SERVICE`" --openaideployment `"$env:AZURE_OPENAI_EMB_DEPLOYMENT`" " + `
 "--openaikey `"$env:OPENAI_API_KEY`" --openaiorg `"$env:OPENAI_ORGANIZATION`" " + `
+"--embeddingcache `"$cwd/.embeddingcache`" --ingestionmanifest `"$cwd/.ingestionmanifest.json`" $embeddingQuotaArg $embeddingDimensionsArg " + `
 "--formrecognizerservice $env:AZURE_FORMRECOGNIZER_SERVICE " + `
 "$searchImagesArg $visionEndpointArg $visionKeyArg $visionSecretNameArg " + `
 "$adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg  " + `
@@ -2,21 +2,28 @@ import argparse
 import asyncio
 from typing import Any, Optional, Union
 
+import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential
 from azure.keyvault.secrets.aio import SecretClient
 
 from prepdocslib.blobmanager import BlobManager
+from prepdocslib.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     ImageEmbeddings,
     OpenAIEmbeddings,
     OpenAIEmbeddingService,
+    TokenBucketRateLimiter,
+    get_embedding_encoding,
 )
 from prepdocslib.fileprocessor import FileProcessor
 from prepdocslib.filestrategy import DocumentAction, FileStrategy
+from prepdocslib.ingestionmanifest import IngestionManifest
+from prepdocslib.ingestionprofile import profile_calls
 from prepdocslib.jsonparser import JsonParser
+from prepdocslib.localindex import LocalIndex
 from prepdocslib.schedhtmlparser import LocalHtmlParser, DocumentAnalysisHtmlParser
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
@@ -25,6 +32,7 @@ from prepdocslib.listfilestrategy import (
 )
 from prepdocslib.parser import Parser
 from prepdocslib.pdfparser import DocumentAnalysisParser, LocalPdfParser
+from prepdocslib.snapshotstrategy import SnapshotAction, SnapshotStrategy
 from prepdocslib.strategy import SearchInfo, Strategy
 from prepdocslib.textsplitter import SentenceTextSplitter, SimpleTextSplitter, ScheduleTextSplitter
 
@@ -54,6 +62,8 @@ async def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> Fi
         credential=storage_creds,
         store_page_images=args.searchimages,
         verbose=args.verbose,
+        image_format=args.pageimageformat,
+        image_dpi=args.pageimagedpi,
     )
 
     pdf_parser: Parser
@@ -73,17 +83,12 @@ async def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> Fi
         pdf_parser = LocalPdfParser()
     else:
         pdf_parser = doc_int_parser
-    sentence_text_splitter = SentenceTextSplitter(has_image_embeddings=args.searchimages)
-    file_processors = {
-        ".pdf": FileProcessor(pdf_parser, sentence_text_splitter),
-        ".json": FileProcessor(JsonParser(), SimpleTextSplitter()),
-        ".docx": FileProcessor(doc_int_parser, sentence_text_splitter),
-        ".html": FileProcessor(LocalHtmlParser(), ScheduleTextSplitter()),
-        ".1": None,
-        ".sh" : None,
-    }
     use_vectors = not args.novectors
     embeddings: Optional[OpenAIEmbeddings] = None
+    embedding_cache = EmbeddingCache(args.embeddingcache, verbose=args.verbose) if args.embeddingcache else None
+    embedding_rate_limiter = TokenBucketRateLimiter(
+        tokens_per_minute=args.openaitpm, requests_per_minute=args.openairpm
+    )
     if use_vectors and args.openaihost != "openai":
         azure_open_ai_credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
             credential if is_key_empty(args.openaikey) else AzureKeyCredential(args.openaikey)
@@ -95,6 +100,11 @@ async def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> Fi
             credential=azure_open_ai_credential,
             disable_batch=args.disablebatchvectors,
             verbose=args.verbose,
+            cache=embedding_cache,
+            rate_limiter=embedding_rate_limiter,
+            max_concurrency=args.openaiconcurrency,
+            first_fit_decreasing=args.packbatchvectors,
+            open_ai_dimensions=args.openaidimensions,
         )
     elif use_vectors:
         embeddings = OpenAIEmbeddingService(
@@ -103,8 +113,36 @@ async def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> Fi
             organization=args.openaiorg,
             disable_batch=args.disablebatchvectors,
             verbose=args.verbose,
+            cache=embedding_cache,
+            rate_limiter=embedding_rate_limiter,
+            max_concurrency=args.openaiconcurrency,
+            first_fit_decreasing=args.packbatchvectors,
+            open_ai_dimensions=args.openaidimensions,
         )
 
+    # Sections measured in tokens use the same encoding as the embedding model, so their lengths can be reused for batching
+    encoding: Optional[tiktoken.Encoding] = None
+    if args.sectiontokens:
+        encoding = (
+            embeddings.get_encoding()
+            if embeddings
+            else get_embedding_encoding(args.openaimodelname or "text-embedding-ada-002")
+        )
+    sentence_text_splitter = SentenceTextSplitter(
+        has_image_embeddings=args.searchimages,
+        max_tokens_per_section=args.sectiontokens,
+        token_overlap=args.sectiontokenoverlap,
+        encoding=encoding,
+    )
+    file_processors = {
+        ".pdf": FileProcessor(pdf_parser, sentence_text_splitter),
+        ".json": FileProcessor(JsonParser(), SimpleTextSplitter()),
+        ".docx": FileProcessor(doc_int_parser, sentence_text_splitter),
+        ".html": FileProcessor(LocalHtmlParser(), ScheduleTextSplitter()),
+        ".1": None,
+        ".sh" : None,
+    }
+
     image_embeddings: Optional[ImageEmbeddings] = None
 
     if args.searchimages:
@@ -146,6 +184,18 @@ async def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> Fi
         search_analyzer_name=args.searchanalyzername,
         use_acls=args.useacls,
         category=args.category,
+        manifest=IngestionManifest(args.ingestionmanifest) if args.ingestionmanifest else None,
+        local_index=LocalIndex(args.localindex) if args.localindex else None,
+    )
+
+
+def setup_snapshot_strategy(args: Any) -> SnapshotStrategy:
+    return SnapshotStrategy(
+        path=args.exportsnapshot or args.importsnapshot,
+        snapshot_action=SnapshotAction.Export if args.exportsnapshot else SnapshotAction.Import,
+        search_analyzer_name=args.searchanalyzername,
+        manifest=IngestionManifest(args.ingestionmanifest) if args.ingestionmanifest else None,
+        local_index=LocalIndex(args.localindex) if args.localindex else None,
     )
 
 
@@ -248,6 +298,24 @@ if __name__ == "__main__":
     parser.add_argument(
         "--openaimodelname", help="Name of the Azure OpenAI embedding model ('text-embedding-ada-002' recommended)"
     )
+    parser.add_argument(
+        "--openaidimensions",
+        type=int,
+        required=False,
+        help="Optional. Number of dimensions of the embedding vectors, for models that support shortened embeddings (text-embedding-3-*). Defaults to the model's native dimensions",
+    )
+    parser.add_argument(
+        "--sectiontokens",
+        type=int,
+        required=False,
+        help="Optional. Split documents into sections of at most this many tokens of the embedding model, instead of about 1000 characters",
+    )
+    parser.add_argument(
+        "--sectiontokenoverlap",
+        type=int,
+        required=False,
+        help="Optional. Number of tokens that consecutive sections share when using --sectiontokens. Defaults to a tenth of the section size",
+    )
     parser.add_argument(
         "--novectors",
         action="store_true",
@@ -256,6 +324,54 @@ if __name__ == "__main__":
     parser.add_argument(
         "--disablebatchvectors", action="store_true", help="Don't compute embeddings in batch for the sections"
     )
+    parser.add_argument(
+        "--packbatchvectors",
+        action="store_true",
+        help="Pack sections into embedding batches by size (first-fit-decreasing) instead of in document order, to make fewer requests",
+    )
+    parser.add_argument(
+        "--openaitpm",
+        type=int,
+        required=False,
+        help="Optional. Tokens-per-minute quota of the embedding deployment, used to pace concurrent embedding requests",
+    )
+    parser.add_argument(
+        "--openairpm",
+        type=int,
+        required=False,
+        help="Optional. Requests-per-minute quota of the embedding deployment, used to pace concurrent embedding requests",
+    )
+    parser.add_argument(
+        "--openaiconcurrency",
+        type=int,
+        default=4,
+        help="Optional. Maximum number of embedding batch requests in flight at once",
+    )
+    parser.add_argument(
+        "--embeddingcache",
+        required=False,
+        help="Optional. Directory of a persistent embedding cache, so sections whose text hasn't changed are not embedded again",
+    )
+    parser.add_argument(
+        "--ingestionmanifest",
+        required=False,
+        help="Optional. JSON file recording the search document ids of each indexed file, so removed or re-indexed files are deleted by key instead of by searching the index",
+    )
+    parser.add_argument(
+        "--localindex",
+        required=False,
+        help="Optional. Also write the indexed sections and their embeddings to this folder, which the app searches in its own process instead of Azure AI Search when LOCAL_SEARCH_INDEX_PATH is set to it",
+    )
+    parser.add_argument(
+        "--exportsnapshot",
+        required=False,
+        help="Optional. Instead of processing files, export the sections of the search index with their embeddings to this snapshot file",
+    )
+    parser.add_argument(
+        "--importsnapshot",
+        required=False,
+        help="Optional. Instead of processing files, index the sections of this snapshot file without computing their embeddings again",
+    )
     parser.add_argument(
         "--openaikey",
         required=False,
@@ -293,6 +409,18 @@ if __name__ == "__main__":
         required=False,
         help="Optional. Generate image embeddings to enable each page to be searched as an image",
     )
+    parser.add_argument(
+        "--pageimageformat",
+        choices=["png", "jpeg", "webp"],
+        default="png",
+        help="Optional. Format of the page images stored when using --searchimages. JPEG and WebP images are much smaller than PNG",
+    )
+    parser.add_argument(
+        "--pageimagedpi",
+        type=int,
+        required=False,
+        help="Optional. Resolution of the page images stored when using --searchimages, 72 DPI by default",
+    )
     parser.add_argument(
         "--visionendpoint",
         required=False,
@@ -313,6 +441,16 @@ if __name__ == "__main__":
         required=False,
         help="Required if --searchimages is specified and --keyvaultname is provided. Fetch the Azure AI Vision key from this key vault instead of using the current user identity to login.",
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Optional. Print the time spent parsing, splitting, uploading, embedding and indexing, and the files, sections and bytes processed per second",
+    )
+    parser.add_argument(
+        "--profileoutput",
+        required=False,
+        help="Optional. Profile every function call and write it to this file, as an HTML report if it ends in .html (requires pyinstrument) or else as cProfile statistics",
+    )
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     args = parser.parse_args()
 
@@ -324,6 +462,16 @@ if __name__ == "__main__":
     )
 
     loop = asyncio.get_event_loop()
-    file_strategy = loop.run_until_complete(setup_file_strategy(azd_credential, args))
-    loop.run_until_complete(main(file_strategy, azd_credential, args))
+    strategy: Strategy
+    if args.exportsnapshot or args.importsnapshot:
+        strategy = setup_snapshot_strategy(args)
+    else:
+        strategy = loop.run_until_complete(setup_file_strategy(azd_credential, args))
+    if args.profileoutput:
+        with profile_calls(args.profileoutput):
+            loop.run_until_complete(main(strategy, azd_credential, args))
+    else:
+        loop.run_until_complete(main(strategy, azd_credential, args))
+    if args.profile and isinstance(strategy, FileStrategy):
+        print(strategy.profile.report())
     loop.close()
@@ -62,6 +62,15 @@ if [ "$USE_LOCAL_PDF_PARSER" = true ]; then
   localPdfParserArg="--localpdfparser"
 fi
 
+# Each unit of Azure OpenAI capacity allows 1,000 tokens and 6 requests per minute
+if [ "$OPENAI_HOST" = "azure" ] && [ -n "$AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY" ]; then
+  embeddingQuotaArg="--openaitpm $((AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY * 1000)) --openairpm $((AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY * 6))"
+fi
+
+if [ -n "$AZURE_OPENAI_EMB_DIMENSIONS" ]; then
+  embeddingDimensionsArg="--openaidimensions $AZURE_OPENAI_EMB_DIMENSIONS"
+fi
+
 if [ -n "$AZURE_TENANT_ID" ]; then
   tenantArg="--tenantid $AZURE_TENANT_ID"
 fi
@@ -73,6 +82,7 @@ $searchAnalyzerNameArg $searchSecretNameArg \
 --openaihost "$OPENAI_HOST" --openaimodelname "$AZURE_OPENAI_EMB_MODEL_NAME" \
 --openaiservice "$AZURE_OPENAI_SERVICE" --openaideployment "$AZURE_OPENAI_EMB_DEPLOYMENT"  \
 --openaikey "$OPENAI_API_KEY" --openaiorg "$OPENAI_ORGANIZATION" \
+--embeddingcache ./.embeddingcache --ingestionmanifest ./.ingestionmanifest.json $embeddingQuotaArg $embeddingDimensionsArg \
 --formrecognizerservice "$AZURE_FORMRECOGNIZER_SERVICE" \
 $searchImagesArg $visionEndpointArg $visionKeyArg $visionSecretNameArg \
 $adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg \
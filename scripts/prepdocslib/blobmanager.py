@@ -1,18 +1,86 @@
+import asyncio
 import datetime
+import functools
+import hashlib
 import io
 import os
 import re
-from typing import List, Optional, Union
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, Any, Dict, List, Optional, Tuple, Union
 
 import fitz  # type: ignore
 from azure.core.credentials_async import AsyncTokenCredential
-from azure.storage.blob import BlobSasPermissions, UserDelegationKey, generate_blob_sas
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import (
+    BlobSasPermissions,
+    ContentSettings,
+    UserDelegationKey,
+    generate_blob_sas,
+)
 from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 from PIL import Image, ImageDraw, ImageFont
-from pypdf import PdfReader
 
 from .listfilestrategy import File
 
+# Pillow format names and the options used when saving page images in each of them
+PAGE_IMAGE_FORMATS: Dict[str, Tuple[str, Dict[str, Any]]] = {
+    "png": ("PNG", {}),
+    "jpeg": ("JPEG", {"quality": 85}),
+    "webp": ("WEBP", {"quality": 85}),
+}
+PAGE_IMAGE_EXTENSIONS = "|".join(PAGE_IMAGE_FORMATS)
+
+
+@functools.lru_cache(maxsize=1)
+def open_pdf(path: str, modified_time: int) -> fitz.Document:
+    # Worker processes render many pages of the same file, so each of them only opens the document once
+    return fitz.open(path)
+
+
+@functools.lru_cache(maxsize=1)
+def load_font() -> Optional[ImageFont.FreeTypeFont]:
+    try:
+        return ImageFont.truetype("arial.ttf", 20)
+    except OSError:
+        try:
+            return ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
+        except OSError:
+            print("\tUnable to find arial.ttf or FreeMono.ttf, using default font")
+            return None
+
+
+def render_page_image(
+    path: str, modified_time: int, page_num: int, blob_name: str, image_format: str, dpi: Optional[int]
+) -> bytes:
+    """
+    Renders a page of a PDF with its blob name written above it, and encodes it in the given format
+    This runs in worker processes, so it only takes arguments that can be pickled
+    """
+    page = open_pdf(path, modified_time).load_page(page_num)
+    pix = page.get_pixmap(dpi=dpi) if dpi else page.get_pixmap()
+    original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
+
+    # Create a new image with additional space for text
+    text_height = 40  # Height of the text area
+    new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
+
+    # Paste the original image onto the new image
+    new_img.paste(original_img, (0, text_height))
+
+    # Draw the text on the white area
+    draw = ImageDraw.Draw(new_img)
+    text = f"SourceFileName:{blob_name}"
+
+    # 10 pixels from the top and left of the image
+    x = 10
+    y = 10
+    draw.text((x, y), text, font=load_font(), fill="black")
+
+    pil_format, save_options = PAGE_IMAGE_FORMATS[image_format]
+    output = io.BytesIO()
+    new_img.save(output, format=pil_format, **save_options)
+    return output.getvalue()
+
 
 class BlobManager:
     """
@@ -26,124 +94,187 @@ class BlobManager:
         credential: Union[AsyncTokenCredential, str],
         store_page_images: bool = False,
         verbose: bool = False,
+        image_format: str = "png",
+        image_dpi: Optional[int] = None,
+        image_workers: Optional[int] = None,
+        max_image_uploads: int = 8,
+        max_upload_concurrency: int = 4,
     ):
+        if image_format not in PAGE_IMAGE_FORMATS:
+            raise ValueError(
+                f"Unsupported page image format {image_format}, expected one of {list(PAGE_IMAGE_FORMATS)}"
+            )
         self.endpoint = endpoint
         self.credential = credential
         self.container = container
         self.store_page_images = store_page_images
         self.verbose = verbose
+        self.image_format = image_format
+        self.image_dpi = image_dpi
+        self.image_workers = image_workers
+        self.max_image_uploads = max_image_uploads
+        self.max_upload_concurrency = max_upload_concurrency
         self.user_delegation_key: Optional[UserDelegationKey] = None
+        self.service_client: Optional[BlobServiceClient] = None
+        self.container_client: Optional[ContainerClient] = None
+        self.container_exists = False
+        self.image_executor: Optional[ProcessPoolExecutor] = None
+
+    def get_service_client(self) -> BlobServiceClient:
+        # A single client, and so a single connection pool, is shared by every upload and removal of an ingestion run
+        if self.service_client is None:
+            self.service_client = BlobServiceClient(
+                account_url=self.endpoint,
+                credential=self.credential,
+                max_single_put_size=4 * 1024 * 1024,
+                max_block_size=4 * 1024 * 1024,
+            )
+        return self.service_client
+
+    def get_container_client(self) -> ContainerClient:
+        if self.container_client is None:
+            self.container_client = self.get_service_client().get_container_client(self.container)
+        return self.container_client
+
+    def get_image_executor(self) -> ProcessPoolExecutor:
+        # The worker processes are started once per ingestion run, so every PDF reuses their imports and open documents
+        if self.image_executor is None:
+            self.image_executor = ProcessPoolExecutor(max_workers=self.image_workers)
+        return self.image_executor
+
+    async def close(self):
+        if self.container_client is not None:
+            await self.container_client.close()
+        if self.service_client is not None:
+            await self.service_client.close()
+        if self.image_executor is not None:
+            self.image_executor.shutdown()
+        self.service_client = None
+        self.container_client = None
+        self.container_exists = False
+        self.image_executor = None
 
     async def upload_blob(self, file: File) -> Optional[List[str]]:
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential, max_single_put_size=4 * 1024 * 1024
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
+        container_client = self.get_container_client()
+        if not self.container_exists:
             if not await container_client.exists():
                 await container_client.create_container()
+            self.container_exists = True
 
-            # Re-open and upload the original file
-            with open(file.content.name, "rb") as reopened_file:
-                blob_name = BlobManager.blob_name_from_file_name(file.content.name)
-                print(f"\tUploading blob for whole file -> {blob_name}")
-                await container_client.upload_blob(blob_name, reopened_file, overwrite=True)
+        # The file was already read by the parser, so its stream is rewound and uploaded rather than reopened
+        blob_name = BlobManager.blob_name_from_file_name(file.content.name)
+        content_md5 = BlobManager.content_md5(file.content)
+        if await self.blob_matches(container_client, blob_name, content_md5):
+            if self.verbose:
+                print(f"\tSkipping upload of unchanged blob {blob_name}")
+        else:
+            print(f"\tUploading blob for whole file -> {blob_name}")
+            # The MD5 is stored explicitly because the service only computes it for blobs uploaded in a single request
+            await container_client.upload_blob(
+                blob_name,
+                file.content,
+                overwrite=True,
+                content_settings=ContentSettings(content_md5=content_md5),
+                max_concurrency=self.max_upload_concurrency,
+            )
 
-            if self.store_page_images and os.path.splitext(file.content.name)[1].lower() == ".pdf":
-                return await self.upload_pdf_blob_images(service_client, container_client, file)
+        if self.store_page_images and os.path.splitext(file.content.name)[1].lower() == ".pdf":
+            return await self.upload_pdf_blob_images(self.get_service_client(), container_client, file)
 
         return None
 
+    async def blob_matches(self, container_client: ContainerClient, blob_name: str, content_md5: bytes) -> bool:
+        try:
+            properties = await container_client.get_blob_client(blob_name).get_blob_properties()
+        except ResourceNotFoundError:
+            return False
+        return properties.content_settings.content_md5 == content_md5
+
+    @classmethod
+    def content_md5(cls, content: IO) -> bytes:
+        content.seek(0)
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: content.read(1024 * 1024), b""):
+            md5.update(chunk)
+        content.seek(0)
+        return md5.digest()
+
     async def upload_pdf_blob_images(
         self, service_client: BlobServiceClient, container_client: ContainerClient, file: File
     ) -> List[str]:
-        with open(file.content.name, "rb") as reopened_file:
-            reader = PdfReader(reopened_file)
-            page_count = len(reader.pages)
-        doc = fitz.open(file.content.name)
-        sas_uris = []
+        path = file.content.name
+        modified_time = os.stat(path).st_mtime_ns
+        with fitz.open(path) as doc:
+            page_count = len(doc)
         start_time = datetime.datetime.now(datetime.timezone.utc)
         expiry_time = start_time + datetime.timedelta(days=1)
+        if page_count and not self.user_delegation_key:
+            self.user_delegation_key = await service_client.get_user_delegation_key(start_time, expiry_time)
 
-        font = None
-        try:
-            font = ImageFont.truetype("arial.ttf", 20)
-        except OSError:
-            try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
-            except OSError:
-                print("\tUnable to find arial.ttf or FreeMono.ttf, using default font")
+        # Pages are rendered and encoded in worker processes so they don't block the event loop or each other, and
+        # the semaphore bounds how many rendered pages are held in memory waiting to be uploaded
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_image_uploads)
 
-        for i in range(page_count):
-            blob_name = BlobManager.blob_image_name_from_file_page(file.content.name, i)
-            if self.verbose:
-                print(f"\tConverting page {i} to image and uploading -> {blob_name}")
-
-            doc = fitz.open(file.content.name)
-            page = doc.load_page(i)
-            pix = page.get_pixmap()
-            original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
-
-            # Create a new image with additional space for text
-            text_height = 40  # Height of the text area
-            new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
-
-            # Paste the original image onto the new image
-            new_img.paste(original_img, (0, text_height))
-
-            # Draw the text on the white area
-            draw = ImageDraw.Draw(new_img)
-            text = f"SourceFileName:{blob_name}"
-
-            # 10 pixels from the top and left of the image
-            x = 10
-            y = 10
-            draw.text((x, y), text, font=font, fill="black")
-
-            output = io.BytesIO()
-            new_img.save(output, format="PNG")
-            output.seek(0)
-
-            blob_client = await container_client.upload_blob(blob_name, output, overwrite=True)
-            if not self.user_delegation_key:
-                self.user_delegation_key = await service_client.get_user_delegation_key(start_time, expiry_time)
-
-            if blob_client.account_name is not None:
-                sas_token = generate_blob_sas(
-                    account_name=blob_client.account_name,
-                    container_name=blob_client.container_name,
-                    blob_name=blob_client.blob_name,
-                    user_delegation_key=self.user_delegation_key,
-                    permission=BlobSasPermissions(read=True),
-                    expiry=expiry_time,
-                    start=start_time,
+        async def upload_page_image(executor: ProcessPoolExecutor, page_num: int) -> Optional[str]:
+            blob_name = BlobManager.blob_image_name_from_file_page(path, page_num, self.image_format)
+            async with semaphore:
+                if self.verbose:
+                    print(f"\tConverting page {page_num} to image and uploading -> {blob_name}")
+                image = await loop.run_in_executor(
+                    executor,
+                    render_page_image,
+                    path,
+                    modified_time,
+                    page_num,
+                    blob_name,
+                    self.image_format,
+                    self.image_dpi,
                 )
-                sas_uris.append(f"{blob_client.url}?{sas_token}")
+                blob_client = await container_client.upload_blob(blob_name, image, overwrite=True)
+
+            if blob_client.account_name is None:
+                return None
+            sas_token = generate_blob_sas(
+                account_name=blob_client.account_name,
+                container_name=blob_client.container_name,
+                blob_name=blob_client.blob_name,
+                user_delegation_key=self.user_delegation_key,
+                permission=BlobSasPermissions(read=True),
+                expiry=expiry_time,
+                start=start_time,
+            )
+            return f"{blob_client.url}?{sas_token}"
 
-        return sas_uris
+        executor = self.get_image_executor()
+        sas_uris = await asyncio.gather(*(upload_page_image(executor, page_num) for page_num in range(page_count)))
+        return [sas_uri for sas_uri in sas_uris if sas_uri is not None]
 
     async def remove_blob(self, path: Optional[str] = None):
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
+        container_client = self.get_container_client()
+        if not self.container_exists:
             if not await container_client.exists():
                 return
-            if path is None:
-                prefix = None
-                blobs = container_client.list_blob_names()
-            else:
-                prefix = os.path.splitext(os.path.basename(path))[0]
-                blobs = container_client.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0])
-            async for blob_path in blobs:
-                # This still supports PDFs split into individual pages, but we could remove in future to simplify code
-                if (
-                    prefix is not None
-                    and (
-                        not re.match(rf"{prefix}-\d+\.pdf", blob_path) or not re.match(rf"{prefix}-\d+\.png", blob_path)
-                    )
-                ) or (path is not None and blob_path == os.path.basename(path)):
-                    continue
-                if self.verbose:
-                    print(f"\tRemoving blob {blob_path}")
-                await container_client.delete_blob(blob_path)
+            self.container_exists = True
+        if path is None:
+            prefix = None
+            blobs = container_client.list_blob_names()
+        else:
+            prefix = os.path.splitext(os.path.basename(path))[0]
+            blobs = container_client.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0])
+        async for blob_path in blobs:
+            # This still supports PDFs split into individual pages, but we could remove in future to simplify code
+            if (
+                prefix is not None
+                and (
+                    not re.match(rf"{prefix}-\d+\.pdf", blob_path)
+                    or not re.match(rf"{prefix}-\d+\.({PAGE_IMAGE_EXTENSIONS})", blob_path)
+                )
+            ) or (path is not None and blob_path == os.path.basename(path)):
+                continue
+            if self.verbose:
+                print(f"\tRemoving blob {blob_path}")
+            await container_client.delete_blob(blob_path)
 
     @classmethod
     def sourcepage_from_file_page(cls, filename, page=0) -> str:
@@ -153,8 +284,8 @@ class BlobManager:
             return os.path.basename(filename)
 
     @classmethod
-    def blob_image_name_from_file_page(cls, filename, page=0) -> str:
-        return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + ".png"
+    def blob_image_name_from_file_page(cls, filename, page=0, image_format="png") -> str:
+        return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + f".{image_format}"
 
     @classmethod
     def blob_name_from_file_name(cls, filename) -> str:
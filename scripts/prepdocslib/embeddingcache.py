@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """
+    On-disk vectors for a single embedding model
+    Vectors are appended as raw float32 rows to a data file that is read back through a memory map, and an index file maps text hashes to row numbers
+    """
+
+    def __init__(self, data_path: str, index_path: str):
+        self.data_path = data_path
+        self.index_path = index_path
+        self.dimensions: Optional[int] = None
+        self.rows: Dict[str, int] = {}
+        self.matrix: Optional[np.memmap] = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as index_file:
+                index = json.load(index_file)
+            self.dimensions = index["dimensions"]
+            self.rows = index["rows"]
+            # Drop any rows that were indexed but never fully written to the data file
+            stored_rows = self.stored_row_count()
+            self.rows = {key: row for key, row in self.rows.items() if row < stored_rows}
+
+    def stored_row_count(self) -> int:
+        if not self.dimensions or not os.path.exists(self.data_path):
+            return 0
+        return os.path.getsize(self.data_path) // (self.dimensions * 4)
+
+    def get(self, key: str) -> Optional[List[float]]:
+        row = self.rows.get(key)
+        if row is None or self.dimensions is None:
+            return None
+        if self.matrix is None:
+            self.matrix = np.memmap(
+                self.data_path, dtype=np.float32, mode="r", shape=(self.stored_row_count(), self.dimensions)
+            )
+        return self.matrix[row].tolist()
+
+    def put(self, keys: List[str], embeddings: List[List[float]]):
+        new_embeddings: Dict[str, List[float]] = {}
+        for key, embedding in zip(keys, embeddings):
+            if key not in self.rows:
+                new_embeddings[key] = embedding
+        new_rows = list(new_embeddings.items())
+        if not new_rows:
+            return
+        if self.dimensions is None:
+            self.dimensions = len(new_rows[0][1])
+        vectors = np.asarray([embedding for _, embedding in new_rows], dtype=np.float32)
+        if vectors.shape[1] != self.dimensions:
+            raise ValueError(
+                f"Cannot store {vectors.shape[1]}-dimensional embeddings in a {self.dimensions}-dimensional store"
+            )
+        next_row = self.stored_row_count()
+        with open(self.data_path, "ab") as data_file:
+            data_file.write(vectors.tobytes())
+        for offset, (key, _) in enumerate(new_rows):
+            self.rows[key] = next_row + offset
+        # The memory map has a fixed size, so it's reopened on the next read to see the new rows
+        self.matrix = None
+        with open(self.index_path, "w", encoding="utf-8") as index_file:
+            json.dump({"dimensions": self.dimensions, "rows": self.rows}, index_file)
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of text embeddings, keyed on the embedding model and the SHA-256 hash of the text
+    Lets a reindex of unchanged content skip the embeddings API entirely
+    """
+
+    def __init__(self, path: str, verbose: bool = False):
+        self.path = path
+        self.verbose = verbose
+        self.stores: Dict[str, EmbeddingStore] = {}
+
+    @classmethod
+    def hash_text(cls, text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def store_for_model(self, model: str) -> EmbeddingStore:
+        if model not in self.stores:
+            os.makedirs(self.path, exist_ok=True)
+            store_name = re.sub("[^0-9a-zA-Z_.-]", "_", model)
+            self.stores[model] = EmbeddingStore(
+                data_path=os.path.join(self.path, f"{store_name}.f32"),
+                index_path=os.path.join(self.path, f"{store_name}.json"),
+            )
+        return self.stores[model]
+
+    def get_embeddings(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        store = self.store_for_model(model)
+        embeddings = [store.get(EmbeddingCache.hash_text(text)) for text in texts]
+        if self.verbose:
+            hits = sum(1 for embedding in embeddings if embedding is not None)
+            print(f"Embedding cache hits: {hits} of {len(texts)} texts")
+        return embeddings
+
+    def put_embeddings(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        self.store_for_model(model).put([EmbeddingCache.hash_text(text) for text in texts], embeddings)
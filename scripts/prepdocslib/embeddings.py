@@ -1,6 +1,7 @@
+import asyncio
 import time
 from abc import ABC
-from typing import List, Optional, Union
+from typing import Any, Dict, List, Mapping, Optional, Union
 from urllib.parse import urljoin
 
 import aiohttp
@@ -8,6 +9,7 @@ import tiktoken
 from azure.core.credentials import AccessToken, AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from openai import AsyncAzureOpenAI, AsyncOpenAI, RateLimitError
+from openai.types import CreateEmbeddingResponse
 from tenacity import (
     AsyncRetrying,
     retry_if_exception_type,
@@ -15,15 +17,135 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from .embeddingcache import EmbeddingCache
+
 
 class EmbeddingBatch:
     """
     Represents a batch of text that is going to be embedded
+    Indices are the positions of the texts in the list that was split into batches
     """
 
-    def __init__(self, texts: List[str], token_length: int):
+    def __init__(self, texts: List[str], token_length: int, indices: Optional[List[int]] = None):
         self.texts = texts
         self.token_length = token_length
+        self.indices = indices if indices is not None else list(range(len(texts)))
+
+
+class EmbeddingModelInfo:
+    """
+    Capabilities of an embedding model: how much text can be sent in one batch request, and the size of the vectors it returns
+    Models with reducible dimensions can return shortened vectors, which take less index memory and are faster to search
+    """
+
+    def __init__(
+        self,
+        token_limit: int,
+        max_batch_size: int,
+        dimensions: int,
+        reducible_dimensions: bool = False,
+        encoding: str = "cl100k_base",
+    ):
+        self.token_limit = token_limit
+        self.max_batch_size = max_batch_size
+        self.dimensions = dimensions
+        self.reducible_dimensions = reducible_dimensions
+        # Named explicitly, since tiktoken can't map the newer models to their encoding
+        self.encoding = encoding
+
+
+SUPPORTED_EMBEDDING_MODELS: Dict[str, EmbeddingModelInfo] = {
+    "text-embedding-ada-002": EmbeddingModelInfo(token_limit=8100, max_batch_size=16, dimensions=1536),
+    "text-embedding-3-small": EmbeddingModelInfo(
+        token_limit=8100, max_batch_size=16, dimensions=1536, reducible_dimensions=True
+    ),
+    "text-embedding-3-large": EmbeddingModelInfo(
+        token_limit=8100, max_batch_size=16, dimensions=3072, reducible_dimensions=True
+    ),
+}
+
+# Vector size of models that aren't in SUPPORTED_EMBEDDING_MODELS
+DEFAULT_EMBEDDING_DIMENSIONS = 1536
+
+
+def get_embedding_encoding(open_ai_model_name: str) -> tiktoken.Encoding:
+    model_info = SUPPORTED_EMBEDDING_MODELS.get(open_ai_model_name)
+    if model_info:
+        return tiktoken.get_encoding(model_info.encoding)
+    return tiktoken.encoding_for_model(open_ai_model_name)
+
+
+class TokenBucketRateLimiter:
+    """
+    Paces requests to the embeddings API so that they stay within the deployment's tokens-per-minute and requests-per-minute quota
+    Both buckets refill continuously, and the rate limit headers returned by the service can drain or pause them
+    """
+
+    def __init__(self, tokens_per_minute: Optional[int] = None, requests_per_minute: Optional[int] = None):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.available_tokens = float(tokens_per_minute or 0)
+        self.available_requests = float(requests_per_minute or 0)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.updated_at) / 60
+        self.updated_at = now
+        if self.tokens_per_minute:
+            self.available_tokens = min(
+                self.tokens_per_minute, self.available_tokens + elapsed_minutes * self.tokens_per_minute
+            )
+        if self.requests_per_minute:
+            self.available_requests = min(
+                self.requests_per_minute, self.available_requests + elapsed_minutes * self.requests_per_minute
+            )
+
+    def seconds_until_available(self, token_length: int) -> float:
+        wait = max(0.0, self.paused_until - time.monotonic())
+        if self.tokens_per_minute:
+            # A request larger than the whole quota can never fit, so it only waits for a full bucket
+            needed_tokens = min(token_length, self.tokens_per_minute)
+            wait = max(wait, (needed_tokens - self.available_tokens) * 60 / self.tokens_per_minute)
+        if self.requests_per_minute:
+            wait = max(wait, (1 - self.available_requests) * 60 / self.requests_per_minute)
+        return wait
+
+    async def acquire(self, token_length: int):
+        async with self.lock:
+            while True:
+                self.refill()
+                wait = self.seconds_until_available(token_length)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.tokens_per_minute:
+                self.available_tokens -= token_length
+            if self.requests_per_minute:
+                self.available_requests -= 1
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        retry_after = TokenBucketRateLimiter.retry_after_seconds(headers)
+        if retry_after is not None:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if self.tokens_per_minute and remaining_tokens is not None:
+            self.available_tokens = min(self.available_tokens, float(remaining_tokens))
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if self.requests_per_minute and remaining_requests is not None:
+            self.available_requests = min(self.available_requests, float(remaining_requests))
+
+    @classmethod
+    def retry_after_seconds(cls, headers: Mapping[str, str]) -> Optional[float]:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms is not None:
+            return float(retry_after_ms) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after is not None and retry_after.replace(".", "", 1).isdigit():
+            return float(retry_after)
+        return None
 
 
 class OpenAIEmbeddings(ABC):
@@ -32,90 +154,225 @@ class OpenAIEmbeddings(ABC):
     Can split source text into batches for more efficient embedding calls
     """
 
-    SUPPORTED_BATCH_AOAI_MODEL = {"text-embedding-ada-002": {"token_limit": 8100, "max_batch_size": 16}}
-
-    def __init__(self, open_ai_model_name: str, disable_batch: bool = False, verbose: bool = False):
+    def __init__(
+        self,
+        open_ai_model_name: str,
+        disable_batch: bool = False,
+        verbose: bool = False,
+        cache: Optional[EmbeddingCache] = None,
+        rate_limiter: Optional[TokenBucketRateLimiter] = None,
+        max_concurrency: int = 4,
+        first_fit_decreasing: bool = False,
+        open_ai_dimensions: Optional[int] = None,
+    ):
         self.open_ai_model_name = open_ai_model_name
+        self.model_info = SUPPORTED_EMBEDDING_MODELS.get(open_ai_model_name)
+        if open_ai_dimensions is not None and open_ai_dimensions != self.native_dimensions():
+            if not self.model_info or not self.model_info.reducible_dimensions:
+                raise ValueError(f"Model {open_ai_model_name} does not support reduced embedding dimensions")
+            if not 0 < open_ai_dimensions <= self.model_info.dimensions:
+                raise ValueError(
+                    f"Model {open_ai_model_name} supports at most {self.model_info.dimensions} embedding dimensions"
+                )
+        self.open_ai_dimensions = open_ai_dimensions
         self.disable_batch = disable_batch
         self.verbose = verbose
+        self.cache = cache
+        self.rate_limiter = rate_limiter or TokenBucketRateLimiter()
+        self.max_concurrency = max_concurrency
+        self.client: Optional[AsyncOpenAI] = None
+        self.first_fit_decreasing = first_fit_decreasing
+        self.encoding: Optional[tiktoken.Encoding] = None
 
     async def create_client(self) -> AsyncOpenAI:
         raise NotImplementedError
 
+    def native_dimensions(self) -> int:
+        return self.model_info.dimensions if self.model_info else DEFAULT_EMBEDDING_DIMENSIONS
+
+    def embedding_dimensions(self) -> int:
+        return self.open_ai_dimensions or self.native_dimensions()
+
+    def dimensions_argument(self) -> Dict[str, Any]:
+        # Only send the dimensions parameter when asking for shortened vectors, since older models reject it
+        if self.open_ai_dimensions is None or self.open_ai_dimensions == self.native_dimensions():
+            return {}
+        return {"dimensions": self.open_ai_dimensions}
+
+    def cache_model_name(self) -> str:
+        if not self.dimensions_argument():
+            return self.open_ai_model_name
+        return f"{self.open_ai_model_name}-{self.open_ai_dimensions}"
+
+    async def get_client(self) -> AsyncOpenAI:
+        # The client holds a connection pool, so it's created once and shared by every request
+        if self.client is None:
+            self.client = await self.create_client()
+        return self.client
+
     def before_retry_sleep(self, retry_state):
         if self.verbose:
             print("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
 
+    def retry_wait(self, retry_state) -> float:
+        exception = retry_state.outcome.exception()
+        if isinstance(exception, RateLimitError):
+            self.rate_limiter.update_from_headers(exception.response.headers)
+            retry_after = TokenBucketRateLimiter.retry_after_seconds(exception.response.headers)
+            if retry_after is not None:
+                return retry_after
+        return wait_random_exponential(min=15, max=60)(retry_state)
+
+    async def request_embeddings(self, client: AsyncOpenAI, input: Union[str, List[str]]) -> CreateEmbeddingResponse:
+        # The raw response is read so the rate limit headers of every request pace the next ones, not only those of
+        # the requests that were already throttled
+        raw_response = await client.embeddings.with_raw_response.create(
+            model=self.open_ai_model_name, input=input, **self.dimensions_argument()
+        )
+        self.rate_limiter.update_from_headers(raw_response.headers)
+        return raw_response.parse()
+
+    def get_encoding(self) -> tiktoken.Encoding:
+        # Resolving the encoding is expensive, so it's only done once per model
+        if self.encoding is None:
+            self.encoding = get_embedding_encoding(self.open_ai_model_name)
+        return self.encoding
+
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
+        return len(self.get_encoding().encode(text))
+
+    def calculate_token_lengths(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in self.get_encoding().encode_batch(texts)]
 
-    def split_text_into_batches(self, texts: List[str]) -> List[EmbeddingBatch]:
-        batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
-        if not batch_info:
+    def split_text_into_batches(
+        self, texts: List[str], token_lengths: Optional[List[int]] = None
+    ) -> List[EmbeddingBatch]:
+        if not self.model_info:
             raise NotImplementedError(
                 f"Model {self.open_ai_model_name} is not supported with batch embedding operations"
             )
 
-        batch_token_limit = batch_info["token_limit"]
-        batch_max_size = batch_info["max_batch_size"]
+        batch_token_limit = self.model_info.token_limit
+        batch_max_size = self.model_info.max_batch_size
+        if token_lengths is None:
+            token_lengths = self.calculate_token_lengths(texts)
+        if self.first_fit_decreasing:
+            return self.pack_batches(texts, token_lengths, batch_token_limit, batch_max_size)
+
         batches: List[EmbeddingBatch] = []
-        batch: List[str] = []
+        batch: List[int] = []
         batch_token_length = 0
-        for text in texts:
-            text_token_length = self.calculate_token_length(text)
+        for index, text_token_length in enumerate(token_lengths):
             if batch_token_length + text_token_length >= batch_token_limit and len(batch) > 0:
-                batches.append(EmbeddingBatch(batch, batch_token_length))
+                batches.append(EmbeddingBatch([texts[i] for i in batch], batch_token_length, batch))
                 batch = []
                 batch_token_length = 0
 
-            batch.append(text)
+            batch.append(index)
             batch_token_length = batch_token_length + text_token_length
             if len(batch) == batch_max_size:
-                batches.append(EmbeddingBatch(batch, batch_token_length))
+                batches.append(EmbeddingBatch([texts[i] for i in batch], batch_token_length, batch))
                 batch = []
                 batch_token_length = 0
 
         if len(batch) > 0:
-            batches.append(EmbeddingBatch(batch, batch_token_length))
+            batches.append(EmbeddingBatch([texts[i] for i in batch], batch_token_length, batch))
 
         return batches
 
-    async def create_embedding_batch(self, texts: List[str]) -> List[List[float]]:
-        batches = self.split_text_into_batches(texts)
-        embeddings = []
-        client = await self.create_client()
-        for batch in batches:
-            async for attempt in AsyncRetrying(
-                retry=retry_if_exception_type(RateLimitError),
-                wait=wait_random_exponential(min=15, max=60),
-                stop=stop_after_attempt(15),
-                before_sleep=self.before_retry_sleep,
-            ):
-                with attempt:
-                    emb_response = await client.embeddings.create(model=self.open_ai_model_name, input=batch.texts)
-                    embeddings.extend([data.embedding for data in emb_response.data])
-                    if self.verbose:
-                        print(f"Batch Completed. Batch size  {len(batch.texts)} Token count {batch.token_length}")
-
+    def pack_batches(
+        self, texts: List[str], token_lengths: List[int], batch_token_limit: int, batch_max_size: int
+    ) -> List[EmbeddingBatch]:
+        # First-fit-decreasing: place the longest texts first, each into the first batch that still has room
+        batch_indices: List[List[int]] = []
+        batch_token_lengths: List[int] = []
+        for index in sorted(range(len(texts)), key=lambda i: token_lengths[i], reverse=True):
+            for batch_number, batch in enumerate(batch_indices):
+                if (
+                    len(batch) < batch_max_size
+                    and batch_token_lengths[batch_number] + token_lengths[index] < batch_token_limit
+                ):
+                    batch.append(index)
+                    batch_token_lengths[batch_number] += token_lengths[index]
+                    break
+            else:
+                batch_indices.append([index])
+                batch_token_lengths.append(token_lengths[index])
+
+        return [
+            EmbeddingBatch([texts[i] for i in batch], batch_token_length, batch)
+            for batch, batch_token_length in zip(batch_indices, batch_token_lengths)
+        ]
+
+    async def create_embedding_batch(
+        self, texts: List[str], token_lengths: Optional[List[int]] = None
+    ) -> List[List[float]]:
+        batches = self.split_text_into_batches(texts, token_lengths)
+        client = await self.get_client()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def embed_batch(batch: EmbeddingBatch) -> List[List[float]]:
+            async with semaphore:
+                async for attempt in AsyncRetrying(
+                    retry=retry_if_exception_type(RateLimitError),
+                    wait=self.retry_wait,
+                    stop=stop_after_attempt(15),
+                    before_sleep=self.before_retry_sleep,
+                ):
+                    with attempt:
+                        await self.rate_limiter.acquire(batch.token_length)
+                        emb_response = await self.request_embeddings(client, batch.texts)
+                if self.verbose:
+                    print(f"Batch Completed. Batch size  {len(batch.texts)} Token count {batch.token_length}")
+                return [data.embedding for data in sorted(emb_response.data, key=lambda data: data.index)]
+
+        batch_embeddings = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        # Batches can be packed out of order, so each embedding goes back to the position of its text
+        embeddings: List[List[float]] = [[] for _ in texts]
+        for batch, embeddings_of_batch in zip(batches, batch_embeddings):
+            for index, embedding in zip(batch.indices, embeddings_of_batch):
+                embeddings[index] = embedding
         return embeddings
 
     async def create_embedding_single(self, text: str) -> List[float]:
-        client = await self.create_client()
+        client = await self.get_client()
         async for attempt in AsyncRetrying(
             retry=retry_if_exception_type(RateLimitError),
-            wait=wait_random_exponential(min=15, max=60),
+            wait=self.retry_wait,
             stop=stop_after_attempt(15),
             before_sleep=self.before_retry_sleep,
         ):
             with attempt:
-                emb_response = await client.embeddings.create(model=self.open_ai_model_name, input=text)
+                await self.rate_limiter.acquire(0)
+                emb_response = await self.request_embeddings(client, text)
 
         return emb_response.data[0].embedding
 
-    async def create_embeddings(self, texts: List[str]) -> List[List[float]]:
-        if not self.disable_batch and self.open_ai_model_name in OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL:
-            return await self.create_embedding_batch(texts)
+    async def create_embeddings(self, texts: List[str], token_lengths: Optional[List[int]] = None) -> List[List[float]]:
+        """
+        Token lengths can be passed in when the texts were already measured with this model's encoding, so they don't
+        have to be tokenized again to be batched
+        """
+        if not self.cache:
+            return await self.compute_embeddings(texts, token_lengths)
+
+        cached_embeddings = self.cache.get_embeddings(self.cache_model_name(), texts)
+        missing = [index for index, embedding in enumerate(cached_embeddings) if embedding is None]
+        if not missing:
+            return [embedding for embedding in cached_embeddings if embedding is not None]
+
+        missing_texts = [texts[index] for index in missing]
+        missing_token_lengths = [token_lengths[index] for index in missing] if token_lengths is not None else None
+        computed_embeddings = await self.compute_embeddings(missing_texts, missing_token_lengths)
+        self.cache.put_embeddings(self.cache_model_name(), missing_texts, computed_embeddings)
+        computed = iter(computed_embeddings)
+        return [embedding if embedding is not None else next(computed) for embedding in cached_embeddings]
+
+    async def compute_embeddings(
+        self, texts: List[str], token_lengths: Optional[List[int]] = None
+    ) -> List[List[float]]:
+        if not self.disable_batch and self.model_info:
+            return await self.create_embedding_batch(texts, token_lengths)
 
         return [await self.create_embedding_single(text) for text in texts]
 
@@ -134,19 +391,41 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         disable_batch: bool = False,
         verbose: bool = False,
+        cache: Optional[EmbeddingCache] = None,
+        rate_limiter: Optional[TokenBucketRateLimiter] = None,
+        max_concurrency: int = 4,
+        first_fit_decreasing: bool = False,
+        open_ai_dimensions: Optional[int] = None,
     ):
-        super().__init__(open_ai_model_name, disable_batch, verbose)
+        super().__init__(
+            open_ai_model_name,
+            disable_batch,
+            verbose,
+            cache,
+            rate_limiter,
+            max_concurrency,
+            first_fit_decreasing,
+            open_ai_dimensions,
+        )
         self.open_ai_service = open_ai_service
         self.open_ai_deployment = open_ai_deployment
         self.credential = credential
         self.cached_token: Optional[AccessToken] = None
 
     async def create_client(self) -> AsyncOpenAI:
+        if isinstance(self.credential, AzureKeyCredential):
+            return AsyncAzureOpenAI(
+                azure_endpoint=f"https://{self.open_ai_service}.openai.azure.com",
+                azure_deployment=self.open_ai_deployment,
+                api_key=self.credential.key,
+                api_version="2024-02-01",
+            )
+        # The shared client lives for the whole ingestion run, so tokens are refreshed on every request
         return AsyncAzureOpenAI(
             azure_endpoint=f"https://{self.open_ai_service}.openai.azure.com",
             azure_deployment=self.open_ai_deployment,
-            api_key=await self.wrap_credential(),
-            api_version="2023-05-15",
+            azure_ad_token_provider=self.wrap_credential,
+            api_version="2024-02-01",
         )
 
     async def wrap_credential(self) -> str:
@@ -175,8 +454,22 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         organization: Optional[str] = None,
         disable_batch: bool = False,
         verbose: bool = False,
+        cache: Optional[EmbeddingCache] = None,
+        rate_limiter: Optional[TokenBucketRateLimiter] = None,
+        max_concurrency: int = 4,
+        first_fit_decreasing: bool = False,
+        open_ai_dimensions: Optional[int] = None,
     ):
-        super().__init__(open_ai_model_name, disable_batch, verbose)
+        super().__init__(
+            open_ai_model_name,
+            disable_batch,
+            verbose,
+            cache,
+            rate_limiter,
+            max_concurrency,
+            first_fit_decreasing,
+            open_ai_dimensions,
+        )
         self.credential = credential
         self.organization = organization
 
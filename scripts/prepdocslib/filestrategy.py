@@ -4,7 +4,16 @@ from typing import List, Optional
 from .blobmanager import BlobManager
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
 from .fileprocessor import FileProcessor
+from .ingestionmanifest import IngestionManifest
+from .ingestionprofile import (
+    BLOB_UPLOAD,
+    IMAGE_EMBEDDING,
+    PARSE,
+    SPLIT,
+    IngestionProfile,
+)
 from .listfilestrategy import ListFileStrategy
+from .localindex import LocalIndex
 from .searchmanager import SearchManager, Section
 from .strategy import SearchInfo, Strategy
 
@@ -24,13 +33,16 @@ class FileStrategy(Strategy):
         self,
         list_file_strategy: ListFileStrategy,
         blob_manager: BlobManager,
-        file_processors: dict[str, FileProcessor],
+        file_processors: dict[str, Optional[FileProcessor]],
         document_action: DocumentAction = DocumentAction.Add,
         embeddings: Optional[OpenAIEmbeddings] = None,
         image_embeddings: Optional[ImageEmbeddings] = None,
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         category: Optional[str] = None,
+        manifest: Optional[IngestionManifest] = None,
+        local_index: Optional[LocalIndex] = None,
+        profile: Optional[IngestionProfile] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -41,6 +53,9 @@ class FileStrategy(Strategy):
         self.search_analyzer_name = search_analyzer_name
         self.use_acls = use_acls
         self.category = category
+        self.manifest = manifest
+        self.local_index = local_index
+        self.profile = profile or IngestionProfile()
 
     async def setup(self, search_info: SearchInfo):
         search_manager = SearchManager(
@@ -53,41 +68,59 @@ class FileStrategy(Strategy):
         await search_manager.create_index()
 
     async def run(self, search_info: SearchInfo):
-        search_manager = SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
-        if self.document_action == DocumentAction.Add:
-            files = self.list_file_strategy.list()
-            async for file in files:
-                try:
-                    key = file.file_extension()
-                    processor = self.file_processors[key]
-                    if not processor:
-                        # skip file if no parser is found
+        search_manager = SearchManager(
+            search_info,
+            self.search_analyzer_name,
+            self.use_acls,
+            self.embeddings,
+            manifest=self.manifest,
+            image_format=self.blob_manager.image_format,
+            local_index=self.local_index,
+            profile=self.profile,
+        )
+        try:
+            if self.document_action == DocumentAction.Add:
+                files = self.list_file_strategy.list()
+                async for file in files:
+                    try:
+                        key = file.file_extension()
+                        processor = self.file_processors[key]
+                        if not processor:
+                            # skip file if no parser is found
+                            if search_info.verbose:
+                                print(f"Skipping '{file.filename()}'.")
+                            continue
                         if search_info.verbose:
-                            print(f"Skipping '{file.filename()}'.")
-                        continue
-                    if search_info.verbose:
-                        print(f"Parsing '{file.filename()}'")
-                    pages = [page async for page in processor.parser.parse(content=file.content)]
-                    if search_info.verbose:
-                        print(f"Splitting '{file.filename()}' into sections")
-                    sections = [
-                        Section(split_page, content=file, category=self.category)
-                        for split_page in processor.splitter.split_pages(pages)
-                    ]
+                            print(f"Parsing '{file.filename()}' and splitting it into sections")
+                        # Pages are split as they're parsed, so splitting doesn't wait for the whole document
+                        with self.profile.stage(SPLIT):
+                            pages = self.profile.timed(PARSE, processor.parser.parse(content=file.content))
+                            sections = [
+                                Section(split_page, content=file, category=self.category)
+                                async for split_page in processor.splitter.split_pages_async(pages)
+                            ]
+                        self.profile.add_file(file.content, len(sections))
 
-                    blob_sas_uris = await self.blob_manager.upload_blob(file)
-                    blob_image_embeddings: Optional[List[List[float]]] = None
-                    if self.image_embeddings and blob_sas_uris:
-                        blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
-                    await search_manager.update_content(sections, blob_image_embeddings)
-                finally:
-                    if file:
-                        file.close()
-        elif self.document_action == DocumentAction.Remove:
-            paths = self.list_file_strategy.list_paths()
-            async for path in paths:
-                await self.blob_manager.remove_blob(path)
-                await search_manager.remove_content(path)
-        elif self.document_action == DocumentAction.RemoveAll:
-            await self.blob_manager.remove_blob()
-            await search_manager.remove_content()
+                        with self.profile.stage(BLOB_UPLOAD):
+                            blob_sas_uris = await self.blob_manager.upload_blob(file)
+                        blob_image_embeddings: Optional[List[List[float]]] = None
+                        if self.image_embeddings and blob_sas_uris:
+                            with self.profile.stage(IMAGE_EMBEDDING):
+                                blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
+                        await search_manager.update_content(sections, blob_image_embeddings)
+                    finally:
+                        if file:
+                            file.close()
+            elif self.document_action == DocumentAction.Remove:
+                paths = self.list_file_strategy.list_paths()
+                async for path in paths:
+                    await self.blob_manager.remove_blob(path)
+                    await search_manager.remove_content(path)
+            elif self.document_action == DocumentAction.RemoveAll:
+                await self.blob_manager.remove_blob()
+                await search_manager.remove_content()
+        finally:
+            # The blob session is shared by every file of the run, so it's only closed once they're all done
+            await self.blob_manager.close()
+            if self.local_index:
+                self.local_index.save()
@@ -0,0 +1,127 @@
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+class IndexSnapshot:
+    """
+    Documents of a search index stored column by column in a single compressed NumPy archive
+    Vector fields are float32 matrices, integer fields int64 arrays, and text fields UTF-8 bytes with an offset per
+    document. Any other field (such as a collection) is stored as JSON text. Every column has a mask of the documents
+    that have a value for it, so missing fields and nulls come back as they were
+    """
+
+    VERSION = 1
+    VECTOR_FIELDS = ["embedding", "imageEmbedding"]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.archive = np.load(path)
+        schema = json.loads(self.archive["schema"].tobytes().decode("utf-8"))
+        if schema["version"] != self.VERSION:
+            raise ValueError(f"Unsupported snapshot version {schema['version']} in {path}")
+        self.count: int = schema["count"]
+        self.fields: Dict[str, str] = schema["fields"]
+        self.columns: Dict[str, Dict[str, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return self.count
+
+    def dimensions(self, field: str) -> Optional[int]:
+        if self.fields.get(field) != "vector":
+            return None
+        return int(self.column(field)["values"].shape[1])
+
+    def column(self, field: str) -> Dict[str, np.ndarray]:
+        # Arrays are decompressed from the archive on first use, so reading it in slices only does that once
+        if field not in self.columns:
+            self.columns[field] = {
+                part: self.archive[f"{field}.{part}"]
+                for part in ("values", "offsets", "present")
+                if f"{field}.{part}" in self.archive
+            }
+        return self.columns[field]
+
+    def read_documents(self, start: int = 0, stop: Optional[int] = None) -> List[Dict[str, Any]]:
+        stop = self.count if stop is None else min(stop, self.count)
+        documents: List[Dict[str, Any]] = [{} for _ in range(start, stop)]
+        for field, kind in self.fields.items():
+            column = self.column(field)
+            present = column["present"]
+            values = column["values"]
+            for row in range(start, stop):
+                if not present[row]:
+                    continue
+                if kind == "vector":
+                    value: Any = values[row].tolist()
+                elif kind == "int":
+                    value = int(values[row])
+                else:
+                    offsets = column["offsets"]
+                    value = values[offsets[row] : offsets[row + 1]].tobytes().decode("utf-8")
+                    if kind == "json":
+                        value = json.loads(value)
+                documents[row - start][field] = value
+        return documents
+
+    @classmethod
+    def save(cls, path: str, documents: List[Dict[str, Any]]):
+        fields: Dict[str, str] = {}
+        for document in documents:
+            for field, value in document.items():
+                if value is not None:
+                    fields[field] = cls.merge_kind(fields.get(field), cls.value_kind(field, value))
+        arrays: Dict[str, np.ndarray] = {}
+        for field, kind in fields.items():
+            present = np.array([document.get(field) is not None for document in documents], dtype=bool)
+            arrays[f"{field}.present"] = present
+            if kind == "vector":
+                dimensions = next(len(document[field]) for document in documents if document.get(field) is not None)
+                vectors = np.zeros((len(documents), dimensions), dtype=np.float32)
+                for row, document in enumerate(documents):
+                    if present[row]:
+                        vectors[row] = document[field]
+                arrays[f"{field}.values"] = vectors
+            elif kind == "int":
+                arrays[f"{field}.values"] = np.array(
+                    [document[field] if present[row] else 0 for row, document in enumerate(documents)], dtype=np.int64
+                )
+            else:
+                encoded = [
+                    (
+                        (document[field] if kind == "string" else json.dumps(document[field])).encode("utf-8")
+                        if present[row]
+                        else b""
+                    )
+                    for row, document in enumerate(documents)
+                ]
+                arrays[f"{field}.offsets"] = np.cumsum([0] + [len(value) for value in encoded], dtype=np.int64)
+                arrays[f"{field}.values"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        schema = {"version": cls.VERSION, "count": len(documents), "fields": fields}
+        arrays["schema"] = np.frombuffer(json.dumps(schema).encode("utf-8"), dtype=np.uint8)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Written to a temporary file first so an interrupted export can't leave a truncated snapshot behind
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as snapshot_file:
+            np.savez_compressed(snapshot_file, **arrays)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def value_kind(cls, field: str, value: Any) -> str:
+        if field in cls.VECTOR_FIELDS and isinstance(value, list):
+            return "vector"
+        if isinstance(value, int) and not isinstance(value, bool):
+            return "int"
+        if isinstance(value, str):
+            return "string"
+        return "json"
+
+    @classmethod
+    def merge_kind(cls, kind: Optional[str], value_kind: str) -> str:
+        # A field whose values don't all have the same type is kept as JSON, which preserves each of them
+        return value_kind if kind is None or kind == value_kind else "json"
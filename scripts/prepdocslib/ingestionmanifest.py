@@ -0,0 +1,41 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+
+class IngestionManifest:
+    """
+    Record of the search document ids that were indexed for each source file, kept per search index
+    Lets a file's sections be removed by key, without searching the index for them first
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.indexes: Dict[str, Dict[str, List[str]]] = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as manifest_file:
+                self.indexes = json.load(manifest_file)
+
+    def get_ids(self, index_name: str, sourcefile: str) -> Optional[List[str]]:
+        return self.indexes.get(index_name, {}).get(sourcefile)
+
+    def set_ids(self, index_name: str, sourcefile: str, ids: List[str]):
+        self.indexes.setdefault(index_name, {})[sourcefile] = ids
+        self.save()
+
+    def remove(self, index_name: str, sourcefile: Optional[str] = None):
+        if sourcefile is None:
+            self.indexes.pop(index_name, None)
+        else:
+            self.indexes.get(index_name, {}).pop(sourcefile, None)
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Written to a temporary file first so an interrupted run can't leave a truncated manifest behind
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(self.indexes, manifest_file)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,140 @@
+import cProfile
+import os
+import time
+from contextlib import contextmanager
+from typing import IO, AsyncGenerator, Dict, Iterator, List, TypeVar
+
+# Stages of ingesting a file, in the order they happen
+PARSE = "parse"
+SPLIT = "split"
+BLOB_UPLOAD = "blob_upload"
+IMAGE_EMBEDDING = "image_embedding"
+EMBEDDING = "embedding"
+INDEXING = "indexing"
+STAGES = [PARSE, SPLIT, BLOB_UPLOAD, IMAGE_EMBEDDING, EMBEDDING, INDEXING]
+
+T = TypeVar("T")
+
+
+class StageTime:
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.calls = 0
+
+
+class IngestionProfile:
+    """
+    Time spent in each stage of ingesting files, split into the CPU time of this process and the time spent waiting
+    Stages can be nested, such as parsing inside splitting, and each stage only counts the time outside the stages
+    nested in it. Files are processed one at a time, so stages never overlap
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, StageTime] = {stage: StageTime() for stage in STAGES}
+        self.files = 0
+        self.bytes = 0
+        self.sections = 0
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        # Time of the stages nested in each running stage, which is subtracted from it
+        self.nested: List[List[float]] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        self.nested.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            nested_wall, nested_cpu = self.nested.pop()
+            stage = self.stages.setdefault(name, StageTime())
+            stage.wall += wall - nested_wall
+            stage.cpu += cpu - nested_cpu
+            stage.calls += 1
+            if self.nested:
+                self.nested[-1][0] += wall
+                self.nested[-1][1] += cpu
+
+    async def timed(self, name: str, items: AsyncGenerator[T, None]) -> AsyncGenerator[T, None]:
+        # Times producing each item, such as each page of a parser, without the time the consumer spends on it
+        iterator = items.__aiter__()
+        while True:
+            with self.stage(name):
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield item
+
+    def add_file(self, content: IO, sections: int):
+        position = content.tell()
+        content.seek(0, os.SEEK_END)
+        self.bytes += content.tell()
+        content.seek(position)
+        self.files += 1
+        self.sections += sections
+
+    def metrics(self) -> Dict[str, float]:
+        wall = time.perf_counter() - self.start_wall
+        metrics = {
+            "total_seconds": wall,
+            "total_cpu_seconds": time.process_time() - self.start_cpu,
+            "files_per_second": self.files / wall if wall else 0.0,
+            "sections_per_second": self.sections / wall if wall else 0.0,
+            "bytes_per_second": self.bytes / wall if wall else 0.0,
+        }
+        for name, stage in self.stages.items():
+            metrics[f"{name}_seconds"] = stage.wall
+            metrics[f"{name}_cpu_seconds"] = stage.cpu
+        return metrics
+
+    def report(self) -> str:
+        metrics = self.metrics()
+        wall = metrics["total_seconds"]
+        lines = [
+            f"Ingested {self.files} files ({self.bytes / 1e6:.1f} MB) into {self.sections} sections in {wall:.1f}s: "
+            f"{metrics['files_per_second']:.2f} files/s, {metrics['sections_per_second']:.1f} sections/s, "
+            f"{metrics['bytes_per_second'] / 1e3:.0f} kB/s",
+            f"{'stage':<16} {'calls':>7} {'seconds':>9} {'cpu':>9} {'wait':>9} {'share':>6}",
+        ]
+        for name, stage in self.stages.items():
+            if not stage.calls:
+                continue
+            lines.append(
+                f"{name:<16} {stage.calls:>7} {stage.wall:>9.2f} {stage.cpu:>9.2f} {max(0.0, stage.wall - stage.cpu):>9.2f} "
+                f"{stage.wall / wall * 100 if wall else 0:>5.1f}%"
+            )
+        return "\n".join(lines)
+
+
+@contextmanager
+def profile_calls(path: str) -> Iterator[None]:
+    """
+    Profiles every function called in the block, written to an HTML report by pyinstrument if the path ends in .html,
+    or else as cProfile statistics for pstats or snakeviz
+    """
+    if path.endswith(".html"):
+        try:
+            from pyinstrument import Profiler
+        except ImportError as error:
+            raise ImportError("Writing an HTML profile requires pyinstrument (pip install pyinstrument)") from error
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path, "w", encoding="utf-8") as report_file:
+                report_file.write(profiler.output_html())
+    else:
+        call_profile = cProfile.Profile()
+        call_profile.enable()
+        try:
+            yield
+        finally:
+            call_profile.disable()
+            call_profile.dump_stats(path)
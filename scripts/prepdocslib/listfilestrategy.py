@@ -1,14 +1,18 @@
+import asyncio
 import base64
 import hashlib
 import os
 import re
+import shutil
 import tempfile
 from abc import ABC
+from collections import deque
 from glob import glob
-from typing import IO, AsyncGenerator, Dict, List, Optional, Union
+from typing import IO, AsyncGenerator, Deque, Dict, List, Optional, Union
 
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.storage.filedatalake.aio import (
+    DataLakeFileClient,
     DataLakeServiceClient,
 )
 
@@ -118,12 +122,14 @@ class ADLSGen2ListFileStrategy(ListFileStrategy):
         data_lake_path: str,
         credential: Union[AsyncTokenCredential, str],
         verbose: bool = False,
+        max_prefetch: int = 4,
     ):
         self.data_lake_storage_account = data_lake_storage_account
         self.data_lake_filesystem = data_lake_filesystem
         self.data_lake_path = data_lake_path
         self.credential = credential
         self.verbose = verbose
+        self.max_prefetch = max_prefetch
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
         async with DataLakeServiceClient(
@@ -136,39 +142,87 @@ class ADLSGen2ListFileStrategy(ListFileStrategy):
                 yield path.name
 
     async def list(self) -> AsyncGenerator[File, None]:
+        # Up to max_prefetch files are downloaded ahead of the one being processed, so the next file is usually ready
+        # as soon as the caller asks for it. Each file is downloaded into its own folder of a temporary directory
+        # (files from different folders can have the same name) and deleted once the caller has moved on
         async with DataLakeServiceClient(
             account_url=f"https://{self.data_lake_storage_account}.dfs.core.windows.net", credential=self.credential
         ) as service_client, service_client.get_file_system_client(self.data_lake_filesystem) as filesystem_client:
-            async for path in self.list_paths():
-                temp_file_path = os.path.join(tempfile.gettempdir(), os.path.basename(path))
+            with tempfile.TemporaryDirectory() as temp_dir:
+                paths = self.list_paths().__aiter__()
+                downloads: Deque[asyncio.Task] = deque()
+                listed_all_paths = False
+                listed_count = 0
                 try:
-                    async with filesystem_client.get_file_client(path) as file_client:
-                        with open(temp_file_path, "wb") as temp_file:
-                            downloader = await file_client.download_file()
-                            await downloader.readinto(temp_file)
-                    # Parse out user ids and group ids
-                    acls: Dict[str, List[str]] = {"oids": [], "groups": []}
-                    # https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
-                    # Request ACLs as GUIDs
-                    access_control = await file_client.get_access_control(upn=False)
-                    acl_list = access_control["acl"]
-                    # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
-                    # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
-                    acl_list = acl_list.split(",")
-                    for acl in acl_list:
-                        acl_parts: list = acl.split(":")
-                        if len(acl_parts) != 3:
+                    while True:
+                        while not listed_all_paths and len(downloads) < self.max_prefetch:
+                            try:
+                                path = await paths.__anext__()
+                            except StopAsyncIteration:
+                                listed_all_paths = True
+                                break
+                            download_dir = os.path.join(temp_dir, str(listed_count))
+                            listed_count += 1
+                            file_client = filesystem_client.get_file_client(path)
+                            downloads.append(asyncio.create_task(self.download_file(file_client, path, download_dir)))
+                        if not downloads:
+                            break
+                        file = await downloads.popleft()
+                        if file is None:
                             continue
-                        if len(acl_parts[1]) == 0:
-                            continue
-                        if acl_parts[0] == "user" and "r" in acl_parts[2]:
-                            acls["oids"].append(acl_parts[1])
-                        if acl_parts[0] == "group" and "r" in acl_parts[2]:
-                            acls["groups"].append(acl_parts[1])
-                    yield File(content=open(temp_file_path, "rb"), acls=acls)
-                except Exception as data_lake_exception:
-                    print(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
-                    try:
-                        os.remove(temp_file_path)
-                    except Exception as file_delete_exception:
-                        print(f"\tGot an error while deleting {temp_file_path} -> {file_delete_exception}")
+                        try:
+                            yield file
+                        finally:
+                            file.close()
+                            shutil.rmtree(os.path.dirname(file.content.name), ignore_errors=True)
+                finally:
+                    # The caller stopped early, so the downloads still running are cancelled and waited for, so none
+                    # of them writes into the temporary directory as it's deleted, and files downloaded ahead are closed
+                    for download in downloads:
+                        download.cancel()
+                    for result in await asyncio.gather(*downloads, return_exceptions=True):
+                        if isinstance(result, File):
+                            result.close()
+
+    async def download_file(self, file_client: DataLakeFileClient, path: str, download_dir: str) -> Optional[File]:
+        temp_file_path = os.path.join(download_dir, os.path.basename(path))
+        try:
+            os.makedirs(download_dir, exist_ok=True)
+            async with file_client:
+
+                async def download():
+                    with open(temp_file_path, "wb") as temp_file:
+                        downloader = await file_client.download_file()
+                        await downloader.readinto(temp_file)
+
+                # The ACLs are requested while the file is downloading
+                # Request ACLs as GUIDs, see https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
+                access_control_request = file_client.get_access_control(upn=False)  # type: ignore[misc]
+                _, access_control = await asyncio.gather(download(), access_control_request)
+            if self.verbose:
+                print(f"\tDownloaded {path}")
+            return File(
+                content=open(temp_file_path, "rb"), acls=ADLSGen2ListFileStrategy.parse_acls(access_control["acl"])
+            )
+        except Exception as data_lake_exception:
+            print(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
+            shutil.rmtree(download_dir, ignore_errors=True)
+            return None
+
+    @classmethod
+    def parse_acls(cls, acl_list: str) -> Dict[str, List[str]]:
+        # Parse out user ids and group ids
+        acls: Dict[str, List[str]] = {"oids": [], "groups": []}
+        # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
+        # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
+        for acl in acl_list.split(","):
+            acl_parts: list = acl.split(":")
+            if len(acl_parts) != 3:
+                continue
+            if len(acl_parts[1]) == 0:
+                continue
+            if acl_parts[0] == "user" and "r" in acl_parts[2]:
+                acls["oids"].append(acl_parts[1])
+            if acl_parts[0] == "group" and "r" in acl_parts[2]:
+                acls["groups"].append(acl_parts[1])
+        return acls
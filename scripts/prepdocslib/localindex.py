@@ -0,0 +1,79 @@
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+class LocalIndex:
+    """
+    Copy of the search documents kept in a folder, which the app can search in its own process instead of Azure AI Search
+    The fields are stored as JSON and each vector field as a float32 NumPy matrix with a row per document, so the app
+    can memory-map the vectors instead of reading them all into memory
+    """
+
+    DOCUMENTS_FILE = "documents.json"
+    VECTOR_FIELDS = {"embedding": "embedding.npy", "imageEmbedding": "imageEmbedding.npy"}
+
+    def __init__(self, path: str):
+        self.path = path
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        documents_path = os.path.join(self.path, self.DOCUMENTS_FILE)
+        if os.path.exists(documents_path):
+            with open(documents_path, encoding="utf-8") as documents_file:
+                documents = json.load(documents_file)
+            for field, file_name in self.VECTOR_FIELDS.items():
+                vectors_path = os.path.join(self.path, file_name)
+                if os.path.exists(vectors_path):
+                    vectors = np.load(vectors_path)
+                    for document, vector in zip(documents, vectors):
+                        if vector.any():
+                            document[field] = vector.tolist()
+            self.documents = {document["id"]: document for document in documents}
+
+    def upload_documents(self, documents: List[Dict[str, Any]]):
+        # Like uploads to the search service, a document replaces any document with the same id
+        for document in documents:
+            self.documents[document["id"]] = document
+
+    def delete_documents(self, ids: List[str]):
+        for id in ids:
+            self.documents.pop(id, None)
+
+    def remove(self, sourcefile: Optional[str] = None):
+        if sourcefile is None:
+            self.documents = {}
+        else:
+            self.documents = {
+                id: document for id, document in self.documents.items() if document.get("sourcefile") != sourcefile
+            }
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        documents = list(self.documents.values())
+        for field, file_name in self.VECTOR_FIELDS.items():
+            vectors_path = os.path.join(self.path, file_name)
+            dimensions = next((len(document[field]) for document in documents if document.get(field)), None)
+            if dimensions is None:
+                if os.path.exists(vectors_path):
+                    os.remove(vectors_path)
+                continue
+            # Documents without a vector get a row of zeros, which the app never matches
+            vectors = np.zeros((len(documents), dimensions), dtype=np.float32)
+            for row, document in enumerate(documents):
+                if document.get(field):
+                    vectors[row] = document[field]
+            self.write(file_name, lambda file: np.save(file, vectors))
+        fields = [
+            {field: value for field, value in document.items() if field not in self.VECTOR_FIELDS}
+            for document in documents
+        ]
+        self.write(self.DOCUMENTS_FILE, lambda file: file.write(json.dumps(fields).encode("utf-8")))
+
+    def write(self, file_name: str, write):
+        # Written to a temporary file first so an interrupted run can't leave a truncated file behind
+        path = os.path.join(self.path, file_name)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as file:
+            write(file)
+        os.replace(temp_path, path)
@@ -1,3 +1,6 @@
+from typing import List, Optional
+
+
 class Page:
     """
     A single page from a document
@@ -17,10 +20,40 @@ class Page:
 class SplitPage:
     """
     A section of a page that has been split into a smaller chunk.
+    The token count is only known when the splitter measured the section in tokens of the embedding model
+    Sections of the time schedule also carry the course, meetings, instructors, credits and kinds of sections of their class
     """
 
-    def __init__(self, page_num: int, text: str, level: int, major:str):
+    def __init__(
+        self,
+        page_num: int,
+        text: str,
+        level: int = -1,
+        major: str = "",
+        token_count: Optional[int] = None,
+        course_code: str = "",
+        days: Optional[List[str]] = None,
+        times: Optional[List[str]] = None,
+        instructors: Optional[List[str]] = None,
+        day_mask: int = 0,
+        start_minutes: Optional[int] = None,
+        end_minutes: Optional[int] = None,
+        min_credits: Optional[int] = None,
+        max_credits: Optional[int] = None,
+        section_types: Optional[List[str]] = None,
+    ):
         self.page_num = page_num
         self.text = text
         self.level = level
         self.major = major
+        self.token_count = token_count
+        self.course_code = course_code
+        self.days = days or []
+        self.times = times or []
+        self.instructors = instructors or []
+        self.day_mask = day_mask
+        self.start_minutes = start_minutes
+        self.end_minutes = end_minutes
+        self.min_credits = min_credits
+        self.max_credits = max_credits
+        self.section_types = section_types or []
@@ -1,7 +1,11 @@
 import asyncio
+import json
 import os
-from typing import List, Optional
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
 
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import (
     HnswParameters,
     HnswVectorSearchAlgorithmConfiguration,
@@ -20,8 +24,11 @@ from azure.search.documents.indexes.models import (
 )
 
 from .blobmanager import BlobManager
-from .embeddings import OpenAIEmbeddings
+from .embeddings import DEFAULT_EMBEDDING_DIMENSIONS, OpenAIEmbeddings
+from .ingestionmanifest import IngestionManifest
+from .ingestionprofile import EMBEDDING, INDEXING, IngestionProfile
 from .listfilestrategy import File
+from .localindex import LocalIndex
 from .strategy import SearchInfo
 from .textsplitter import SplitPage
 
@@ -43,6 +50,13 @@ class SearchManager:
     To learn more, please visit https://learn.microsoft.com/azure/search/search-what-is-azure-search
     """
 
+    # Limits of a single indexing request, see https://learn.microsoft.com/azure/search/search-limits-quotas-capacity#api-request-limits
+    MAX_BATCH_SIZE = 1000
+    MAX_BATCH_BYTES = 8 * 1024 * 1024
+    MAX_SEARCH_RESULTS = 100000
+    # Status codes of documents (or whole requests) that can succeed when they are sent again
+    RETRYABLE_STATUS_CODES = {409, 422, 503}
+
     def __init__(
         self,
         search_info: SearchInfo,
@@ -50,17 +64,34 @@ class SearchManager:
         use_acls: bool = False,
         embeddings: Optional[OpenAIEmbeddings] = None,
         search_images: bool = False,
+        max_upload_concurrency: int = 4,
+        max_upload_attempts: int = 5,
+        manifest: Optional[IngestionManifest] = None,
+        image_format: str = "png",
+        local_index: Optional[LocalIndex] = None,
+        embedding_dimensions: Optional[int] = None,
+        profile: Optional[IngestionProfile] = None,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
         self.use_acls = use_acls
         self.embeddings = embeddings
         self.search_images = search_images
+        self.max_upload_concurrency = max_upload_concurrency
+        self.max_upload_attempts = max_upload_attempts
+        self.manifest = manifest
+        self.image_format = image_format
+        self.local_index = local_index
+        self.embedding_dimensions = embedding_dimensions
+        self.profile = profile or IngestionProfile()
 
     async def create_index(self):
         if self.search_info.verbose:
             print(f"Ensuring search index {self.search_info.index_name} exists")
 
+        embedding_dimensions = self.embedding_dimensions or (
+            self.embeddings.embedding_dimensions() if self.embeddings else DEFAULT_EMBEDDING_DIMENSIONS
+        )
         async with self.search_info.create_search_index_client() as search_index_client:
             fields = [
                 SimpleField(name="id", type="Edm.String", key=True),
@@ -73,16 +104,34 @@ class SearchManager:
                     filterable=False,
                     sortable=False,
                     facetable=False,
-                    vector_search_dimensions=1536,
+                    vector_search_dimensions=embedding_dimensions,
                     vector_search_profile="embedding_config",
                 ),
                 SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(name="sourcepage", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True),
                 # Add level field to the index
-                SimpleField(name="level", type="Edm.Int32", filterable=True, facetable=True, sortable=True, searchable=True),
+                SimpleField(
+                    name="level", type="Edm.Int32", filterable=True, facetable=True, sortable=True, searchable=True
+                ),
                 # Add major field to the index
-                SimpleField(name="major", type="Edm.String", filterable=True, facetable=True, sortable=True, searchable=True),
+                SimpleField(
+                    name="major", type="Edm.String", filterable=True, facetable=True, sortable=True, searchable=True
+                ),
+                # Meetings of the classes in the time schedule: the days as a bitmask (Monday is 1, Tuesday 2, and so
+                # on) and the earliest start and latest end in minutes after midnight
+                SimpleField(name="meetingDays", type="Edm.Int32", filterable=True, facetable=True),
+                SimpleField(name="startMinutes", type="Edm.Int32", filterable=True, sortable=True),
+                SimpleField(name="endMinutes", type="Edm.Int32", filterable=True, sortable=True),
+                SearchableField(name="instructors", collection=True, filterable=True, facetable=True),
+                SimpleField(name="minCredits", type="Edm.Int32", filterable=True, sortable=True),
+                SimpleField(name="maxCredits", type="Edm.Int32", filterable=True, sortable=True),
+                SimpleField(
+                    name="sectionTypes",
+                    type=SearchFieldDataType.Collection(SearchFieldDataType.String),
+                    filterable=True,
+                    facetable=True,
+                ),
             ]
             if self.use_acls:
                 fields.append(
@@ -119,7 +168,8 @@ class SearchManager:
                             name="default",
                             prioritized_fields=PrioritizedFields(
                                 # TODO maybe need a change here?
-                                title_field=None, prioritized_content_fields=[SemanticField(field_name="content")]
+                                title_field=None,
+                                prioritized_content_fields=[SemanticField(field_name="content")],
                             ),
                         )
                     ]
@@ -149,57 +199,234 @@ class SearchManager:
                     print(f"Search index {self.search_info.index_name} already exists")
 
     async def update_content(self, sections: List[Section], image_embeddings: Optional[List[List[float]]] = None):
-        MAX_BATCH_SIZE = 1000
-        section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
+        documents = [
+            {
+                "id": f"{section.content.filename_to_id()}-page-{section_index}",
+                "content": section.split_page.text,
+                "level": section.split_page.level,
+                "major": section.split_page.major.lower(),
+                "meetingDays": section.split_page.day_mask or None,
+                "startMinutes": section.split_page.start_minutes,
+                "endMinutes": section.split_page.end_minutes,
+                "instructors": section.split_page.instructors,
+                "minCredits": section.split_page.min_credits,
+                "maxCredits": section.split_page.max_credits,
+                "sectionTypes": section.split_page.section_types,
+                "category": section.category,
+                "sourcepage": (
+                    BlobManager.blob_image_name_from_file_page(
+                        filename=section.content.filename(),
+                        page=section.split_page.page_num,
+                        image_format=self.image_format,
+                    )
+                    if image_embeddings
+                    else BlobManager.sourcepage_from_file_page(
+                        filename=section.content.filename(), page=section.split_page.page_num
+                    )
+                ),
+                "sourcefile": section.content.filename(),
+                **section.content.acls,
+            }
+            for section_index, section in enumerate(sections)
+        ]
+        if self.embeddings and sections:
+            # Splitters that measure sections in tokens already know their lengths, which saves tokenizing them again
+            token_lengths = [section.split_page.token_count for section in sections]
+            with self.profile.stage(EMBEDDING):
+                embeddings = await self.embeddings.create_embeddings(
+                    texts=[section.split_page.text for section in sections],
+                    token_lengths=(
+                        [token_count for token_count in token_lengths if token_count is not None]
+                        if None not in token_lengths
+                        else None
+                    ),
+                )
+            for i, document in enumerate(documents):
+                document["embedding"] = embeddings[i]
+        if image_embeddings:
+            for document, section in zip(documents, sections):
+                document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
 
+        with self.profile.stage(INDEXING):
+            await self.upload_documents(documents)
+            if self.manifest:
+                await self.update_manifest(self.manifest, documents)
+            if self.local_index:
+                # The sections of a file all come in one call, so any left from a previous version of it are outdated
+                for sourcefile in {document["sourcefile"] for document in documents}:
+                    self.local_index.remove(sourcefile)
+                self.local_index.upload_documents(documents)
+
+    async def import_documents(self, documents: List[Dict[str, Any]]):
+        # Documents that were already indexed somewhere keep their ids and embeddings, so they're only uploaded
+        await self.upload_documents(documents)
+        if self.manifest:
+            ids_by_sourcefile: Dict[str, List[str]] = {}
+            for document in documents:
+                if document.get("sourcefile"):
+                    ids_by_sourcefile.setdefault(document["sourcefile"], []).append(document["id"])
+            for sourcefile, ids in ids_by_sourcefile.items():
+                known_ids = self.manifest.get_ids(self.search_info.index_name, sourcefile) or []
+                self.manifest.set_ids(self.search_info.index_name, sourcefile, list(dict.fromkeys(known_ids + ids)))
+        if self.local_index:
+            self.local_index.upload_documents(documents)
+
+    async def export_documents(self) -> List[Dict[str, Any]]:
+        # Every retrievable field is returned, embeddings included. A single search stops paging at 100,000 results,
+        # so larger indexes are exported one source file at a time (the id field is neither filterable nor sortable)
         async with self.search_info.create_search_client() as search_client:
-            for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{section.content.filename_to_id()}-page-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section.split_page.text,
-                        "level": section.split_page.level,
-                        "major": section.split_page.major.lower(),
-                        "category": section.category,
-                        "sourcepage": (
-                            BlobManager.blob_image_name_from_file_page(
-                                filename=section.content.filename(), page=section.split_page.page_num
-                            )
-                            if image_embeddings
-                            else BlobManager.sourcepage_from_file_page(
-                                filename=section.content.filename(), page=section.split_page.page_num
-                            )
-                        ),
-                        "sourcefile": section.content.filename(),
-                        **section.content.acls,
-                    }
-                    for section_index, section in enumerate(batch)
+            count = await search_client.get_document_count()
+            if count <= self.MAX_SEARCH_RESULTS:
+                documents = await self.search_documents(search_client)
+            else:
+                results = await search_client.search("", facets=[f"sourcefile,count:{count}"], top=0)
+                facets = await results.get_facets() or {}
+                filters = ["sourcefile eq null"] + [
+                    "sourcefile eq '{}'".format(facet["value"].replace("'", "''"))
+                    for facet in facets.get("sourcefile", [])
                 ]
-                if self.embeddings:
-                    embeddings = await self.embeddings.create_embeddings(
-                        texts=[section.split_page.text for section in batch]
-                    )
-                    for i, document in enumerate(documents):
-                        document["embedding"] = embeddings[i]
-                if image_embeddings:
-                    for i, (document, section) in enumerate(zip(documents, batch)):
-                        document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
+                documents = []
+                for filter in filters:
+                    documents.extend(await self.search_documents(search_client, filter))
+            if len(documents) != count:
+                raise ValueError(f"Exported {len(documents)} documents but the index holds {count}")
+            return documents
+
+    async def search_documents(self, search_client: SearchClient, filter: Optional[str] = None) -> List[Dict[str, Any]]:
+        results = await search_client.search("", filter=filter)
+        return [
+            {field: value for field, value in document.items() if not field.startswith("@search.")}
+            async for document in results
+        ]
+
+    async def update_manifest(self, manifest: IngestionManifest, documents: List[Dict[str, Any]]):
+        # A file that now has fewer sections than when it was last indexed leaves sections behind, so those are removed
+        ids_by_sourcefile: Dict[str, List[str]] = {}
+        for document in documents:
+            ids_by_sourcefile.setdefault(document["sourcefile"], []).append(document["id"])
+        for sourcefile, ids in ids_by_sourcefile.items():
+            stale_ids = set(manifest.get_ids(self.search_info.index_name, sourcefile) or []) - set(ids)
+            if stale_ids:
+                if self.search_info.verbose:
+                    print(f"\tRemoving {len(stale_ids)} outdated sections of '{sourcefile}'")
+                await self.delete_documents(sorted(stale_ids))
+            manifest.set_ids(self.search_info.index_name, sourcefile, ids)
+
+    def split_documents_into_batches(self, documents: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        # Vectors make documents large, so batches are limited by their JSON payload size as well as their length
+        batches: List[List[Dict[str, Any]]] = []
+        batch: List[Dict[str, Any]] = []
+        batch_bytes = 0
+        for document in documents:
+            document_bytes = len(json.dumps(document))
+            if batch and (len(batch) == self.MAX_BATCH_SIZE or batch_bytes + document_bytes > self.MAX_BATCH_BYTES):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(document)
+            batch_bytes += document_bytes
+        if batch:
+            batches.append(batch)
+        return batches
 
-                await search_client.upload_documents(documents)
+    async def run_batches(
+        self, documents: List[Dict[str, Any]], send_batch: Callable[[List[Dict[str, Any]]], Awaitable[int]]
+    ) -> int:
+        semaphore = asyncio.Semaphore(self.max_upload_concurrency)
+
+        async def run_batch(batch: List[Dict[str, Any]]) -> int:
+            async with semaphore:
+                return await send_batch(batch)
+
+        counts = await asyncio.gather(*(run_batch(batch) for batch in self.split_documents_into_batches(documents)))
+        return sum(counts)
+
+    async def upload_documents(self, documents: List[Dict[str, Any]]):
+        start_time = time.monotonic()
+        async with self.search_info.create_search_client() as search_client:
+            indexed = await self.run_batches(documents, lambda batch: self.upload_batch(search_client, batch))
+
+        elapsed = time.monotonic() - start_time
+        if indexed < len(documents):
+            print(f"\tFailed to index {len(documents) - indexed} of {len(documents)} sections")
+        if self.search_info.verbose and documents:
+            print(f"\tIndexed {indexed} sections in {elapsed:.1f}s ({indexed / max(elapsed, 1e-6):.1f} docs/sec)")
+
+    async def delete_documents(self, ids: List[str], search_client: Optional[SearchClient] = None) -> int:
+        if search_client is None:
+            async with self.search_info.create_search_client() as search_client:
+                return await self.delete_documents(ids, search_client)
+        documents = [{"id": id} for id in ids]
+        return await self.run_batches(documents, lambda batch: self.delete_batch(search_client, batch))
+
+    async def upload_batch(self, search_client: SearchClient, batch: List[Dict[str, Any]]) -> int:
+        return await self.send_batch(search_client.upload_documents, batch, "index")
+
+    async def delete_batch(self, search_client: SearchClient, batch: List[Dict[str, Any]]) -> int:
+        return await self.send_batch(search_client.delete_documents, batch, "remove")
+
+    async def send_batch(self, send: Callable[..., Awaitable[Any]], batch: List[Dict[str, Any]], action: str) -> int:
+        # The whole batch is sent again if the service is unavailable, but only the failed documents if some of them
+        # couldn't be processed. Returns the number of documents that were indexed or removed
+        pending = batch
+        processed = 0
+        for attempt in range(1, self.max_upload_attempts + 1):
+            try:
+                results = await send(documents=pending)
+            except HttpResponseError as error:
+                if error.status_code not in self.RETRYABLE_STATUS_CODES or attempt == self.max_upload_attempts:
+                    raise
+                if self.search_info.verbose:
+                    print(f"\tSearch service returned {error.status_code}, retrying batch of {len(pending)} sections")
+            else:
+                failed_results = [result for result in results or [] if not result.succeeded]
+                processed += len(pending) - len(failed_results)
+                for result in failed_results:
+                    if result.status_code not in self.RETRYABLE_STATUS_CODES:
+                        print(f"\tFailed to {action} section {result.key}: {result.error_message}")
+                retry_keys = {
+                    result.key for result in failed_results if result.status_code in self.RETRYABLE_STATUS_CODES
+                }
+                if not retry_keys:
+                    return processed
+                if attempt == self.max_upload_attempts:
+                    print(f"\tGave up trying to {action} {len(retry_keys)} sections after {attempt} attempts")
+                    return processed
+                if self.search_info.verbose:
+                    print(f"\tRetrying {len(retry_keys)} sections that failed to {action}")
+                pending = [document for document in pending if document["id"] in retry_keys]
+            await asyncio.sleep(min(2**attempt, 30))
+        return processed
 
     async def remove_content(self, path: Optional[str] = None):
         if self.search_info.verbose:
             print(f"Removing sections from '{path or '<all>'}' from search index '{self.search_info.index_name}'")
+        sourcefile = None if path is None else os.path.basename(path)
+        known_ids = (
+            self.manifest.get_ids(self.search_info.index_name, sourcefile) if self.manifest and sourcefile else None
+        )
         async with self.search_info.create_search_client() as search_client:
-            while True:
-                filter = None if path is None else f"sourcefile eq '{os.path.basename(path)}'"
-                result = await search_client.search("", filter=filter, top=1000, include_total_count=True)
-                if await result.get_count() == 0:
-                    break
-                removed_docs = await search_client.delete_documents(
-                    documents=[{"id": document["id"]} async for document in result]
-                )
-                if self.search_info.verbose:
-                    print(f"\tRemoved {len(removed_docs)} sections from index")
-                # It can take a few seconds for search results to reflect changes, so wait a bit
-                await asyncio.sleep(2)
+            if known_ids is not None:
+                removed = await self.delete_documents(known_ids, search_client)
+            else:
+                removed = await self.remove_matching_content(search_client, sourcefile)
+        if self.manifest:
+            self.manifest.remove(self.search_info.index_name, sourcefile)
+        if self.local_index:
+            self.local_index.remove(sourcefile)
+        if self.search_info.verbose:
+            print(f"\tRemoved {removed} sections from index")
+
+    async def remove_matching_content(self, search_client: SearchClient, sourcefile: Optional[str] = None) -> int:
+        # Only the keys are fetched, and all pages are read before deleting so the deletes don't shift the pages.
+        # Deleted documents can show up in results for a few seconds, so ids that were already removed are skipped,
+        # and the search is repeated until it turns up nothing new (a single search stops paging at 100,000 results)
+        filter = None if sourcefile is None else f"sourcefile eq '{sourcefile}'"
+        removed_ids: Set[str] = set()
+        while True:
+            result = await search_client.search("", filter=filter, select=["id"])
+            ids = [document["id"] async for document in result if document["id"] not in removed_ids]
+            if not ids:
+                return len(removed_ids)
+            await self.delete_documents(ids, search_client)
+            removed_ids.update(ids)
@@ -0,0 +1,73 @@
+from enum import Enum
+from typing import Optional
+
+from .indexsnapshot import IndexSnapshot
+from .ingestionmanifest import IngestionManifest
+from .localindex import LocalIndex
+from .searchmanager import SearchManager
+from .strategy import SearchInfo, Strategy
+
+
+class SnapshotAction(Enum):
+    Export = 0
+    Import = 1
+
+
+class SnapshotStrategy(Strategy):
+    """
+    Strategy for copying the documents of a search index to or from a snapshot file, embeddings included
+    Importing a snapshot seeds an index without parsing, splitting or embedding the source files again
+    """
+
+    def __init__(
+        self,
+        path: str,
+        snapshot_action: SnapshotAction,
+        search_analyzer_name: Optional[str] = None,
+        max_upload_concurrency: int = 4,
+        manifest: Optional[IngestionManifest] = None,
+        local_index: Optional[LocalIndex] = None,
+    ):
+        self.path = path
+        self.snapshot_action = snapshot_action
+        self.search_analyzer_name = search_analyzer_name
+        self.max_upload_concurrency = max_upload_concurrency
+        self.manifest = manifest
+        self.local_index = local_index
+
+    def create_search_manager(self, search_info: SearchInfo, snapshot: Optional[IndexSnapshot] = None) -> SearchManager:
+        # The index fields of an import follow the snapshot, so it doesn't need the options it was indexed with
+        return SearchManager(
+            search_info,
+            self.search_analyzer_name,
+            use_acls=snapshot is not None and ("oids" in snapshot.fields or "groups" in snapshot.fields),
+            search_images=snapshot is not None and "imageEmbedding" in snapshot.fields,
+            max_upload_concurrency=self.max_upload_concurrency,
+            manifest=self.manifest,
+            local_index=self.local_index,
+            embedding_dimensions=snapshot.dimensions("embedding") if snapshot else None,
+        )
+
+    async def setup(self, search_info: SearchInfo):
+        if self.snapshot_action == SnapshotAction.Import:
+            await self.create_search_manager(search_info, IndexSnapshot(self.path)).create_index()
+
+    async def run(self, search_info: SearchInfo):
+        if self.snapshot_action == SnapshotAction.Export:
+            documents = await self.create_search_manager(search_info).export_documents()
+            IndexSnapshot.save(self.path, documents)
+            if search_info.verbose:
+                print(f"Exported {len(documents)} sections of '{search_info.index_name}' to '{self.path}'")
+            return
+
+        snapshot = IndexSnapshot(self.path)
+        search_manager = self.create_search_manager(search_info, snapshot)
+        # Read in slices that fill every concurrent upload, so the whole snapshot is never held as Python objects
+        slice_size = SearchManager.MAX_BATCH_SIZE * self.max_upload_concurrency
+        for start in range(0, len(snapshot), slice_size):
+            documents = snapshot.read_documents(start, start + slice_size)
+            if search_info.verbose:
+                print(f"Importing sections {start + 1} to {start + len(documents)} of {len(snapshot)}")
+            await search_manager.import_documents(documents)
+        if self.local_index:
+            self.local_index.save()
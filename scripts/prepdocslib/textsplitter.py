@@ -1,6 +1,19 @@
-from abc import ABC
-from typing import Generator, List
+import bisect
 import re
+from abc import ABC
+from typing import (
+    AsyncGenerator,
+    AsyncIterable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import tiktoken
 
 from .page import Page, SplitPage
 
@@ -16,13 +29,28 @@ class TextSplitter(ABC):
         if False:
             yield
 
+    async def split_pages_async(self, pages: AsyncIterable[Page]) -> AsyncGenerator[SplitPage, None]:
+        """
+        Splits pages as they're produced by a parser. Splitters that need the whole document collect the pages first
+        """
+        for split_page in self.split_pages([page async for page in pages]):
+            yield split_page
+
 
 class SentenceTextSplitter(TextSplitter):
     """
     Class that splits pages into smaller chunks. This is required because embedding models may not be able to analyze an entire page at once
+    Sections are measured in characters by default, or in tokens of the embedding model when max_tokens_per_section is set
     """
 
-    def __init__(self, has_image_embeddings: bool, verbose: bool = False):
+    def __init__(
+        self,
+        has_image_embeddings: bool,
+        verbose: bool = False,
+        max_tokens_per_section: Optional[int] = None,
+        token_overlap: Optional[int] = None,
+        encoding: Optional[tiktoken.Encoding] = None,
+    ):
         self.sentence_endings = [".", "!", "?"]
         self.word_breaks = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
         self.max_section_length = 1000
@@ -30,111 +58,394 @@ class SentenceTextSplitter(TextSplitter):
         self.section_overlap = 100
         self.verbose = verbose
         self.has_image_embeddings = has_image_embeddings
+        if max_tokens_per_section is not None:
+            if encoding is None:
+                raise ValueError("An encoding is needed to split sections by tokens")
+            if max_tokens_per_section <= 0:
+                raise ValueError("The number of tokens per section must be positive")
+            if token_overlap is None:
+                token_overlap = max_tokens_per_section // 10
+            if not 0 <= token_overlap < max_tokens_per_section:
+                raise ValueError("The token overlap must be smaller than the number of tokens per section")
+        self.max_tokens_per_section = max_tokens_per_section
+        self.token_overlap = token_overlap or 0
+        self.encoding = encoding
 
-    def split_pages(self, pages: List[Page]) -> Generator[SplitPage, None, None]:
+    def create_chunker(self) -> Union["SentenceChunker", "TokenChunker"]:
+        if self.max_tokens_per_section is not None and self.encoding is not None:
+            return TokenChunker(self.encoding, self.max_tokens_per_section, self.token_overlap)
+        return SentenceChunker(self)
+
+    def split_pages(self, pages: Iterable[Page]) -> Generator[SplitPage, None, None]:
         # Chunking is disabled when using GPT4V. To be updated in the future.
         if self.has_image_embeddings:
             for i, page in enumerate(pages):
-                yield SplitPage(page_num=i, text=page.text, level=-1, major='')
+                yield SplitPage(page_num=i, text=page.text, level=-1, major="")
+            return
 
-        def find_page(offset):
-            num_pages = len(pages)
-            for i in range(num_pages - 1):
-                if offset >= pages[i].offset and offset < pages[i + 1].offset:
-                    return pages[i].page_num
-            return pages[num_pages - 1].page_num
+        chunker = self.create_chunker()
+        for page in pages:
+            yield from chunker.add_page(page)
+        yield from chunker.finish()
 
-        all_text = "".join(page.text for page in pages)
-        if len(all_text.strip()) == 0:
+    async def split_pages_async(self, pages: AsyncIterable[Page]) -> AsyncGenerator[SplitPage, None]:
+        if self.has_image_embeddings:
+            i = 0
+            async for page in pages:
+                yield SplitPage(page_num=i, text=page.text, level=-1, major="")
+                i += 1
             return
 
-        length = len(all_text)
-        if length <= self.max_section_length:
-            yield SplitPage(page_num=find_page(0), text=all_text, level=-1, major='')
+        chunker = self.create_chunker()
+        async for page in pages:
+            for split_page in chunker.add_page(page):
+                yield split_page
+        for split_page in chunker.finish():
+            yield split_page
+
+
+class SentenceChunker:
+    """
+    Incremental state of a SentenceTextSplitter over one document
+    Pages are added as they're parsed and sections are produced as soon as there's enough text after them to find
+    their boundaries, so the document is never concatenated into one string. Only the text that later sections can
+    still reach back into is buffered, and pages are found by binary search over their offsets
+    """
+
+    def __init__(self, splitter: SentenceTextSplitter):
+        self.splitter = splitter
+        self.sentence_ending_pattern = re.compile("[" + re.escape("".join(splitter.sentence_endings)) + "]")
+        self.last_sentence_ending_pattern = re.compile(
+            ".*[" + re.escape("".join(splitter.sentence_endings)) + "]", re.DOTALL
+        )
+        self.word_break_pattern = re.compile("[" + re.escape("".join(splitter.word_breaks)) + "]")
+        self.last_word_break_pattern = re.compile(".*[" + re.escape("".join(splitter.word_breaks)) + "]", re.DOTALL)
+        # Buffered text, and the offset of its first character in the whole document
+        self.text = ""
+        self.text_offset = 0
+        self.length = 0
+        self.page_offsets: List[int] = []
+        self.page_nums: List[int] = []
+        self.has_content = False
+        self.has_sections = False
+        self.start = 0
+        self.end = 0
+
+    def add_page(self, page: Page) -> Generator[SplitPage, None, None]:
+        self.text += page.text
+        self.length += len(page.text)
+        self.page_offsets.append(page.offset)
+        self.page_nums.append(page.page_num)
+        # Nothing is produced for a document that's entirely whitespace, so that has to be ruled out first
+        self.has_content = self.has_content or len(page.text.strip()) > 0
+        lookahead = self.splitter.max_section_length + self.splitter.sentence_search_limit
+        while self.has_content and self.length > self.start + lookahead:
+            yield self.next_section()
+
+    def finish(self) -> Generator[SplitPage, None, None]:
+        if not self.has_content:
             return
+        if not self.has_sections and self.length <= self.splitter.max_section_length:
+            yield SplitPage(page_num=self.find_page(0), text=self.text, level=-1, major="")
+            return
+        while self.start + self.splitter.section_overlap < self.length:
+            yield self.next_section()
+        if self.start + self.splitter.section_overlap < self.end:
+            yield SplitPage(
+                page_num=self.find_page(self.start), text=self.slice(self.start, self.end), level=-1, major=""
+            )
+
+    def find_page(self, offset: int) -> int:
+        index = bisect.bisect_right(self.page_offsets, offset) - 1
+        return self.page_nums[index] if index >= 0 else self.page_nums[-1]
+
+    def char(self, offset: int) -> str:
+        return self.text[offset - self.text_offset]
+
+    def slice(self, start: int, end: int) -> str:
+        return self.text[start - self.text_offset : end - self.text_offset]
+
+    def search(self, pattern: re.Pattern, start: int, end: int) -> int:
+        # First match in the document offsets [start, end), or -1
+        match = pattern.search(self.text, start - self.text_offset, end - self.text_offset)
+        return match.start() + self.text_offset if match else -1
+
+    def search_last(self, pattern: re.Pattern, start: int, end: int) -> int:
+        # Last match in the document offsets [start, end) of a pattern that starts with a greedy ".*", or -1
+        match = pattern.match(self.text, start - self.text_offset, end - self.text_offset)
+        return match.end() - 1 + self.text_offset if match else -1
 
-        start = 0
-        end = length
-        while start + self.section_overlap < length:
-            last_word = -1
-            end = start + self.max_section_length
+    def next_section(self) -> SplitPage:
+        splitter = self.splitter
+        length = self.length
+        start = self.start
+        end = start + splitter.max_section_length
 
-            if end > length:
-                end = length
+        if end > length:
+            end = length
+        else:
+            # Try to find the end of the sentence
+            search_end = min(length, end + splitter.sentence_search_limit)
+            sentence_end = self.search(self.sentence_ending_pattern, end, search_end)
+            if sentence_end >= 0:
+                end = sentence_end
             else:
-                # Try to find the end of the sentence
-                while (
-                    end < length
-                    and (end - start - self.max_section_length) < self.sentence_search_limit
-                    and all_text[end] not in self.sentence_endings
-                ):
-                    if all_text[end] in self.word_breaks:
-                        last_word = end
-                    end += 1
-                if end < length and all_text[end] not in self.sentence_endings and last_word > 0:
+                last_word = self.search_last(self.last_word_break_pattern, end, search_end)
+                end = search_end
+                if end < length and self.char(end) not in splitter.sentence_endings and last_word > 0:
                     end = last_word  # Fall back to at least keeping a whole word
-            if end < length:
-                end += 1
-
-            # Try to find the start of the sentence or at least a whole word boundary
-            last_word = -1
-            while (
-                start > 0
-                and start > end - self.max_section_length - 2 * self.sentence_search_limit
-                and all_text[start] not in self.sentence_endings
-            ):
-                if all_text[start] in self.word_breaks:
-                    last_word = start
-                start -= 1
-            if all_text[start] not in self.sentence_endings and last_word > 0:
-                start = last_word
-            if start > 0:
-                start += 1
-
-            section_text = all_text[start:end]
-            yield SplitPage(page_num=find_page(start), text=section_text, level=-1, major='')
-
-            last_table_start = section_text.rfind("<table")
-            if last_table_start > 2 * self.sentence_search_limit and last_table_start > section_text.rfind("</table"):
-                # If the section ends with an unclosed table, we need to start the next section with the table.
-                # If table starts inside sentence_search_limit, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-                # If last table starts inside section_overlap, keep overlapping
-                if self.verbose:
-                    print(
-                        f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}"
-                    )
-                start = min(end - self.section_overlap, start + last_table_start)
-            else:
-                start = end - self.section_overlap
+        if end < length:
+            end += 1
+
+        # Try to find the start of the sentence or at least a whole word boundary
+        last_word = -1
+        lowest_start = max(0, end - splitter.max_section_length - 2 * splitter.sentence_search_limit)
+        if start > lowest_start:
+            sentence_start = self.search_last(self.last_sentence_ending_pattern, lowest_start + 1, start + 1)
+            stop = sentence_start if sentence_start >= 0 else lowest_start
+            last_word = self.search(self.word_break_pattern, stop + 1, start + 1)
+            start = stop
+        if self.char(start) not in splitter.sentence_endings and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = self.slice(start, end)
+        split_page = SplitPage(page_num=self.find_page(start), text=section_text, level=-1, major="")
+
+        last_table_start = section_text.rfind("<table")
+        if last_table_start > 2 * splitter.sentence_search_limit and last_table_start > section_text.rfind("</table"):
+            # If the section ends with an unclosed table, we need to start the next section with the table.
+            # If table starts inside sentence_search_limit, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
+            # If last table starts inside section_overlap, keep overlapping
+            if splitter.verbose:
+                print(
+                    f"Section ends with unclosed table, starting next section with the table at page {self.find_page(start)} offset {start} table start {last_table_start}"
+                )
+            self.start = min(end - splitter.section_overlap, start + last_table_start)
+        else:
+            self.start = end - splitter.section_overlap
+        self.end = end
+        self.has_sections = True
+
+        # The next section can search back for the start of a sentence up to this far before where it starts
+        keep_from = max(0, self.start - splitter.max_section_length - 2 * splitter.sentence_search_limit - 1)
+        if keep_from - self.text_offset > len(self.text) // 2:
+            self.text = self.text[keep_from - self.text_offset :]
+            self.text_offset = keep_from
+        return split_page
+
+
+class TokenChunker:
+    """
+    Incremental state of a SentenceTextSplitter that measures sections in tokens of the embedding model
+    Each page is encoded once as it's added, and sections are cut from the tokens: at the last sentence ending in the
+    second half of the section if there is one, otherwise before the last word. Consecutive sections overlap by up to
+    token_overlap tokens, starting on a sentence or word where possible, and the section length is exactly the number
+    of tokens in it
+    """
+
+    def __init__(self, encoding: tiktoken.Encoding, max_tokens: int, overlap: int):
+        self.encoding = encoding
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        # Buffered tokens, and the position of the first one in the whole document
+        self.tokens: List[int] = []
+        self.tokens_offset = 0
+        self.length = 0
+        self.page_offsets: List[int] = []
+        self.page_nums: List[int] = []
+        self.has_content = False
+        self.start = 0
+        self.token_bytes: Dict[int, bytes] = {}
+
+    def add_page(self, page: Page) -> Generator[SplitPage, None, None]:
+        self.page_offsets.append(self.length)
+        self.page_nums.append(page.page_num)
+        tokens = self.encoding.encode(page.text, disallowed_special=())
+        self.tokens.extend(tokens)
+        self.length += len(tokens)
+        self.has_content = self.has_content or len(page.text.strip()) > 0
+        while self.has_content and self.length > self.start + self.max_tokens:
+            yield self.next_section(self.find_end())
+
+    def finish(self) -> Generator[SplitPage, None, None]:
+        if self.has_content and self.start < self.length:
+            yield self.next_section(self.length)
+
+    def find_page(self, position: int) -> int:
+        index = bisect.bisect_right(self.page_offsets, position) - 1
+        return self.page_nums[index] if index >= 0 else self.page_nums[-1]
+
+    def bytes_of(self, position: int) -> bytes:
+        token = self.tokens[position - self.tokens_offset]
+        if token not in self.token_bytes:
+            self.token_bytes[token] = self.encoding.decode_single_token_bytes(token)
+        return self.token_bytes[token]
+
+    def ends_sentence(self, position: int) -> bool:
+        return self.bytes_of(position).rstrip().endswith((b".", b"!", b"?"))
+
+    def starts_word(self, position: int) -> bool:
+        return self.bytes_of(position)[:1].isspace()
+
+    def find_end(self) -> int:
+        hard_end = self.start + self.max_tokens
+        lowest_end = self.start + self.max_tokens // 2
+        for end in range(hard_end, lowest_end, -1):
+            if self.ends_sentence(end - 1):
+                return end
+        for end in range(hard_end, lowest_end, -1):
+            if self.starts_word(end):
+                return end
+        return hard_end
+
+    def find_next_start(self, end: int) -> int:
+        lowest_start = max(self.start + 1, end - self.overlap)
+        for start in range(lowest_start, end):
+            if self.ends_sentence(start - 1):
+                return start
+        for start in range(lowest_start, end):
+            if self.starts_word(start):
+                return start
+        return lowest_start if self.overlap else end
+
+    def next_section(self, end: int) -> SplitPage:
+        section_tokens = self.tokens[self.start - self.tokens_offset : end - self.tokens_offset]
+        split_page = SplitPage(
+            page_num=self.find_page(self.start),
+            text=self.encoding.decode(section_tokens),
+            level=-1,
+            major="",
+            token_count=len(section_tokens),
+        )
+        self.start = self.find_next_start(end) if end < self.length else end
+        # Sections never reach back before where the next one starts
+        stale = self.start - self.tokens_offset
+        if stale > len(self.tokens) // 2:
+            self.tokens = self.tokens[stale:]
+            self.tokens_offset = self.start
+        return split_page
 
-        if start + self.section_overlap < end:
-            yield SplitPage(page_num=find_page(start), text=all_text[start:end], level=-1, major='')
 
 class ScheduleTextSplitter(TextSplitter):
     """
     Class that splits pages into chunks that correspond to a single UW class offering in the schedule, no more, no less.
+    The course, meeting days and times, instructors, credits and kinds of sections of each class are read in a single
+    pass of one compiled pattern, and a class that doesn't match it still produces its chunk, with whatever fields could
+    be found. Meeting days are also summed into a bitmask (Monday is 1, Tuesday 2, and so on) and times are converted to
+    minutes after midnight, so they can be filtered on in the index
     """
 
-    def __init__(self):
-        self.section_ending = "---------------------"
+    section_ending = "---------------------"
+    week_days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+    # Every alternative starts with a literal, which lets the pattern skip quickly through course descriptions
+    class_pattern = re.compile(
+        r"Class: (?P<major>[A-Z&][A-Z& ]*?) ?(?P<number>\d+)"
+        r"|Main Section: (?P<lecture>)\s*[^\d\n]*\d{5} +(?:[A-Z]{1,2}\d? +(?P<credits>\d+(?:-\d+)?)?)?"
+        r"|Quiz Section: (?P<quiz>)"
+        r"|Lab Section: (?P<lab>)"
+        r"|Meeting Days: (?P<days>[A-Za-z,]*)"
+        r"|Meeting Time: (?P<time>\d{3,4}-\d{3,4}P?)?(?P<place>[^\nM]*(?:M(?!eeting )[^\nM]*)*)"
+        r"|to be arranged(?P<arranged_place>[^\nM]*(?:M(?!eeting )[^\nM]*)*)"
+    )
+    week_day_pattern = re.compile("|".join(week_days))
+    # Instructors are listed as "Last,First" after the room, e.g. "KNE 120 Wang,Matt Open 0/ 440"
+    instructor_pattern = re.compile(r"(?<![^ ])([A-Za-z'-]+,[A-Za-z][^\d/]*?)(?: +(?:Open +|Closed +)?\d+/| *$)")
+    digits_pattern = re.compile("[0-9]+")
+    letters_pattern = re.compile("[a-zA-Z& ]+")
 
     def split_pages(self, pages: List[Page]) -> Generator[SplitPage, None, None]:
-        # Chunking is disabled when using GPT4V. To be updated in the future.
-
         all_text = "".join(page.text for page in pages)
         if len(all_text.strip()) == 0:
             return
 
-        for chunk in re.split(self.section_ending, all_text):
-            class_location = chunk.find("Class: ")
-            if class_location > 0:
-                level = int(re.search("[0-9]+", chunk).group())
-                major = re.search("[a-zA-Z ]+", chunk[class_location + 7:]).group().strip()
+        for chunk in all_text.split(self.section_ending):
+            yield self.split_class(chunk)
+
+    def split_class(self, chunk: str) -> SplitPage:
+        course_code = ""
+        major = ""
+        level = 0
+        days: List[str] = []
+        times: List[str] = []
+        instructors: List[str] = []
+        section_types: List[str] = []
+        min_credits: Optional[int] = None
+        max_credits: Optional[int] = None
+        for match in self.class_pattern.finditer(chunk):
+            # The last group of each alternative tells which one matched
+            kind = match.lastgroup
+            if kind is None:
+                continue
+            if kind == "number":
+                if not course_code:
+                    major = match["major"].strip()
+                    level = int(match["number"])
+                    course_code = f"{major} {match['number']}"
+            elif kind == "days":
+                for day in self.week_day_pattern.findall(match["days"]):
+                    if day not in days:
+                        days.append(day)
+            elif kind == "place" or kind == "arranged_place":
+                time = match["time"]
+                if time is not None and time not in times:
+                    times.append(time)
+                instructor_match = self.instructor_pattern.search(match[kind])
+                if instructor_match and instructor_match.group(1) not in instructors:
+                    instructors.append(instructor_match.group(1))
             else:
-                level = 0
-                major = ""
-            yield SplitPage(page_num=0, text=chunk, level=level, major=major)
-        
+                section_type = "lecture" if kind == "credits" else kind
+                if section_type not in section_types:
+                    section_types.append(section_type)
+                if kind == "credits":
+                    low, _, high = match["credits"].partition("-")
+                    min_credits = min(int(low), min_credits) if min_credits is not None else int(low)
+                    max_credits = max(int(high or low), max_credits or 0)
+
+        class_location = chunk.find("Class: ")
+        if not course_code and class_location > 0:
+            # A class without a course number, so only its department is known
+            major_match = self.letters_pattern.match(chunk, class_location + 7)
+            major = major_match.group().strip() if major_match else ""
+            digits_match = self.digits_pattern.search(chunk)
+            level = int(digits_match.group()) if digits_match else 0
+        days.sort(key=self.week_days.index)
+        meeting_minutes = [minutes for minutes in map(self.meeting_minutes, times) if minutes is not None]
+        return SplitPage(
+            page_num=0,
+            text=chunk,
+            level=level,
+            major=major,
+            course_code=course_code,
+            days=days,
+            times=times,
+            instructors=instructors,
+            day_mask=sum(1 << self.week_days.index(day) for day in days),
+            start_minutes=min(start for start, _ in meeting_minutes) if meeting_minutes else None,
+            end_minutes=max(end for _, end in meeting_minutes) if meeting_minutes else None,
+            min_credits=min_credits,
+            max_credits=max_credits,
+            section_types=section_types,
+        )
+
+    @classmethod
+    def meeting_minutes(cls, time: str) -> Optional[Tuple[int, int]]:
+        """
+        Converts a meeting time of the schedule, like "1130-1220" or "430-620P", to minutes after midnight
+        Hours aren't marked AM or PM: classes starting before 7 are in the afternoon, and a trailing P marks the evening
+        """
+        evening = time.endswith("P")
+        start_text, _, end_text = time.rstrip("P").partition("-")
+        start = int(start_text[:-2]) * 60 + int(start_text[-2:])
+        end = int(end_text[:-2]) * 60 + int(end_text[-2:])
+        if start < 7 * 60 or (evening and start < 12 * 60):
+            start += 12 * 60
+        if end <= start and end < 12 * 60:
+            end += 12 * 60
+        if end <= start or end > 24 * 60:
+            return None
+        return start, end
 
 
 class SimpleTextSplitter(TextSplitter):
@@ -16,6 +16,26 @@ class MockAzureCredential(AsyncTokenCredential):
         return MockToken("", 9999999999, "")
 
 
+class MockRawEmbeddingsResponse:
+    def __init__(self, response, headers):
+        self.response = response
+        self.headers = headers
+
+    def parse(self):
+        return self.response
+
+
+class MockRawEmbeddingsClient:
+    """Serves the responses of a mock embeddings client as raw responses, with the headers it sets if any"""
+
+    def __init__(self, embeddings_client):
+        self.embeddings_client = embeddings_client
+
+    async def create(self, *args, **kwargs):
+        response = await self.embeddings_client.create(*args, **kwargs)
+        return MockRawEmbeddingsResponse(response, getattr(self.embeddings_client, "headers", {}))
+
+
 class MockBlobClient:
     async def download_blob(self):
         return MockBlob()
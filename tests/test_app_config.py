@@ -144,3 +144,43 @@ async def test_app_searchkey_notfound(monkeypatch, minimal_env):
     quart_app = app.create_app()
     async with quart_app.test_app() as test_app:
         test_app.test_client()
+
+
+@pytest.mark.asyncio
+async def test_app_metrics_disabled(monkeypatch, minimal_env):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        client = test_app.test_client()
+        response = await client.get("/metrics")
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_app_metrics_prometheus(monkeypatch, minimal_env):
+    monkeypatch.setenv("LATENCY_SINKS", "console, prometheus")
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        latency_tracer = quart_app.config[app.CONFIG_LATENCY_TRACER]
+        assert [type(sink).__name__ for sink in latency_tracer.sinks] == ["ConsoleSink", "PrometheusSink"]
+        latency_tracer.start("ChatReadRetrieveReadApproach").finish()
+
+        client = test_app.test_client()
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        assert response.content_type.startswith("text/plain")
+        result = await response.get_data(as_text=True)
+        assert (
+            'approach_stage_duration_seconds_count{approach="ChatReadRetrieveReadApproach",stage="total"} 1' in result
+        )
+
+
+@pytest.mark.asyncio
+async def test_app_coalesce_requests(monkeypatch, minimal_env):
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_REQUEST_COALESCER].enabled is False
+
+    monkeypatch.setenv("COALESCE_REQUESTS", "True")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_REQUEST_COALESCER].enabled is True
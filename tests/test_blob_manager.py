@@ -1,8 +1,14 @@
+import hashlib
+import io
 import os
 import sys
 from tempfile import NamedTemporaryFile
 
+import fitz  # type: ignore
 import pytest
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobProperties, ContentSettings
+from PIL import Image
 
 from .mocks import MockAzureCredential
 from scripts.prepdocslib.blobmanager import BlobManager
@@ -11,6 +17,11 @@ from scripts.prepdocslib.listfilestrategy import File
 
 @pytest.fixture
 def blob_manager(monkeypatch):
+    async def mock_get_blob_properties(*args, **kwargs):
+        raise ResourceNotFoundError("The specified blob does not exist")
+
+    monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
     return BlobManager(
         endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
         credential=MockAzureCredential(),
@@ -147,6 +158,77 @@ async def test_create_container_upon_upload(monkeypatch, mock_env, blob_manager)
         await blob_manager.upload_blob(f)
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_upload_reuses_session(monkeypatch, mock_env, blob_manager):
+    exists_calls = []
+
+    async def mock_exists(*args, **kwargs):
+        exists_calls.append(args)
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    uploads = []
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        uploads.append((name, data.read(), kwargs["content_settings"].content_md5))
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    with NamedTemporaryFile(suffix=".pdf") as first_file, NamedTemporaryFile(suffix=".pdf") as second_file:
+        first_file.write(b"first")
+        second_file.write(b"second")
+        # Like after parsing, the streams are left at their end and have to be rewound before uploading
+        await blob_manager.upload_blob(File(first_file.file))
+        service_client = blob_manager.service_client
+        await blob_manager.upload_blob(File(second_file.file))
+
+        assert blob_manager.service_client is service_client
+        assert len(exists_calls) == 1
+        assert [(name, data) for name, data, _ in uploads] == [
+            (os.path.basename(first_file.name), b"first"),
+            (os.path.basename(second_file.name), b"second"),
+        ]
+        assert uploads[0][2] == hashlib.md5(b"first").digest()
+
+    await blob_manager.close()
+    assert blob_manager.service_client is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_upload_skips_unchanged_blob(monkeypatch, mock_env, blob_manager):
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    async def mock_get_blob_properties(*args, **kwargs):
+        properties = BlobProperties()
+        properties.content_settings = ContentSettings(content_md5=bytearray(hashlib.md5(b"unchanged").digest()))
+        return properties
+
+    monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
+    uploaded_names = []
+
+    async def mock_upload_blob(self, name, *args, **kwargs):
+        uploaded_names.append(name)
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    with NamedTemporaryFile(suffix=".pdf") as unchanged_file, NamedTemporaryFile(suffix=".pdf") as changed_file:
+        unchanged_file.write(b"unchanged")
+        changed_file.write(b"changed")
+        await blob_manager.upload_blob(File(unchanged_file.file))
+        await blob_manager.upload_blob(File(changed_file.file))
+
+        assert uploaded_names == [os.path.basename(changed_file.name)]
+
+
 @pytest.mark.asyncio
 @pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
 async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
@@ -163,11 +245,88 @@ async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
     await blob_manager.remove_blob()
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_upload_pdf_page_images(monkeypatch, mock_env):
+    blob_manager = BlobManager(
+        endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        container=os.environ["AZURE_STORAGE_CONTAINER"],
+        store_page_images=True,
+        image_format="webp",
+        image_dpi=36,
+        image_workers=2,
+    )
+    with NamedTemporaryFile(suffix=".pdf") as temp_file:
+        doc = fitz.open()
+        for page_text in ["first page", "second page", "third page"]:
+            doc.new_page().insert_text((72, 72), page_text)
+        doc.save(temp_file.name)
+        f = File(open(temp_file.name, "rb"))
+        name = os.path.splitext(os.path.basename(temp_file.name))[0]
+
+        async def mock_exists(*args, **kwargs):
+            return True
+
+        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+        async def mock_get_blob_properties(*args, **kwargs):
+            raise ResourceNotFoundError("The specified blob does not exist")
+
+        monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
+        async def mock_get_user_delegation_key(*args, **kwargs):
+            return None
+
+        monkeypatch.setattr(
+            "azure.storage.blob.aio.BlobServiceClient.get_user_delegation_key", mock_get_user_delegation_key
+        )
+
+        class MockBlobClient:
+            account_name = None
+
+        uploaded = {}
+
+        async def mock_upload_blob(self, name, data, *args, **kwargs):
+            uploaded[name] = data if isinstance(data, bytes) else None
+            return MockBlobClient()
+
+        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+        await blob_manager.upload_blob(f)
+        executor = blob_manager.image_executor
+        # Later PDFs of the run are rendered by the same worker processes
+        await blob_manager.upload_blob(f)
+        assert blob_manager.image_executor is executor
+        f.close()
+        await blob_manager.close()
+        assert blob_manager.image_executor is None
+
+    assert sorted(uploaded) == sorted([os.path.basename(temp_file.name)] + [f"{name}-{i}.webp" for i in range(3)])
+    for i in range(3):
+        image = Image.open(io.BytesIO(uploaded[f"{name}-{i}.webp"]))
+        assert image.format == "WEBP"
+        # An A4 page at half of the 72 DPI default, plus the space for the file name above the page
+        assert image.size == (298, 421 + 40)
+
+
+def test_unsupported_page_image_format():
+    with pytest.raises(ValueError):
+        BlobManager(
+            endpoint="https://test.blob.core.windows.net", credential="key", container="test", image_format="bmp"
+        )
+
+
 def test_sourcepage_from_file_page():
     assert BlobManager.sourcepage_from_file_page("test.pdf", 0) == "test.pdf#page=1"
     assert BlobManager.sourcepage_from_file_page("test.html", 0) == "test.html"
 
 
+def test_blob_image_name_from_file_page():
+    assert BlobManager.blob_image_name_from_file_page("tmp/test.pdf", 2) == "test-2.png"
+    assert BlobManager.blob_image_name_from_file_page("tmp/test.pdf", 2, "jpeg") == "test-2.jpeg"
+
+
 def test_blob_name_from_file_name():
     assert BlobManager.blob_name_from_file_name("tmp/test.pdf") == "test.pdf"
     assert BlobManager.blob_name_from_file_name("tmp/test.html") == "test.html"
@@ -1,10 +1,13 @@
 import json
+import re
 
 import pytest
 from openai.types.chat import ChatCompletion
 
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 
+from .mocks import MockAsyncSearchResultsIterator
+
 
 @pytest.fixture
 def chat_approach():
@@ -90,6 +93,39 @@ def test_get_search_query(chat_approach):
     assert query == "accesstelemedicineservices"
 
 
+def test_get_search_query_filtered_search(chat_approach):
+    arguments = {"search_query": "400 LEVEL Computer Science classes", "level": "400", "major": "computer science"}
+    chatcompletions = ChatCompletion.model_validate(
+        {
+            "id": "chatcmpl-81JkxYqYppUkPtOAia40gki2vJ9QM",
+            "object": "chat.completion",
+            "created": 1695324963,
+            "model": "gpt-35-turbo",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "tool_calls",
+                    "message": {
+                        "content": None,
+                        "role": "assistant",
+                        "tool_calls": [
+                            {
+                                "id": "filtered_search1235",
+                                "type": "function",
+                                "function": {"name": "filtered_search", "arguments": json.dumps(arguments)},
+                            }
+                        ],
+                    },
+                }
+            ],
+        }
+    )
+    query = chat_approach.get_search_query(chatcompletions, "hello")
+
+    assert query == arguments
+    assert chat_approach.build_course_filter(query) == "level ge 400 and level lt 500 and (major eq 'cse')"
+
+
 def test_get_search_query_returns_default(chat_approach):
     payload = '{"id":"chatcmpl-81JkxYqYppUkPtOAia40gki2vJ9QM","object":"chat.completion","created":1695324963,"model":"gpt-35-turbo","prompt_filter_results":[{"prompt_index":0,"content_filter_results":{"hate":{"filtered":false,"severity":"safe"},"self_harm":{"filtered":false,"severity":"safe"},"sexual":{"filtered":false,"severity":"safe"},"violence":{"filtered":false,"severity":"safe"}}}],"choices":[{"index":0,"finish_reason":"function_call","message":{"content":"","role":"assistant"},"content_filter_results":{}}],"usage":{"completion_tokens":19,"prompt_tokens":425,"total_tokens":444}}'
     default_query = "hello"
@@ -99,120 +135,6 @@ def test_get_search_query_returns_default(chat_approach):
     assert query == default_query
 
 
-def test_get_messages_from_history(chat_approach):
-    messages = chat_approach.get_messages_from_history(
-        system_prompt="You are a bot.",
-        model_id="gpt-35-turbo",
-        history=[
-            {"role": "user", "content": "What happens in a performance review?"},
-            {
-                "role": "assistant",
-                "content": "During the performance review at Contoso Electronics, the supervisor will discuss the employee's performance over the past year and provide feedback on areas for improvement. They will also provide an opportunity for the employee to discuss their goals and objectives for the upcoming year. The review is a two-way dialogue between managers and employees, and employees will receive a written summary of their performance review which will include a rating of their performance, feedback, and goals and objectives for the upcoming year [employee_handbook-3.pdf].",
-            },
-            {"role": "user", "content": "What does a Product Manager do?"},
-        ],
-        user_content="What does a Product Manager do?",
-        max_tokens=3000,
-    )
-    assert messages == [
-        {"role": "system", "content": "You are a bot."},
-        {"role": "user", "content": "What happens in a performance review?"},
-        {
-            "role": "assistant",
-            "content": "During the performance review at Contoso Electronics, the supervisor will discuss the employee's performance over the past year and provide feedback on areas for improvement. They will also provide an opportunity for the employee to discuss their goals and objectives for the upcoming year. The review is a two-way dialogue between managers and employees, and employees will receive a written summary of their performance review which will include a rating of their performance, feedback, and goals and objectives for the upcoming year [employee_handbook-3.pdf].",
-        },
-        {"role": "user", "content": "What does a Product Manager do?"},
-    ]
-
-
-def test_get_messages_from_history_truncated(chat_approach):
-    messages = chat_approach.get_messages_from_history(
-        system_prompt="You are a bot.",
-        model_id="gpt-35-turbo",
-        history=[
-            {"role": "user", "content": "What happens in a performance review?"},
-            {
-                "role": "assistant",
-                "content": "During the performance review at Contoso Electronics, the supervisor will discuss the employee's performance over the past year and provide feedback on areas for improvement. They will also provide an opportunity for the employee to discuss their goals and objectives for the upcoming year. The review is a two-way dialogue between managers and employees, and employees will receive a written summary of their performance review which will include a rating of their performance, feedback, and goals and objectives for the upcoming year [employee_handbook-3.pdf].",
-            },
-            {"role": "user", "content": "What does a Product Manager do?"},
-        ],
-        user_content="What does a Product Manager do?",
-        max_tokens=10,
-    )
-    assert messages == [
-        {"role": "system", "content": "You are a bot."},
-        {"role": "user", "content": "What does a Product Manager do?"},
-    ]
-
-
-def test_get_messages_from_history_truncated_longer(chat_approach):
-    messages = chat_approach.get_messages_from_history(
-        system_prompt="You are a bot.",  # 8 tokens
-        model_id="gpt-35-turbo",
-        history=[
-            {"role": "user", "content": "What happens in a performance review?"},  # 10 tokens
-            {
-                "role": "assistant",
-                "content": "During the performance review at Contoso Electronics, the supervisor will discuss the employee's performance over the past year and provide feedback on areas for improvement. They will also provide an opportunity for the employee to discuss their goals and objectives for the upcoming year. The review is a two-way dialogue between managers and employees, and employees will receive a written summary of their performance review which will include a rating of their performance, feedback, and goals and objectives for the upcoming year [employee_handbook-3.pdf].",
-            },  # 102 tokens
-            {"role": "user", "content": "Is there a dress code?"},  # 9 tokens
-            {
-                "role": "assistant",
-                "content": "Yes, there is a dress code at Contoso Electronics. Look sharp! [employee_handbook-1.pdf]",
-            },  # 26 tokens
-            {"role": "user", "content": "What does a Product Manager do?"},  # 10 tokens
-        ],
-        user_content="What does a Product Manager do?",
-        max_tokens=55,
-    )
-    assert messages == [
-        {"role": "system", "content": "You are a bot."},
-        {"role": "user", "content": "Is there a dress code?"},
-        {
-            "role": "assistant",
-            "content": "Yes, there is a dress code at Contoso Electronics. Look sharp! [employee_handbook-1.pdf]",
-        },
-        {"role": "user", "content": "What does a Product Manager do?"},
-    ]
-
-
-def test_get_messages_from_history_truncated_break_pair(chat_approach):
-    """Tests that the truncation breaks the pair of messages."""
-    messages = chat_approach.get_messages_from_history(
-        system_prompt="You are a bot.",  # 8 tokens
-        model_id="gpt-35-turbo",
-        history=[
-            {"role": "user", "content": "What happens in a performance review?"},  # 10 tokens
-            {
-                "role": "assistant",
-                "content": "During the performance review at Contoso Electronics, the supervisor will discuss the employee's performance over the past year and provide feedback on areas for improvement. They will also provide an opportunity for the employee to discuss their goals and objectives for the upcoming year. The review is a two-way dialogue between managers and employees, and employees will receive a written summary of their performance review which will include a rating of their performance, feedback, and goals and objectives for the upcoming year [employee_handbook-3.pdf].",
-            },  # 102 tokens
-            {"role": "user", "content": "Is there a dress code?"},  # 9 tokens
-            {
-                "role": "assistant",
-                "content": "Yes, there is a dress code at Contoso Electronics. Look sharp! [employee_handbook-1.pdf]",
-            },  # 26 tokens
-            {"role": "user", "content": "What does a Product Manager do?"},  # 10 tokens
-        ],
-        user_content="What does a Product Manager do?",
-        max_tokens=147,
-    )
-    assert messages == [
-        {"role": "system", "content": "You are a bot."},
-        {
-            "role": "assistant",
-            "content": "During the performance review at Contoso Electronics, the supervisor will discuss the employee's performance over the past year and provide feedback on areas for improvement. They will also provide an opportunity for the employee to discuss their goals and objectives for the upcoming year. The review is a two-way dialogue between managers and employees, and employees will receive a written summary of their performance review which will include a rating of their performance, feedback, and goals and objectives for the upcoming year [employee_handbook-3.pdf].",
-        },
-        {"role": "user", "content": "Is there a dress code?"},
-        {
-            "role": "assistant",
-            "content": "Yes, there is a dress code at Contoso Electronics. Look sharp! [employee_handbook-1.pdf]",
-        },
-        {"role": "user", "content": "What does a Product Manager do?"},
-    ]
-
-
 def test_extract_followup_questions(chat_approach):
     content = "Here is answer to your question.<<What is the dress code?>>"
     pre_content, followup_questions = chat_approach.extract_followup_questions(content)
@@ -249,21 +171,119 @@ def test_extract_followup_questions_no_pre_content(chat_approach):
     assert followup_questions == ["What is the dress code?"]
 
 
-def test_get_messages_from_history_few_shots(chat_approach):
-    user_query_request = "What does a Product manager do?"
-    messages = chat_approach.get_messages_from_history(
-        system_prompt=chat_approach.query_prompt_template,
-        model_id=chat_approach.chatgpt_model,
-        user_content=user_query_request,
-        history=[],
-        max_tokens=chat_approach.chatgpt_token_limit - len(user_query_request),
-        few_shots=chat_approach.query_prompt_few_shots,
+def test_build_course_filter(chat_approach):
+    assert chat_approach.build_course_filter({"search_query": "intro classes"}) is None
+    assert (
+        chat_approach.build_course_filter({"search_query": "300 level classes", "level": "300"})
+        == "level ge 300 and level lt 400"
+    )
+    assert chat_approach.build_course_filter({"search_query": "300 classes", "level": "300"}) is None
+    assert (
+        chat_approach.build_course_filter({"search_query": "classes", "major": ["computer science", "O'Neil"]})
+        == "(major eq 'cse' or major eq 'o''neil')"
+    )
+    assert (
+        chat_approach.build_course_filter({"search_query": "classes", "instructor": "Matt Wang"})
+        == "search.ismatch('Matt Wang', 'instructors', 'simple', 'all')"
+    )
+    assert (
+        chat_approach.build_course_filter(
+            {"search_query": "classes", "start_after": "1pm", "end_before": "17:30", "credits": 5}
+        )
+        == "startMinutes ge 780 and endMinutes le 1050 and minCredits le 5 and maxCredits ge 5"
+    )
+    assert (
+        chat_approach.build_course_filter({"search_query": "classes", "section_types": ["lab"]})
+        == "sectionTypes/any(t: t eq 'lab')"
+    )
+
+
+def test_build_course_filter_days(chat_approach):
+    def filtered_masks(arguments):
+        day_filter = chat_approach.build_course_filter({"search_query": "classes", **arguments})
+        return [int(mask) for mask in re.findall(r"meetingDays eq (\d+)", day_filter)]
+
+    monday_masks = filtered_masks({"days": ["Monday"]})
+    assert len(monday_masks) == 64 and all(mask & 1 for mask in monday_masks)
+    # Classes that meet Monday and Wednesday, but not on Friday
+    masks = filtered_masks({"days": ["monday", "Wednesday"], "exclude_days": ["Friday"]})
+    assert 5 in masks and 1 + 4 + 16 not in masks and 1 not in masks
+    assert len(masks) == 16
+    assert chat_approach.build_course_filter({"days": ["Monday"], "exclude_days": ["Monday"]}) == "false"
+    assert chat_approach.build_course_filter({"days": ["Someday"], "start_after": "noonish"}) is None
+
+
+def test_keyword_query_classifier(chat_approach):
+    classifier = chat_approach.keyword_query_classifier
+
+    def classify(*questions):
+        return classifier.classify([{"role": "user", "content": question} for question in questions])
+
+    assert classify("CSE 333") == {"search_query": "CSE 333", "major": ["CSE"], "level": None}
+    arguments = classify("300 level music classes")
+    assert arguments == {"search_query": "300 level music classes", "major": ["MUSIC"], "level": "300"}
+    assert chat_approach.build_course_filter(arguments) == "level ge 300 and level lt 400 and (major eq 'music')"
+    # The question keeps its case as the search query, and still asks for a level
+    arguments = classify("300 Level MUSIC classes")
+    assert arguments == {"search_query": "300 Level MUSIC classes", "major": ["MUSIC"], "level": "300"}
+    assert chat_approach.build_course_filter(arguments) == "level ge 300 and level lt 400 and (major eq 'music')"
+    assert classify("Show me 200 level Computer Science & Engineering classes")["major"] == ["CSE"]
+    assert classify("b str301 or math 126?")["major"] == ["B STR", "MATH"]
+    # Anything the rules don't understand, and follow-up questions, go to the chat model
+    assert classify("Who teaches CSE 332?") is None
+    assert classify("Which BIOL classes have a lab section?") is None
+    assert classify("100 level or 200 level CHEM classes") is None
+    assert classify("What is the capital of France?") is None
+    assert classify("What CSE classes are there?", "Which of those meet in the morning?") is None
+
+
+def test_prompts_built_once(chat_approach):
+    assert [tool["function"]["name"] for tool in chat_approach.query_prompt.tools] == [
+        "search_sources",
+        "search_degree_requirements",
+        "filtered_search",
+    ]
+    assert chat_approach.get_answer_prompt({}) is chat_approach.answer_prompts[False]
+    assert chat_approach.get_answer_prompt({"suggest_followup_questions": True}) is chat_approach.answer_prompts[True]
+    assert (
+        "Generate 3 very brief follow-up questions"
+        in chat_approach.answer_prompts[True].message_builder.messages[0]["content"]
     )
-    # Make sure messages are in the right order
-    assert messages[0]["role"] == "system"
-    assert messages[1]["role"] == "user"
-    assert messages[2]["role"] == "assistant"
-    assert messages[3]["role"] == "user"
-    assert messages[4]["role"] == "assistant"
-    assert messages[5]["role"] == "user"
-    assert messages[5]["content"] == user_query_request
+    # Prompts from the request are built for it
+    injected_prompt = chat_approach.get_answer_prompt({"prompt_template": ">>>Talk like a pirate."})
+    assert "Talk like a pirate." in injected_prompt.message_builder.messages[0]["content"]
+    replaced_prompt = chat_approach.get_answer_prompt({"prompt_template": "Talk like a pirate."})
+    assert replaced_prompt.message_builder.messages[0]["content"] == "Talk like a pirate."
+
+
+def test_get_dimensions_argument(chat_approach):
+    assert chat_approach.get_dimensions_argument() == {}
+    # The native size isn't sent, since ada-002 rejects the dimensions parameter
+    chat_approach.embedding_model = "text-embedding-ada-002"
+    chat_approach.embedding_dimensions = 1536
+    assert chat_approach.get_dimensions_argument() == {}
+    chat_approach.embedding_model = "text-embedding-3-large"
+    assert chat_approach.get_dimensions_argument() == {"dimensions": 1536}
+
+
+class RecordingSearchClient:
+    async def search(self, *args, **kwargs):
+        self.select = kwargs.get("select")
+        return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"))
+
+
+@pytest.mark.asyncio
+async def test_search_select(chat_approach):
+    chat_approach.search_client = RecordingSearchClient()
+    await chat_approach.search(3, "CSE 333", None, [], False, False)
+    assert chat_approach.search_client.select == ["id", "content", "category", "sourcepage", "sourcefile"]
+
+    select_vectors = chat_approach.get_select_vectors({}, chat_approach.source_reducer.VECTOR_FIELDS)
+    assert select_vectors == ["embedding"]
+    await chat_approach.search(3, "CSE 333", None, [], True, True, select_vectors=select_vectors)
+    assert chat_approach.search_client.select[-1] == "embedding"
+
+    assert chat_approach.get_select_vectors({}) == []
+    assert chat_approach.get_select_vectors(
+        {"include_vectors": True, "vector_fields": ["embedding", "imageEmbedding"]}, ["embedding"]
+    ) == ["embedding", "imageEmbedding"]
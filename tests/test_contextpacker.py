@@ -0,0 +1,32 @@
+from core.contextpacker import ContextPacker
+
+SENTENCE = "CSE 333 is a systems programming class taught in C and C++. "
+
+
+def test_pack_sources_by_rank():
+    packer = ContextPacker("gpt-35-turbo")
+    sources = [
+        "cse.html: " + SENTENCE * 5,
+        "math.html: " + SENTENCE * 50,
+        "info.html: " + SENTENCE * 50,
+    ]
+    packed = packer.pack(sources, max_tokens=300)
+    assert packed.sources[0] == sources[0]
+    # The second source is cut at the end of a sentence, which leaves too little room for the third
+    assert packed.sources[1].startswith("math.html: CSE 333")
+    assert packed.sources[1].endswith("C++.")
+    assert len(packed.sources[1]) < len(sources[1])
+    assert packed.truncated == ["math.html"]
+    assert packed.dropped == ["info.html"]
+    assert 200 < packed.token_count <= 300
+
+
+def test_pack_sources_that_fit():
+    packer = ContextPacker("gpt-35-turbo")
+    sources = ["cse.html: " + SENTENCE, "math.html: " + SENTENCE]
+    packed = packer.pack(sources, max_tokens=1000)
+    assert packed.sources == sources
+    assert packed.truncated == [] and packed.dropped == []
+    # Without a sentence that fits, a source is left out rather than cut mid-sentence
+    packed = packer.pack(["cse.html: " + "word " * 500], max_tokens=100)
+    assert packed.sources == [] and packed.dropped == ["cse.html"]
@@ -0,0 +1,117 @@
+import pytest
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
+
+from .mocks import MockAsyncPageIterator
+from scripts.prepdocslib.indexsnapshot import IndexSnapshot
+from scripts.prepdocslib.ingestionmanifest import IngestionManifest
+from scripts.prepdocslib.snapshotstrategy import SnapshotAction, SnapshotStrategy
+from scripts.prepdocslib.strategy import SearchInfo
+
+DOCUMENTS = [
+    {
+        "id": "file-cse_html-page-0",
+        "content": "Class: CSE 121 Introduction to computer programming – Wang",
+        "embedding": [0.25, -0.5, 1.0],
+        "level": 121,
+        "major": "cse",
+        "meetingDays": 21,
+        "instructors": ["Wang,Matt"],
+        "sourcefile": "cse.html",
+        "oids": ["OID_1"],
+    },
+    {
+        "id": "file-cse_html-page-1",
+        "content": "",
+        "embedding": None,
+        "level": 0,
+        "major": "",
+        "meetingDays": None,
+        "instructors": [],
+        "sourcefile": "cse.html",
+    },
+]
+
+
+class MockIndexingResult:
+    def __init__(self, key: str):
+        self.key = key
+        self.succeeded = True
+        self.status_code = 201
+
+
+@pytest.fixture
+def search_info():
+    return SearchInfo(
+        endpoint="https://testsearchclient.blob.core.windows.net",
+        credential=AzureKeyCredential("test"),
+        index_name="test",
+    )
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "snapshots" / "index.npz")
+    IndexSnapshot.save(path, DOCUMENTS)
+
+    snapshot = IndexSnapshot(path)
+    assert len(snapshot) == 2
+    assert snapshot.fields["embedding"] == "vector"
+    assert snapshot.fields["level"] == "int"
+    assert snapshot.fields["instructors"] == "json"
+    assert snapshot.dimensions("embedding") == 3
+    assert snapshot.dimensions("imageEmbedding") is None
+    # Fields that were null or missing are left out, and everything else comes back unchanged
+    assert snapshot.read_documents() == [
+        DOCUMENTS[0],
+        {key: value for key, value in DOCUMENTS[1].items() if value is not None},
+    ]
+    assert snapshot.read_documents(1, 10) == snapshot.read_documents()[1:]
+
+
+@pytest.mark.asyncio
+async def test_snapshot_export_and_import(monkeypatch, search_info, tmp_path):
+    async def mock_search(self, *args, **kwargs):
+        return MockAsyncPageIterator(data=[{**document, "@search.score": 1} for document in DOCUMENTS])
+
+    async def mock_get_document_count(self):
+        return len(DOCUMENTS)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "get_document_count", mock_get_document_count)
+
+    path = str(tmp_path / "index.npz")
+    await SnapshotStrategy(path, SnapshotAction.Export).run(search_info)
+
+    indexes = []
+
+    async def mock_create_index(self, index):
+        indexes.append(index)
+
+    async def mock_list_index_names(self):
+        for index in []:
+            yield index
+
+    monkeypatch.setattr(SearchIndexClient, "create_index", mock_create_index)
+    monkeypatch.setattr(SearchIndexClient, "list_index_names", mock_list_index_names)
+
+    uploaded_documents = []
+
+    async def mock_upload_documents(self, documents):
+        uploaded_documents.extend(documents)
+        return [MockIndexingResult(document["id"]) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"))
+    strategy = SnapshotStrategy(path, SnapshotAction.Import, manifest=manifest)
+    await strategy.setup(search_info)
+    await strategy.run(search_info)
+
+    # The index is created with the dimensions and fields of the snapshot
+    embedding_field = next(field for field in indexes[0].fields if field.name == "embedding")
+    assert embedding_field.vector_search_dimensions == 3
+    assert "oids" in [field.name for field in indexes[0].fields]
+    assert [document["id"] for document in uploaded_documents] == [document["id"] for document in DOCUMENTS]
+    assert uploaded_documents[0]["embedding"] == [0.25, -0.5, 1.0]
+    assert manifest.get_ids("test", "cse.html") == [document["id"] for document in DOCUMENTS]
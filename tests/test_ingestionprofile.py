@@ -0,0 +1,53 @@
+import io
+import time
+
+import pytest
+
+from scripts.prepdocslib.ingestionprofile import (
+    INDEXING,
+    PARSE,
+    SPLIT,
+    IngestionProfile,
+)
+
+
+async def slow_pages():
+    for page in ["first page", "second page"]:
+        time.sleep(0.01)
+        yield page
+
+
+@pytest.mark.asyncio
+async def test_ingestion_profile_nested_stages():
+    profile = IngestionProfile()
+    with profile.stage(SPLIT):
+        pages = [page async for page in profile.timed(PARSE, slow_pages())]
+        time.sleep(0.005)
+    assert pages == ["first page", "second page"]
+
+    # Producing each page and noticing the end of the pages count as parsing, and only the rest as splitting
+    assert profile.stages[PARSE].calls == 3
+    assert profile.stages[PARSE].wall >= 0.02
+    assert 0.005 <= profile.stages[SPLIT].wall < profile.stages[PARSE].wall
+    # Sleeping is waiting rather than CPU time
+    assert profile.stages[PARSE].cpu < 0.01
+    assert profile.stages[INDEXING].calls == 0
+
+
+def test_ingestion_profile_report():
+    profile = IngestionProfile()
+    content = io.BytesIO(b"x" * 2000)
+    content.seek(10)
+    profile.add_file(content, sections=4)
+    assert content.tell() == 10
+    with profile.stage(INDEXING):
+        pass
+
+    metrics = profile.metrics()
+    assert profile.bytes == 2000
+    assert metrics["sections_per_second"] > 0
+    assert metrics["indexing_seconds"] >= 0
+    report = profile.report()
+    assert report.startswith("Ingested 1 files (0.0 MB) into 4 sections")
+    # Stages that never ran are left out
+    assert [line.split()[0] for line in report.splitlines()[2:]] == [INDEXING]
@@ -0,0 +1,91 @@
+import logging
+
+import pytest
+from opentelemetry import metrics
+from opentelemetry.sdk.metrics import MeterProvider
+
+from core.latency import (
+    SEARCH,
+    TOTAL,
+    ConsoleSink,
+    Histogram,
+    LatencySink,
+    LatencyTracer,
+    OpenTelemetrySink,
+    PrometheusSink,
+)
+
+
+class FailingSink(LatencySink):
+    def record(self, approach, timings):
+        raise ValueError("Sink is down")
+
+
+def test_histogram():
+    histogram = Histogram([0.1, 0.5, 1.0])
+    for value in [0.05, 0.1, 0.3, 2.0]:
+        histogram.observe(value)
+    # Boundaries are inclusive, and values above the last one only count towards the total
+    assert histogram.cumulative_counts() == [2, 3, 3]
+    assert histogram.count == 4
+    assert histogram.sum == 2.45
+
+
+def test_prometheus_render():
+    sink = PrometheusSink(buckets=[0.1, 1.0])
+    sink.record("RetrieveThenReadApproach", {SEARCH: 0.05, TOTAL: 1.5})
+    sink.record("RetrieveThenReadApproach", {SEARCH: 0.5, TOTAL: 0.75})
+    assert sink.render().splitlines() == [
+        "# HELP approach_stage_duration_seconds Time spent in each stage of answering a question",
+        "# TYPE approach_stage_duration_seconds histogram",
+        'approach_stage_duration_seconds_bucket{approach="RetrieveThenReadApproach",stage="search",le="0.1"} 1',
+        'approach_stage_duration_seconds_bucket{approach="RetrieveThenReadApproach",stage="search",le="1.0"} 2',
+        'approach_stage_duration_seconds_bucket{approach="RetrieveThenReadApproach",stage="search",le="+Inf"} 2',
+        'approach_stage_duration_seconds_sum{approach="RetrieveThenReadApproach",stage="search"} 0.55',
+        'approach_stage_duration_seconds_count{approach="RetrieveThenReadApproach",stage="search"} 2',
+        'approach_stage_duration_seconds_bucket{approach="RetrieveThenReadApproach",stage="total",le="0.1"} 0',
+        'approach_stage_duration_seconds_bucket{approach="RetrieveThenReadApproach",stage="total",le="1.0"} 1',
+        'approach_stage_duration_seconds_bucket{approach="RetrieveThenReadApproach",stage="total",le="+Inf"} 2',
+        'approach_stage_duration_seconds_sum{approach="RetrieveThenReadApproach",stage="total"} 2.25',
+        'approach_stage_duration_seconds_count{approach="RetrieveThenReadApproach",stage="total"} 2',
+    ]
+
+
+def test_request_trace(caplog):
+    prometheus_sink = PrometheusSink()
+    tracer = LatencyTracer([FailingSink(), ConsoleSink(), prometheus_sink])
+    assert tracer.get_sink(PrometheusSink) is prometheus_sink
+
+    trace = tracer.start("ChatReadRetrieveReadApproach")
+    with trace.stage(SEARCH):
+        pass
+    trace.record(SEARCH, 0.25)
+    with caplog.at_level(logging.INFO):
+        trace.finish()
+        trace.finish()
+
+    # Stages that happen more than once add up, and a failing sink doesn't stop the others
+    assert trace.timings[SEARCH] >= 0.25
+    assert trace.timings[TOTAL] >= 0
+    assert list(trace.as_milliseconds()) == [SEARCH, TOTAL]
+    assert "Failed to record latencies in FailingSink" in caplog.text
+    assert "ChatReadRetrieveReadApproach latency: search=" in caplog.text
+    assert prometheus_sink.histograms[("ChatReadRetrieveReadApproach", TOTAL)].count == 1
+
+
+def test_use_otlp_exporter(monkeypatch, caplog):
+    pytest.importorskip("opentelemetry.exporter.otlp.proto.http.metric_exporter")
+    meter_providers = []
+    monkeypatch.setattr(metrics, "set_meter_provider", meter_providers.append)
+
+    # Without a configured provider, one that exports to the collector is set
+    monkeypatch.setattr(metrics, "get_meter_provider", lambda: metrics.NoOpMeterProvider())
+    assert OpenTelemetrySink.use_otlp_exporter("http://collector:4318/v1/metrics")
+    assert len(meter_providers) == 1
+
+    # A configured provider, like the Azure Monitor one, is kept
+    monkeypatch.setattr(metrics, "get_meter_provider", lambda: MeterProvider())
+    with caplog.at_level(logging.WARNING):
+        assert not OpenTelemetrySink.use_otlp_exporter("http://collector:4318/v1/metrics")
+    assert len(meter_providers) == 1
+    assert "latencies won't be sent to the OTLP collector" in caplog.text
@@ -1,8 +1,10 @@
+import asyncio
 import hashlib
 import io
 import os
 import tempfile
 
+import azure.storage.filedatalake.aio
 import pytest
 
 from .mocks import MockAzureCredential
@@ -40,7 +42,7 @@ def test_file_filename_to_id():
     # test ascii filename
     assert File(empty).filename_to_id() == "file-foo_pdf-666F6F2E706466"
     # test filename containing unicode
-    empty.name = "foo\u00A9.txt"
+    empty.name = "foo\u00a9.txt"
     assert File(empty).filename_to_id() == "file-foo__txt-666F6FC2A92E747874"
     # test filenaming starting with unicode
     empty.name = "ファイル名.pdf"
@@ -133,3 +135,64 @@ async def test_read_adls_gen2_files(monkeypatch, mock_data_lake_service_client):
     assert files[1].acls == {"oids": ["B-USER-ID"], "groups": ["B-GROUP-ID"]}
     assert files[2].filename() == "c.txt"
     assert files[2].acls == {"oids": ["C-USER-ID"], "groups": ["C-GROUP-ID"]}
+
+
+@pytest.mark.asyncio
+async def test_read_adls_gen2_files_prefetch(monkeypatch, mock_data_lake_service_client):
+    adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a",
+        data_lake_filesystem="a",
+        data_lake_path="a",
+        credential=MockAzureCredential(),
+        max_prefetch=2,
+    )
+
+    started_downloads = []
+
+    async def mock_download_file(self, *args, **kwargs):
+        started_downloads.append(self.path)
+        await asyncio.sleep(0)
+        return azure.storage.filedatalake.aio.StorageStreamDownloader(None)
+
+    monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "download_file", mock_download_file)
+
+    temp_file_paths = []
+    async for file in adlsgen2_list_strategy.list():
+        # The next file is downloaded while this one is being processed, but no more than 2 files are held at once
+        assert len(started_downloads) <= len(temp_file_paths) + 2
+        assert file.content.read() == b"test content"
+        temp_file_paths.append(file.content.name)
+
+    assert started_downloads == ["a.txt", "b.txt", "c.txt"]
+    assert [os.path.basename(path) for path in temp_file_paths] == ["a.txt", "b.txt", "c.txt"]
+    assert not any(os.path.exists(path) for path in temp_file_paths)
+
+
+@pytest.mark.asyncio
+async def test_read_adls_gen2_files_stop_early(monkeypatch, mock_data_lake_service_client):
+    adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a",
+        data_lake_filesystem="a",
+        data_lake_path="a",
+        credential=MockAzureCredential(),
+        max_prefetch=2,
+    )
+
+    finished_downloads = []
+
+    async def mock_download_file(self, *args, **kwargs):
+        try:
+            if self.path != "a.txt":
+                await asyncio.sleep(10)
+            return azure.storage.filedatalake.aio.StorageStreamDownloader(None)
+        finally:
+            finished_downloads.append(self.path)
+
+    monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "download_file", mock_download_file)
+
+    files = adlsgen2_list_strategy.list()
+    file = await files.__anext__()
+    assert file.filename() == "a.txt"
+    await files.aclose()
+    # The download started ahead was cancelled and waited for before its directory was deleted
+    assert finished_downloads == ["a.txt", "b.txt"]
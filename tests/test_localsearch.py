@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+from azure.search.documents.models import RawVectorQuery
+
+from approaches.localsearch import BM25Index, LocalSearchBackend, ODataFilter
+
+from scripts.prepdocslib.localindex import LocalIndex
+
+
+@pytest.fixture
+def local_backend(tmp_path):
+    local_index = LocalIndex(str(tmp_path))
+    local_index.upload_documents(
+        [
+            {
+                "id": "cse-121",
+                "content": "Class: CSE 121 Introduction to computer programming",
+                "level": 121,
+                "major": "cse",
+                "sourcepage": "cse.html",
+                "sourcefile": "cse.html",
+                "meetingDays": 21,
+                "instructors": ["Wang,Matt"],
+                "sectionTypes": ["lecture", "quiz"],
+                "oids": ["OID_1"],
+                "embedding": [1.0, 0.0, 0.0],
+            },
+            {
+                "id": "cse-332",
+                "content": "Class: CSE 332 Data structures and parallelism, programming in Java",
+                "level": 332,
+                "major": "cse",
+                "sourcepage": "cse.html",
+                "sourcefile": "cse.html",
+                "meetingDays": 10,
+                "instructors": ["Smith,Alice"],
+                "sectionTypes": ["lecture"],
+                "oids": ["OID_2"],
+                "embedding": [0.0, 1.0, 0.0],
+            },
+            {
+                "id": "math-126",
+                "content": "Class: MATH 126 Calculus with analytic geometry",
+                "level": 126,
+                "major": "math",
+                "sourcepage": "math.html",
+                "sourcefile": "math.html",
+                "meetingDays": None,
+                "instructors": [],
+                "sectionTypes": ["lecture", "quiz"],
+                "embedding": [0.6, 0.8, 0.0],
+            },
+            {"id": "no-vector", "content": "Spring 2024 Time Schedule", "level": 0, "major": ""},
+        ]
+    )
+    local_index.save()
+    return LocalSearchBackend(str(tmp_path))
+
+
+@pytest.mark.asyncio
+async def test_local_search_text(local_backend):
+    documents = await local_backend.search(5, "programming", None, [], False, False, False, [])
+    assert [document.id for document in documents] == ["cse-121", "cse-332"]
+    # Vectors are only returned when they're selected
+    assert documents[0].embedding is None
+    assert documents[0].captions == []
+
+    documents = await local_backend.search(5, "programming", None, [], False, False, False, ["embedding"])
+    assert documents[0].embedding == [1.0, 0.0, 0.0]
+    assert documents[0].image_embedding is None
+
+    documents = await local_backend.search(5, "programming java", None, [], False, False, True, [])
+    assert [document.id for document in documents] == ["cse-332"]
+
+
+@pytest.mark.asyncio
+async def test_local_search_vectors(local_backend):
+    vector = RawVectorQuery(vector=[0.0, 2.0, 0.0], k=2, fields="embedding")
+    documents = await local_backend.search(5, None, None, [vector], False, False, False, [])
+    # Ranked by cosine similarity, and the document without an embedding is never returned
+    assert [document.id for document in documents] == ["cse-332", "math-126"]
+
+
+@pytest.mark.asyncio
+async def test_local_search_hybrid(local_backend):
+    vector = RawVectorQuery(vector=[0.6, 0.8, 0.0], k=50, fields="embedding")
+    documents = await local_backend.search(2, "programming", None, [vector], True, True, False, [])
+    # math-126 is the closest vector but isn't about programming, so the classes both queries find rank above it
+    assert [document.id for document in documents] == ["cse-121", "cse-332"]
+
+
+@pytest.mark.asyncio
+async def test_local_search_filter(local_backend):
+    documents = await local_backend.search(
+        5, None, "level ge 100 and level lt 200 and major eq 'cse'", [], False, False, False, []
+    )
+    assert [document.id for document in documents] == ["cse-121"]
+
+    vector = RawVectorQuery(vector=[1.0, 0.0, 0.0], k=50, fields="embedding")
+    documents = await local_backend.search(
+        5, "class", "oids/any(g:search.in(g, 'OID_2, OID_3'))", [vector], False, False, False, []
+    )
+    assert [document.id for document in documents] == ["cse-332"]
+
+
+def test_odata_filter():
+    document = {
+        "level": 121,
+        "major": "cse",
+        "category": None,
+        "meetingDays": 21,
+        "instructors": ["Wang,Matt"],
+        "sectionTypes": ["lecture", "quiz"],
+        "groups": ["GROUP_1"],
+    }
+    assert ODataFilter("(meetingDays eq 5 or meetingDays eq 21) and sectionTypes/any(t: t eq 'quiz')")(document)
+    assert ODataFilter("search.ismatch('matt wang', 'instructors', 'simple', 'all')")(document)
+    assert not ODataFilter("search.ismatch('matt smith', 'instructors', 'simple', 'all')")(document)
+    assert ODataFilter("category ne 'excluded' and not (major eq 'math')")(document)
+    assert ODataFilter("(oids/any(g:search.in(g, 'OID_1')) or groups/any(g:search.in(g, 'GROUP_1, GROUP_2')))")(
+        document
+    )
+    assert not ODataFilter("startMinutes ge 600")(document)
+    assert not ODataFilter("false")(document)
+    assert ODataFilter("major eq 'o''brien' or level gt 100")(document)
+    with pytest.raises(ValueError):
+        ODataFilter("level ge")
+    with pytest.raises(ValueError):
+        ODataFilter("level has 100")
+
+
+def test_bm25_scores():
+    index = BM25Index(["the cat sat", "the cat sat on the cat mat", "a dog"])
+    scores = index.scores("cat")
+    assert scores[1] > scores[0]
+    # Documents that don't match are NaN, so they're left out of the ranking
+    assert not np.isnan(index.scores("cat dog")).any()
+    assert np.isnan(index.scores("cat dog", match_all=True)).all()
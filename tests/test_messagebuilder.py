@@ -47,3 +47,15 @@ def test_messagebuilder_unicode_append():
     assert builder.model == "gpt-35-turbo"
     assert builder.count_tokens_for_message(builder.messages[0]) == 4
     assert builder.count_tokens_for_message(builder.messages[1]) == 4
+
+
+def test_messagebuilder_copy():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    copied_builder = builder.copy()
+    copied_builder.insert_message("user", "Hello, how are you?")
+    assert builder.messages == [{"role": "system", "content": "You are a bot."}]
+    assert copied_builder.messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "Hello, how are you?"},
+    ]
+    assert copied_builder.model == "gpt-35-turbo"
@@ -1,6 +1,7 @@
 import pytest
 
 from core.modelhelper import (
+    get_embedding_dimensions,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
@@ -21,6 +22,12 @@ def test_get_token_limit_error():
         get_token_limit("gpt-3")
 
 
+def test_get_embedding_dimensions():
+    assert get_embedding_dimensions("text-embedding-ada-002") == 1536
+    assert get_embedding_dimensions("text-embedding-3-large") == 3072
+    assert get_embedding_dimensions("text-embedding-custom") == 1536
+
+
 def test_num_tokens_from_messages():
     message = {
         # 1 token : 1 token
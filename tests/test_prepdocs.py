@@ -1,14 +1,20 @@
+import asyncio
+
 import openai
 import openai.types
 import pytest
 import tenacity
+import tiktoken
 from httpx import Request, Response
 from openai.types.create_embedding_response import Usage
 
-from .mocks import MockAzureCredential
+from .mocks import MockAzureCredential, MockRawEmbeddingsClient
+from scripts.prepdocslib.embeddingcache import EmbeddingCache
 from scripts.prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     OpenAIEmbeddingService,
+    TokenBucketRateLimiter,
+    get_embedding_encoding,
 )
 
 
@@ -23,6 +29,7 @@ class MockEmbeddingsClient:
 class MockClient:
     def __init__(self, embeddings_client):
         self.embeddings = embeddings_client
+        self.embeddings.with_raw_response = MockRawEmbeddingsClient(embeddings_client)
 
 
 @pytest.mark.asyncio
@@ -193,3 +200,337 @@ async def test_compute_embedding_autherror(monkeypatch, capsys):
         )
         monkeypatch.setattr(embeddings, "create_client", create_auth_error_limit_client)
         await embeddings.create_embeddings(texts=["foo"])
+
+
+class CountingMockEmbeddingsClient:
+    def __init__(self):
+        self.inputs = []
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.inputs.append(kwargs["input"])
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[
+                openai.types.Embedding(embedding=[float(len(kwargs["input"])), 0.5, -0.25], index=0, object="embedding")
+            ],
+            model="text-ada-003",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_cache(monkeypatch, tmp_path):
+    embeddings_client = CountingMockEmbeddingsClient()
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-ada-003",
+        credential=MockAzureCredential(),
+        disable_batch=True,
+        cache=EmbeddingCache(str(tmp_path)),
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    assert await embeddings.create_embeddings(texts=["foo", "quux"]) == [[3.0, 0.5, -0.25], [4.0, 0.5, -0.25]]
+    assert embeddings_client.inputs == ["foo", "quux"]
+
+    # A fresh cache over the same directory only embeds the new text
+    embeddings.cache = EmbeddingCache(str(tmp_path))
+    assert await embeddings.create_embeddings(texts=["quux", "hello", "foo"]) == [
+        [4.0, 0.5, -0.25],
+        [5.0, 0.5, -0.25],
+        [3.0, 0.5, -0.25],
+    ]
+    assert embeddings_client.inputs == ["foo", "quux", "hello"]
+
+    embeddings.cache = EmbeddingCache(str(tmp_path))
+    assert await embeddings.create_embeddings(texts=["hello", "foo"]) == [[5.0, 0.5, -0.25], [3.0, 0.5, -0.25]]
+    assert embeddings_client.inputs == ["foo", "quux", "hello"]
+
+
+def test_embedding_cache_keyed_on_model(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put_embeddings("model-a", ["foo", "foo"], [[1.0, 2.0], [1.0, 2.0]])
+    assert cache.get_embeddings("model-a", ["foo", "bar"]) == [[1.0, 2.0], None]
+    assert cache.get_embeddings("model-b", ["foo"]) == [None]
+    assert cache.store_for_model("model-a").stored_row_count() == 1
+
+    with pytest.raises(ValueError):
+        cache.put_embeddings("model-a", ["bar"], [[1.0, 2.0, 3.0]])
+
+
+class MockEncoding:
+    """Counts one token per character, so batching can be tested without downloading a tiktoken encoding"""
+
+    def __init__(self):
+        self.encode_batch_calls = 0
+
+    def encode(self, text):
+        return list(text)
+
+    def encode_batch(self, texts):
+        self.encode_batch_calls += 1
+        return [list(text) for text in texts]
+
+
+class SlowMockEmbeddingsClient:
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # Later batches finish first, so the results have to be put back in order
+        await asyncio.sleep(0.01 * (10 - len(kwargs["input"][0])))
+        self.in_flight -= 1
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[
+                openai.types.Embedding(embedding=[float(len(text))], index=index, object="embedding")
+                for index, text in reversed(list(enumerate(kwargs["input"])))
+            ],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_batch_concurrent(monkeypatch):
+    embeddings_client = SlowMockEmbeddingsClient()
+    created_clients = []
+
+    async def mock_create_client(*args, **kwargs):
+        created_clients.append(True)
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-embedding-ada-002", credential=MockAzureCredential(), max_concurrency=3
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    monkeypatch.setattr(embeddings, "encoding", MockEncoding())
+    texts = ["a" * (i // 16 + 1) for i in range(16 * 5)]
+    assert await embeddings.create_embeddings(texts=texts) == [[float(len(text))] for text in texts]
+    assert await embeddings.create_embeddings(texts=texts[:3]) == [[1.0], [1.0], [1.0]]
+    assert embeddings_client.max_in_flight == 3
+    assert len(created_clients) == 1
+
+
+class RetryAfterMockEmbeddingsClient:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.calls += 1
+        if self.calls == 1:
+            raise openai.RateLimitError(
+                message="Rate limited on the OpenAI embeddings API",
+                response=Response(
+                    429, headers={"retry-after-ms": "10"}, request=Request(method="get", url="https://foo.bar/")
+                ),
+                body=None,
+            )
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[openai.types.Embedding(embedding=[1.0], index=0, object="embedding")],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_ratelimiterror_retry_after(monkeypatch, capsys):
+    embeddings_client = RetryAfterMockEmbeddingsClient()
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-ada-003", credential=MockAzureCredential(), disable_batch=True, verbose=True
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    # The retry-after header replaces the 15-60 second random backoff
+    assert await asyncio.wait_for(embeddings.create_embeddings(texts=["foo"]), timeout=5) == [[1.0]]
+    assert embeddings_client.calls == 2
+    assert capsys.readouterr().out.count("Rate limited on the OpenAI embeddings API") == 1
+
+
+class HeadersMockEmbeddingsClient:
+    def __init__(self):
+        self.headers = {"x-ratelimit-remaining-tokens": "0", "x-ratelimit-remaining-requests": "59"}
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[openai.types.Embedding(embedding=[1.0], index=0, object="embedding")],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_rate_limit_headers(monkeypatch):
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=HeadersMockEmbeddingsClient())
+
+    rate_limiter = TokenBucketRateLimiter(tokens_per_minute=6000, requests_per_minute=600)
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-embedding-ada-002", credential=MockAzureCredential(), rate_limiter=rate_limiter
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    monkeypatch.setattr(embeddings, "encoding", MockEncoding())
+    assert await embeddings.create_embeddings(texts=["foo"]) == [[1.0]]
+    # The headers of a successful response drain the buckets before the service has to throttle
+    assert rate_limiter.available_tokens == 0
+    assert rate_limiter.available_requests == 59
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_rate_limiter(monkeypatch):
+    sleeps = []
+
+    async def mock_sleep(seconds):
+        sleeps.append(seconds)
+        limiter.updated_at -= seconds
+
+    monkeypatch.setattr(asyncio, "sleep", mock_sleep)
+    limiter = TokenBucketRateLimiter(tokens_per_minute=6000, requests_per_minute=60)
+    await limiter.acquire(5000)
+    assert sleeps == []
+    # Waits for the bucket to refill to 3000 tokens, at 100 tokens per second
+    await limiter.acquire(3000)
+    assert sleeps == [pytest.approx(20, abs=0.1)]
+
+    limiter.update_from_headers({"x-ratelimit-remaining-tokens": "0", "x-ratelimit-remaining-requests": "10"})
+    assert limiter.available_tokens == 0
+    assert limiter.available_requests == pytest.approx(10, abs=0.1)
+    assert TokenBucketRateLimiter.retry_after_seconds({"retry-after": "2"}) == 2
+    assert TokenBucketRateLimiter.retry_after_seconds({"retry-after-ms": "250", "retry-after": "1"}) == 0.25
+    assert TokenBucketRateLimiter.retry_after_seconds({}) is None
+
+
+def test_split_text_into_batches(monkeypatch):
+    embeddings = OpenAIEmbeddingService(open_ai_model_name="text-embedding-ada-002", credential=MockAzureCredential())
+    encoding = MockEncoding()
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda encoding_name: encoding)
+    texts = ["a" * 5000, "b" * 5000, "c" * 3000, "d" * 3000]
+    batches = embeddings.split_text_into_batches(texts)
+    assert [batch.indices for batch in batches] == [[0], [1, 2], [3]]
+    assert [batch.token_length for batch in batches] == [5000, 8000, 3000]
+    assert embeddings.calculate_token_length("foo") == 3
+    # The encoding is resolved once and all texts are tokenized in one call
+    assert encoding.encode_batch_calls == 1
+    assert embeddings.split_text_into_batches(texts[:2], token_lengths=[1, 1])[0].indices == [0, 1]
+    assert encoding.encode_batch_calls == 1
+
+    embeddings.first_fit_decreasing = True
+    batches = embeddings.split_text_into_batches(texts)
+    assert [batch.indices for batch in batches] == [[0, 2], [1, 3]]
+    assert [batch.texts for batch in batches] == [[texts[0], texts[2]], [texts[1], texts[3]]]
+
+    batches = embeddings.split_text_into_batches(["a"] * 40)
+    assert [len(batch.texts) for batch in batches] == [16, 16, 8]
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_batch_known_token_lengths(monkeypatch, tmp_path):
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=SlowMockEmbeddingsClient())
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-embedding-ada-002",
+        credential=MockAzureCredential(),
+        cache=EmbeddingCache(str(tmp_path)),
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    encoding = MockEncoding()
+    monkeypatch.setattr(embeddings, "encoding", encoding)
+    split_text_into_batches = embeddings.split_text_into_batches
+    batched_token_lengths = []
+
+    def mock_split_text_into_batches(texts, token_lengths=None):
+        batched_token_lengths.append(token_lengths)
+        return split_text_into_batches(texts, token_lengths)
+
+    monkeypatch.setattr(embeddings, "split_text_into_batches", mock_split_text_into_batches)
+    assert await embeddings.create_embeddings(texts=["a", "bb"], token_lengths=[1, 2]) == [[1.0], [2.0]]
+    # Only the texts that aren't cached are batched, with their own token lengths
+    assert await embeddings.create_embeddings(texts=["a", "ccc", "bb"], token_lengths=[1, 3, 2]) == [
+        [1.0],
+        [3.0],
+        [2.0],
+    ]
+    assert batched_token_lengths == [[1, 2], [3]]
+    assert encoding.encode_batch_calls == 0
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_batch_first_fit_decreasing(monkeypatch):
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=SlowMockEmbeddingsClient())
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-embedding-ada-002", credential=MockAzureCredential(), first_fit_decreasing=True
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    monkeypatch.setattr(embeddings, "encoding", MockEncoding())
+    texts = ["a" * (i % 7 + 1) for i in range(50)]
+    assert await embeddings.create_embeddings(texts=texts) == [[float(len(text))] for text in texts]
+
+
+class KwargsMockEmbeddingsClient:
+    def __init__(self):
+        self.kwargs = []
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.kwargs.append(kwargs)
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[
+                openai.types.Embedding(embedding=[0.5, 0.5], index=index, object="embedding")
+                for index in range(len(kwargs["input"]) if isinstance(kwargs["input"], list) else 1)
+            ],
+            model="text-embedding-3-small",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_dimensions(monkeypatch):
+    embeddings_client = KwargsMockEmbeddingsClient()
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-embedding-3-small", credential=MockAzureCredential(), open_ai_dimensions=256
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    monkeypatch.setattr(embeddings, "encoding", MockEncoding())
+    assert embeddings.embedding_dimensions() == 256
+    # Newer models are embedded in batches
+    await embeddings.create_embeddings(texts=["foo", "bar"])
+    assert embeddings_client.kwargs == [{"model": "text-embedding-3-small", "input": ["foo", "bar"], "dimensions": 256}]
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="text-embedding-3-large", credential=MockAzureCredential(), open_ai_dimensions=3072
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    await embeddings.create_embedding_single("foo")
+    assert embeddings_client.kwargs[-1] == {"model": "text-embedding-3-large", "input": "foo"}
+    assert embeddings.embedding_dimensions() == 3072
+
+    assert OpenAIEmbeddingService(open_ai_model_name="text-ada-003", credential="x").embedding_dimensions() == 1536
+    with pytest.raises(ValueError):
+        OpenAIEmbeddingService(open_ai_model_name="text-embedding-ada-002", credential="x", open_ai_dimensions=256)
+    with pytest.raises(ValueError):
+        OpenAIEmbeddingService(open_ai_model_name="text-embedding-3-small", credential="x", open_ai_dimensions=2048)
+
+
+def test_embedding_encoding():
+    # tiktoken can't map the text-embedding-3 models to an encoding, so the registry names it
+    for model in ["text-embedding-ada-002", "text-embedding-3-small", "text-embedding-3-large"]:
+        assert get_embedding_encoding(model).name == "cl100k_base"
+    embeddings = OpenAIEmbeddingService(open_ai_model_name="text-embedding-3-large", credential=MockAzureCredential())
+    assert embeddings.calculate_token_lengths(["Hello, world"]) == [3]
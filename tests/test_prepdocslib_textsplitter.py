@@ -2,12 +2,17 @@ import shutil
 from pathlib import Path
 
 import pytest
+import tiktoken
 
 from scripts.prepdocslib.listfilestrategy import LocalListFileStrategy
 from scripts.prepdocslib.page import Page
 from scripts.prepdocslib.pdfparser import LocalPdfParser
 from scripts.prepdocslib.searchmanager import Section
-from scripts.prepdocslib.textsplitter import SentenceTextSplitter, SimpleTextSplitter
+from scripts.prepdocslib.textsplitter import (
+    ScheduleTextSplitter,
+    SentenceTextSplitter,
+    SimpleTextSplitter,
+)
 
 
 def test_sentencetextsplitter_split_empty_pages():
@@ -77,3 +82,168 @@ def test_sentencetextsplitter_split_pages():
     assert split_pages[2].page_num == 2
     assert split_pages[2].text == 'e page"}'
     assert len(split_pages[2].text) <= max_object_length
+
+
+def pages_from_texts(texts):
+    pages = []
+    offset = 0
+    for page_num, text in enumerate(texts):
+        pages.append(Page(page_num=page_num, offset=offset, text=text))
+        offset += len(text)
+    return pages
+
+
+def test_sentencetextsplitter_split_multiple_pages():
+    t = SentenceTextSplitter(has_image_embeddings=False)
+    sentences = [f"Sentence number {i} is about courses. " for i in range(120)]
+    pages = pages_from_texts(["".join(sentences[:40]), "", "".join(sentences[40:80]), "".join(sentences[80:])])
+
+    split_pages = list(t.split_pages(pages))
+
+    all_text = "".join(page.text for page in pages)
+    assert len(split_pages) > 3
+    for split_page in split_pages:
+        assert len(split_page.text) <= t.max_section_length + t.sentence_search_limit + 1
+        offset = all_text.find(split_page.text)
+        assert offset >= 0
+        # Each section belongs to the last page that starts at or before it, skipping the empty page
+        assert split_page.page_num == max(page.page_num for page in pages if page.offset <= offset)
+    assert {split_page.page_num for split_page in split_pages} == {0, 2, 3}
+    # Sections end on sentence boundaries
+    assert all(split_page.text.rstrip().endswith(".") for split_page in split_pages)
+
+
+def test_sentencetextsplitter_split_only_whitespace():
+    t = SentenceTextSplitter(has_image_embeddings=False)
+
+    assert list(t.split_pages(pages_from_texts([" " * 3000, "\n" * 3000]))) == []
+
+
+@pytest.mark.asyncio
+async def test_sentencetextsplitter_split_pages_async():
+    t = SentenceTextSplitter(has_image_embeddings=False)
+    pages = pages_from_texts(["Short one. " * 150, "No sentence endings here " * 200, "(a table) [of] {words} " * 100])
+
+    async def parse():
+        for page in pages:
+            yield page
+
+    split_pages = [split_page async for split_page in t.split_pages_async(parse())]
+
+    assert [(p.page_num, p.text) for p in split_pages] == [(p.page_num, p.text) for p in t.split_pages(pages)]
+
+
+def byte_encoding():
+    # A real tiktoken encoding with one token per byte, so token splitting can be tested without downloading one
+    return tiktoken.Encoding(
+        name="bytes",
+        pat_str=r"""\s+(?!\S)|\s+|\S+""",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+
+
+def test_sentencetextsplitter_split_pages_by_tokens():
+    encoding = byte_encoding()
+    t = SentenceTextSplitter(
+        has_image_embeddings=False, max_tokens_per_section=300, token_overlap=40, encoding=encoding
+    )
+    sentences = [f"Sentence number {i} is about courses. " for i in range(120)]
+    pages = pages_from_texts(["".join(sentences[:40]), "", "".join(sentences[40:80]), "".join(sentences[80:])])
+
+    split_pages = list(t.split_pages(pages))
+
+    all_text = "".join(page.text for page in pages)
+    assert len(split_pages) > 3
+    for split_page in split_pages:
+        assert split_page.token_count == len(encoding.encode(split_page.text))
+        assert split_page.token_count <= 300
+        offset = all_text.find(split_page.text)
+        assert offset >= 0
+        assert split_page.page_num == max(page.page_num for page in pages if page.offset <= offset)
+    # Sections end on sentence boundaries, and each one starts with the sentence the previous one ended with
+    assert all(split_page.text.rstrip().endswith(".") for split_page in split_pages)
+    for previous, split_page in zip(split_pages, split_pages[1:]):
+        assert previous.text.endswith(split_page.text[: split_page.text.index(".") + 1])
+    assert split_pages[-1].text.endswith(sentences[-1])
+
+
+@pytest.mark.asyncio
+async def test_sentencetextsplitter_split_pages_by_tokens_async():
+    t = SentenceTextSplitter(has_image_embeddings=False, max_tokens_per_section=100, encoding=byte_encoding())
+    pages = pages_from_texts(["Short one. " * 50, "No sentence endings here " * 40, "x" * 250, " " * 10])
+
+    async def parse():
+        for page in pages:
+            yield page
+
+    split_pages = [split_page async for split_page in t.split_pages_async(parse())]
+
+    assert [(p.page_num, p.text, p.token_count) for p in split_pages] == [
+        (p.page_num, p.text, p.token_count) for p in t.split_pages(pages)
+    ]
+    assert all(p.token_count is not None and p.token_count <= 100 for p in split_pages)
+    # Text without any sentence or word boundary is cut at the token limit, keeping the default 10 token overlap
+    assert split_pages[-2].text == "x" * 100
+
+
+def test_sentencetextsplitter_token_settings():
+    with pytest.raises(ValueError):
+        SentenceTextSplitter(has_image_embeddings=False, max_tokens_per_section=100)
+    with pytest.raises(ValueError):
+        SentenceTextSplitter(
+            has_image_embeddings=False, max_tokens_per_section=100, token_overlap=100, encoding=byte_encoding()
+        )
+
+
+def test_scheduletextsplitter_split_classes():
+    t = ScheduleTextSplitter()
+    schedule = (
+        "Spring 2024 Time Schedule\n\nCOMPUTER SCIENCE & ENGINEERING---------------------\n"
+        "Class: CSE 121 Name: COMP PROGRAMMING I Area of Knowledge:(NSc,RSN), Prerequisites\n"
+        "Course Description: CSE 121 Introduction to Computer Programming I (4) NSc, RSN\n\n"
+        "Main Section: \n 12646 A 4 Meeting Days: Wednesday,Friday Meeting Time: 1130-1220 KNE 120 Wang,Matt Open 0/ 440 \n\n"
+        "Quiz Section: \n 12647 AA QZ Meeting Days: Tuesday,Thursday, Meeting Time: 830-920 MGH 248 Open 0/ 21 \n\n"
+        "---------------------\n"
+        "Class: CS&SS 321 Name: DATA SCIENCE Area of Kowledge: None, \n\n"
+        "Main Section: \n Restr 10156 A 4 to be arranged * * Shevlin,Terry J Closed 0/ 0 \n\n"
+    )
+
+    split_pages = list(t.split_pages([Page(page_num=0, offset=0, text=schedule)]))
+
+    assert [split_page.text for split_page in split_pages] == schedule.split(t.section_ending)
+    assert (split_pages[0].course_code, split_pages[0].level, split_pages[0].major) == ("", 0, "")
+    cse = split_pages[1]
+    assert (cse.course_code, cse.level, cse.major) == ("CSE 121", 121, "CSE")
+    assert cse.days == ["Tuesday", "Wednesday", "Thursday", "Friday"]
+    assert cse.times == ["1130-1220", "830-920"]
+    assert cse.instructors == ["Wang,Matt"]
+    assert cse.day_mask == 2 + 4 + 8 + 16
+    assert (cse.start_minutes, cse.end_minutes) == (8 * 60 + 30, 12 * 60 + 20)
+    assert (cse.min_credits, cse.max_credits) == (4, 4)
+    assert cse.section_types == ["lecture", "quiz"]
+    csss = split_pages[2]
+    assert (csss.course_code, csss.level, csss.major) == ("CS&SS 321", 321, "CS&SS")
+    assert (csss.days, csss.times, csss.instructors) == ([], [], ["Shevlin,Terry J"])
+    assert (csss.day_mask, csss.start_minutes, csss.end_minutes) == (0, None, None)
+
+
+def test_scheduletextsplitter_split_malformed_classes():
+    t = ScheduleTextSplitter()
+    schedule = "Header---------------------\nClass: Name: NO COURSE NUMBER\n---------------------\nClass: "
+
+    split_pages = list(t.split_pages([Page(page_num=0, offset=0, text=schedule)]))
+
+    assert len(split_pages) == 3
+    assert all(split_page.course_code == "" and split_page.level == 0 for split_page in split_pages)
+    assert split_pages[1].major == "Name"
+    assert list(t.split_pages([Page(page_num=0, offset=0, text=" \n ")])) == []
+
+
+def test_scheduletextsplitter_meeting_minutes():
+    assert ScheduleTextSplitter.meeting_minutes("830-920") == (8 * 60 + 30, 9 * 60 + 20)
+    assert ScheduleTextSplitter.meeting_minutes("1230-120") == (12 * 60 + 30, 13 * 60 + 20)
+    assert ScheduleTextSplitter.meeting_minutes("130-220") == (13 * 60 + 30, 14 * 60 + 20)
+    assert ScheduleTextSplitter.meeting_minutes("430-620P") == (16 * 60 + 30, 18 * 60 + 20)
+    assert ScheduleTextSplitter.meeting_minutes("1000-1120") == (10 * 60, 11 * 60 + 20)
+    assert ScheduleTextSplitter.meeting_minutes("1100-1300P") is None
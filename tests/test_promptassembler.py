@@ -0,0 +1,109 @@
+from approaches.chatapproach import ChatApproach
+from core.promptassembler import PromptAssembler
+
+FEW_SHOTS = [
+    # 1 token, 1 token, 1 token, 6 tokens
+    {"role": "user", "content": "Hello, how are you?"},
+    # 1 token, 1 token, 1 token, 5 tokens
+    {"role": "assistant", "content": "You are a bot."},
+]
+
+PERFORMANCE_REVIEW_ANSWER = "During the performance review at Contoso Electronics, the supervisor will discuss the employee's performance over the past year and provide feedback on areas for improvement. They will also provide an opportunity for the employee to discuss their goals and objectives for the upcoming year. The review is a two-way dialogue between managers and employees, and employees will receive a written summary of their performance review which will include a rating of their performance, feedback, and goals and objectives for the upcoming year [employee_handbook-3.pdf]."
+DRESS_CODE_ANSWER = "Yes, there is a dress code at Contoso Electronics. Look sharp! [employee_handbook-1.pdf]"
+LONG_HISTORY = [
+    {"role": "user", "content": "What happens in a performance review?"},  # 10 tokens
+    {"role": "assistant", "content": PERFORMANCE_REVIEW_ANSWER},  # 102 tokens
+    {"role": "user", "content": "Is there a dress code?"},  # 9 tokens
+    {"role": "assistant", "content": DRESS_CODE_ANSWER},  # 26 tokens
+    {"role": "user", "content": "What does a Product Manager do?"},  # 10 tokens
+]
+
+
+def test_promptassembler_token_count():
+    prompt = PromptAssembler("You are a bot.", "gpt-35-turbo", few_shots=FEW_SHOTS)
+    assert prompt.token_count == 8 + 9 + 8
+    tools = [{"type": "function", "function": {"name": "search_sources", "parameters": {"type": "object"}}}]
+    prompt_with_tools = PromptAssembler("You are a bot.", "gpt-35-turbo", few_shots=FEW_SHOTS, tools=tools)
+    assert prompt_with_tools.token_count > prompt.token_count
+
+
+def test_promptassembler_build_messages():
+    prompt = PromptAssembler("You are a bot.", "gpt-35-turbo", few_shots=FEW_SHOTS)
+    history = [
+        {"role": "user", "content": "Hello, how are you?"},
+        {"role": "assistant", "content": "You are a bot."},
+        {"role": "user", "content": "Hello, how are you?"},
+    ]
+    # The fixed 25 tokens and the question leave room for the last answer of the history, but not the question before
+    messages = prompt.build_messages(history, "Hello, how are you?", max_tokens=42)
+    assert messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "Hello, how are you?"},
+        {"role": "assistant", "content": "You are a bot."},
+        {"role": "assistant", "content": "You are a bot."},
+        {"role": "user", "content": "Hello, how are you?"},
+    ]
+    # Requests don't change the fixed part of the prompt
+    assert len(prompt.build_messages(history, "Hello, how are you?", max_tokens=1000)) == 6
+    assert len(prompt.message_builder.messages) == 3
+
+
+def test_promptassembler_build_messages_whole_history():
+    prompt = PromptAssembler("You are a bot.", "gpt-35-turbo")
+    history = [
+        {"role": "user", "content": "What happens in a performance review?"},
+        {"role": "assistant", "content": PERFORMANCE_REVIEW_ANSWER},
+        {"role": "user", "content": "What does a Product Manager do?"},
+    ]
+    messages = prompt.build_messages(history, "What does a Product Manager do?", max_tokens=3000)
+    assert messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "What happens in a performance review?"},
+        {"role": "assistant", "content": PERFORMANCE_REVIEW_ANSWER},
+        {"role": "user", "content": "What does a Product Manager do?"},
+    ]
+
+
+def test_promptassembler_build_messages_truncated():
+    prompt = PromptAssembler("You are a bot.", "gpt-35-turbo")
+    messages = prompt.build_messages(LONG_HISTORY[:3], "What does a Product Manager do?", max_tokens=10)
+    assert messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "What does a Product Manager do?"},
+    ]
+
+
+def test_promptassembler_build_messages_truncated_longer():
+    prompt = PromptAssembler("You are a bot.", "gpt-35-turbo")  # 8 tokens
+    messages = prompt.build_messages(LONG_HISTORY, "What does a Product Manager do?", max_tokens=55)
+    assert messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "Is there a dress code?"},
+        {"role": "assistant", "content": DRESS_CODE_ANSWER},
+        {"role": "user", "content": "What does a Product Manager do?"},
+    ]
+
+
+def test_promptassembler_build_messages_truncated_break_pair():
+    """Tests that the truncation breaks the pair of messages."""
+    prompt = PromptAssembler("You are a bot.", "gpt-35-turbo")  # 8 tokens
+    # The system prompt counts against the budget too, so the long answer just fits and its question doesn't
+    messages = prompt.build_messages(LONG_HISTORY, "What does a Product Manager do?", max_tokens=155)
+    assert messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "assistant", "content": PERFORMANCE_REVIEW_ANSWER},
+        {"role": "user", "content": "Is there a dress code?"},
+        {"role": "assistant", "content": DRESS_CODE_ANSWER},
+        {"role": "user", "content": "What does a Product Manager do?"},
+    ]
+
+
+def test_promptassembler_build_messages_few_shots():
+    prompt = PromptAssembler(
+        ChatApproach.query_prompt_template, "gpt-35-turbo", few_shots=ChatApproach.query_prompt_few_shots
+    )
+    user_query_request = "What does a Product manager do?"
+    messages = prompt.build_messages([], user_query_request, max_tokens=4000 - len(user_query_request))
+    # Make sure messages are in the right order
+    assert [message["role"] for message in messages] == ["system", "user", "assistant", "user", "assistant", "user"]
+    assert messages[5]["content"] == user_query_request
@@ -1,15 +1,20 @@
+import asyncio
 import io
 
 import openai
 import openai.types
 import pytest
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
 from openai.types.create_embedding_response import Usage
 
+from .mocks import MockRawEmbeddingsClient
 from scripts.prepdocslib.embeddings import AzureOpenAIEmbeddingService
+from scripts.prepdocslib.ingestionmanifest import IngestionManifest
 from scripts.prepdocslib.listfilestrategy import File
+from scripts.prepdocslib.localindex import LocalIndex
 from scripts.prepdocslib.searchmanager import SearchManager, Section
 from scripts.prepdocslib.strategy import SearchInfo
 from scripts.prepdocslib.textsplitter import SplitPage
@@ -26,6 +31,17 @@ class MockEmbeddingsClient:
 class MockClient:
     def __init__(self, embeddings_client):
         self.embeddings = embeddings_client
+        self.embeddings.with_raw_response = MockRawEmbeddingsClient(embeddings_client)
+
+
+class MockResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.reason = "Service Unavailable"
+        self.headers = {}
+
+    def text(self):
+        return ""
 
 
 @pytest.fixture
@@ -58,7 +74,7 @@ async def test_create_index_doesnt_exist_yet(monkeypatch, search_info):
     await manager.create_index()
     assert len(indexes) == 1, "It should have created one index"
     assert indexes[0].name == "test"
-    assert len(indexes[0].fields) == 6
+    assert len(indexes[0].fields) == 15
 
 
 @pytest.mark.asyncio
@@ -102,7 +118,47 @@ async def test_create_index_acls(monkeypatch, search_info):
     await manager.create_index()
     assert len(indexes) == 1, "It should have created one index"
     assert indexes[0].name == "test"
-    assert len(indexes[0].fields) == 8
+    assert len(indexes[0].fields) == 17
+
+
+@pytest.mark.asyncio
+async def test_create_index_embedding_dimensions(monkeypatch, search_info):
+    indexes = []
+
+    async def mock_create_index(self, index):
+        indexes.append(index)
+
+    async def mock_list_index_names(self):
+        for index in []:
+            yield index
+
+    monkeypatch.setattr(SearchIndexClient, "create_index", mock_create_index)
+    monkeypatch.setattr(SearchIndexClient, "list_index_names", mock_list_index_names)
+
+    manager = SearchManager(search_info)
+    await manager.create_index()
+    manager = SearchManager(
+        search_info,
+        embeddings=AzureOpenAIEmbeddingService(
+            open_ai_service="x",
+            open_ai_deployment="x",
+            open_ai_model_name="text-embedding-3-large",
+            credential=AzureKeyCredential("test"),
+        ),
+    )
+    await manager.create_index()
+    manager.embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-3-small",
+        credential=AzureKeyCredential("test"),
+        open_ai_dimensions=256,
+    )
+    await manager.create_index()
+    dimensions = [
+        next(field for field in index.fields if field.name == "embedding").vector_search_dimensions for index in indexes
+    ]
+    assert dimensions == [1536, 3072, 256]
 
 
 @pytest.mark.asyncio
@@ -131,6 +187,8 @@ async def test_update_content(monkeypatch, search_info):
                 split_page=SplitPage(
                     page_num=0,
                     text="test content",
+                    level=300,
+                    major="CSE",
                 ),
                 content=file,
                 category="test",
@@ -139,6 +197,59 @@ async def test_update_content(monkeypatch, search_info):
     )
 
 
+@pytest.mark.asyncio
+async def test_update_content_class_fields(monkeypatch, search_info):
+    documents_uploaded = []
+
+    async def mock_upload_documents(self, documents):
+        documents_uploaded.extend(documents)
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    manager = SearchManager(search_info)
+
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/cse.html"
+    file = File(test_io)
+
+    await manager.update_content(
+        [
+            Section(
+                split_page=SplitPage(
+                    page_num=0,
+                    text="Class: CSE 121",
+                    level=121,
+                    major="CSE",
+                    course_code="CSE 121",
+                    days=["Wednesday", "Friday"],
+                    instructors=["Wang,Matt"],
+                    day_mask=4 + 16,
+                    start_minutes=690,
+                    end_minutes=740,
+                    min_credits=4,
+                    max_credits=4,
+                    section_types=["lecture", "quiz"],
+                ),
+                content=file,
+            ),
+            Section(
+                split_page=SplitPage(page_num=0, text="Spring 2024 Time Schedule", level=0, major=""), content=file
+            ),
+        ]
+    )
+
+    assert {key: documents_uploaded[0][key] for key in ["meetingDays", "startMinutes", "endMinutes"]} == {
+        "meetingDays": 20,
+        "startMinutes": 690,
+        "endMinutes": 740,
+    }
+    assert documents_uploaded[0]["instructors"] == ["Wang,Matt"]
+    assert (documents_uploaded[0]["minCredits"], documents_uploaded[0]["maxCredits"]) == (4, 4)
+    assert documents_uploaded[0]["sectionTypes"] == ["lecture", "quiz"]
+    # Sections that aren't classes have no meetings, so they never match a filter on them
+    assert documents_uploaded[1]["meetingDays"] is None
+    assert documents_uploaded[1]["startMinutes"] is None
+
+
 @pytest.mark.asyncio
 async def test_update_content_many(monkeypatch, search_info):
     ids = []
@@ -164,6 +275,8 @@ async def test_update_content_many(monkeypatch, search_info):
                     split_page=SplitPage(
                         page_num=page_num,
                         text=f"test section {page_section_num}",
+                        level=300,
+                        major="CSE",
                     ),
                     content=file,
                     category="test",
@@ -230,6 +343,8 @@ async def test_update_content_with_embeddings(monkeypatch, search_info):
                 split_page=SplitPage(
                     page_num=0,
                     text="test content",
+                    level=300,
+                    major="CSE",
                 ),
                 content=file,
                 category="test",
@@ -245,6 +360,108 @@ async def test_update_content_with_embeddings(monkeypatch, search_info):
     ]
 
 
+@pytest.mark.asyncio
+async def test_update_content_passes_token_counts(monkeypatch, search_info):
+    passed_token_lengths = []
+
+    async def mock_create_embeddings(texts, token_lengths=None):
+        passed_token_lengths.append(token_lengths)
+        return [[1.0] for _ in texts]
+
+    async def mock_upload_documents(self, documents):
+        pass
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-ada-002",
+        credential=AzureKeyCredential("test"),
+    )
+    monkeypatch.setattr(embeddings, "create_embeddings", mock_create_embeddings)
+    manager = SearchManager(search_info, embeddings=embeddings)
+
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+
+    def sections(*token_counts):
+        return [
+            Section(
+                split_page=SplitPage(page_num=0, text=f"section {i}", level=-1, major="", token_count=token_count),
+                content=file,
+            )
+            for i, token_count in enumerate(token_counts)
+        ]
+
+    await manager.update_content(sections(3, 5))
+    # Sections split by characters have no token counts, so the embeddings service measures them itself
+    await manager.update_content(sections(3, None))
+
+    assert passed_token_lengths == [[3, 5], None]
+
+
+class MockIndexingResult:
+    def __init__(self, key, succeeded, status_code):
+        self.key = key
+        self.succeeded = succeeded
+        self.status_code = status_code
+        self.error_message = None if succeeded else "Something went wrong"
+
+
+@pytest.mark.asyncio
+async def test_update_content_retries_failed_documents(monkeypatch, search_info):
+    uploaded_ids = []
+
+    async def mock_upload_documents(self, documents):
+        uploaded_ids.append([document["id"] for document in documents])
+        if len(uploaded_ids) == 1:
+            raise HttpResponseError(response=MockResponse(503))
+        # Sections 0 and 1 fail on the first try, and section 4 can never be indexed
+        results = []
+        for document in documents:
+            section_index = int(document["id"].rsplit("-", 1)[1])
+            if section_index < 2:
+                results.append(MockIndexingResult(document["id"], succeeded=len(uploaded_ids) > 2, status_code=422))
+            else:
+                results.append(MockIndexingResult(document["id"], succeeded=section_index != 4, status_code=400))
+        return results
+
+    async def mock_sleep(seconds):
+        pass
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(asyncio, "sleep", mock_sleep)
+
+    manager = SearchManager(search_info)
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+    await manager.update_content(
+        [
+            Section(split_page=SplitPage(page_num=0, text=f"section {i}", level=300, major="CSE"), content=file)
+            for i in range(5)
+        ]
+    )
+
+    all_ids = [f"file-foo_pdf-666F6F2E706466-page-{i}" for i in range(5)]
+    assert uploaded_ids == [all_ids, all_ids, all_ids[:2]]
+
+
+def test_split_documents_into_batches(monkeypatch, search_info):
+    manager = SearchManager(search_info)
+    monkeypatch.setattr(SearchManager, "MAX_BATCH_SIZE", 3)
+    monkeypatch.setattr(SearchManager, "MAX_BATCH_BYTES", 100)
+    documents = [{"id": str(i), "embedding": [0.5] * (10 if i == 2 else 1)} for i in range(8)]
+    batches = manager.split_documents_into_batches(documents)
+    assert [[document["id"] for document in batch] for batch in batches] == [
+        ["0", "1"],
+        ["2"],
+        ["3", "4", "5"],
+        ["6", "7"],
+    ]
+
+
 @pytest.mark.asyncio
 async def test_remove_content(monkeypatch, search_info):
     class AsyncSearchResultsIterator:
@@ -286,7 +503,7 @@ async def test_remove_content(monkeypatch, search_info):
 
     async def mock_delete_documents(self, documents):
         deleted_documents.extend(documents)
-        return documents
+        return [MockIndexingResult(document["id"], True, 200) for document in documents]
 
     monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
 
@@ -300,3 +517,221 @@ async def test_remove_content(monkeypatch, search_info):
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 1, "It should have deleted one document"
     assert deleted_documents[0]["id"] == "file-foo_pdf-666F6F2E706466-page-0"
+
+
+@pytest.mark.asyncio
+async def test_remove_content_skips_removed_ids(monkeypatch, search_info):
+    # The first search still returns a document that was deleted, until the index catches up
+    search_results = [["doc-0", "doc-1"], ["doc-1", "doc-2"], ["doc-2"]]
+    searched_kwargs = []
+
+    class AsyncSearchResultsIterator:
+        def __init__(self, ids):
+            self.results = [{"id": id} for id in ids]
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if len(self.results) == 0:
+                raise StopAsyncIteration
+            return self.results.pop(0)
+
+    async def mock_search(self, *args, **kwargs):
+        searched_kwargs.append(kwargs)
+        return AsyncSearchResultsIterator(search_results.pop(0))
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    deleted_ids = []
+
+    async def mock_delete_documents(self, documents):
+        deleted_ids.extend(document["id"] for document in documents)
+        return [MockIndexingResult(document["id"], True, 200) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    await SearchManager(search_info).remove_content()
+
+    assert len(searched_kwargs) == 3
+    assert all(kwargs["select"] == ["id"] and kwargs["filter"] is None for kwargs in searched_kwargs)
+    assert deleted_ids == ["doc-0", "doc-1", "doc-2"]
+
+
+@pytest.mark.asyncio
+async def test_remove_content_uses_manifest(monkeypatch, search_info, tmp_path):
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"))
+    manifest.set_ids(search_info.index_name, "foo.pdf", ["foo-page-0", "foo-page-1"])
+    manifest.set_ids(search_info.index_name, "bar.pdf", ["bar-page-0"])
+
+    async def mock_search(self, *args, **kwargs):
+        raise AssertionError("Sections known to the manifest should be removed without searching")
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    deleted_ids = []
+
+    async def mock_delete_documents(self, documents):
+        deleted_ids.extend(document["id"] for document in documents)
+        return [MockIndexingResult(document["id"], True, 200) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    await SearchManager(search_info, manifest=manifest).remove_content("data/foo.pdf")
+
+    assert deleted_ids == ["foo-page-0", "foo-page-1"]
+    reloaded = IngestionManifest(str(tmp_path / "manifest.json"))
+    assert reloaded.get_ids(search_info.index_name, "foo.pdf") is None
+    assert reloaded.get_ids(search_info.index_name, "bar.pdf") == ["bar-page-0"]
+
+
+@pytest.mark.asyncio
+async def test_update_content_removes_stale_sections(monkeypatch, search_info, tmp_path):
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"))
+    file = File(content=io.BytesIO(b""), acls={})
+    file.content.name = "test.pdf"
+    old_ids = [f"{file.filename_to_id()}-page-{i}" for i in range(3)]
+    manifest.set_ids(search_info.index_name, "test.pdf", old_ids)
+
+    async def mock_upload_documents(self, documents):
+        return [MockIndexingResult(document["id"], True, 201) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    deleted_ids = []
+
+    async def mock_delete_documents(self, documents):
+        deleted_ids.extend(document["id"] for document in documents)
+        return [MockIndexingResult(document["id"], True, 200) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manager = SearchManager(search_info, manifest=manifest)
+    await manager.update_content(
+        [
+            Section(
+                split_page=SplitPage(page_num=0, text="test", level=300, major="CSE"),
+                content=file,
+                category="test",
+            )
+        ]
+    )
+
+    assert deleted_ids == old_ids[1:]
+    assert manifest.get_ids(search_info.index_name, "test.pdf") == old_ids[:1]
+
+
+@pytest.mark.asyncio
+async def test_update_content_writes_local_index(monkeypatch, search_info, tmp_path):
+    async def mock_upload_documents(self, documents):
+        return [MockIndexingResult(document["id"], True, 201) for document in documents]
+
+    async def mock_delete_documents(self, documents):
+        return [MockIndexingResult(document["id"], True, 200) for document in documents]
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"))
+    local_index = LocalIndex(str(tmp_path / "index"))
+    local_index.upload_documents([{"id": "outdated", "content": "old", "sourcefile": "test.pdf"}])
+    manager = SearchManager(search_info, manifest=manifest, local_index=local_index)
+    file = File(content=io.BytesIO(b""), acls={"oids": ["OID_ACL"]})
+    file.content.name = "test.pdf"
+    await manager.update_content(
+        [Section(split_page=SplitPage(page_num=0, text="test", level=300, major="CSE"), content=file)]
+    )
+    local_index.upload_documents(
+        [{"id": "other", "content": "other", "sourcefile": "other.pdf", "embedding": [0.5, 0.25]}]
+    )
+    local_index.save()
+
+    reloaded = LocalIndex(str(tmp_path / "index"))
+    assert list(reloaded.documents) == [f"{file.filename_to_id()}-page-0", "other"]
+    assert reloaded.documents[f"{file.filename_to_id()}-page-0"]["oids"] == ["OID_ACL"]
+    assert "embedding" not in reloaded.documents[f"{file.filename_to_id()}-page-0"]
+    assert reloaded.documents["other"]["embedding"] == [0.5, 0.25]
+
+    await SearchManager(search_info, manifest=manifest, local_index=reloaded).remove_content("test.pdf")
+    assert list(reloaded.documents) == ["other"]
+
+
+class MockExportResults:
+    def __init__(self, documents, facets=None):
+        self.documents = list(documents)
+        self.facets = facets
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self.documents) == 0:
+            raise StopAsyncIteration
+        return self.documents.pop(0)
+
+    async def get_facets(self):
+        return self.facets
+
+
+EXPORT_DOCUMENTS = [
+    {"id": "a-0", "content": "a", "sourcefile": "a.pdf"},
+    {"id": "a-1", "content": "a", "sourcefile": "a.pdf"},
+    {"id": "o-0", "content": "o", "sourcefile": "o'brien.pdf"},
+    {"id": "n-0", "content": "n", "sourcefile": None},
+]
+
+
+def mock_export_search(monkeypatch, document_count):
+    searched_kwargs = []
+
+    async def mock_get_document_count(self):
+        return document_count
+
+    async def mock_search(self, *args, **kwargs):
+        searched_kwargs.append(kwargs)
+        if kwargs.get("facets"):
+            return MockExportResults(
+                [], {"sourcefile": [{"value": "a.pdf", "count": 2}, {"value": "o'brien.pdf", "count": 1}]}
+            )
+        matches = {
+            None: EXPORT_DOCUMENTS,
+            "sourcefile eq null": EXPORT_DOCUMENTS[3:],
+            "sourcefile eq 'a.pdf'": EXPORT_DOCUMENTS[:2],
+            "sourcefile eq 'o''brien.pdf'": EXPORT_DOCUMENTS[2:3],
+        }[kwargs.get("filter")]
+        return MockExportResults([{"@search.score": 1, **document} for document in matches])
+
+    monkeypatch.setattr(SearchClient, "get_document_count", mock_get_document_count)
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    return searched_kwargs
+
+
+@pytest.mark.asyncio
+async def test_export_documents(monkeypatch, search_info):
+    searched_kwargs = mock_export_search(monkeypatch, 4)
+
+    assert await SearchManager(search_info).export_documents() == EXPORT_DOCUMENTS
+    assert searched_kwargs == [{"filter": None}]
+
+
+@pytest.mark.asyncio
+async def test_export_documents_pages_by_sourcefile(monkeypatch, search_info):
+    monkeypatch.setattr(SearchManager, "MAX_SEARCH_RESULTS", 3)
+    searched_kwargs = mock_export_search(monkeypatch, 4)
+
+    documents = await SearchManager(search_info).export_documents()
+
+    assert sorted(document["id"] for document in documents) == ["a-0", "a-1", "n-0", "o-0"]
+    assert [kwargs.get("filter") for kwargs in searched_kwargs[1:]] == [
+        "sourcefile eq null",
+        "sourcefile eq 'a.pdf'",
+        "sourcefile eq 'o''brien.pdf'",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_export_documents_incomplete(monkeypatch, search_info):
+    mock_export_search(monkeypatch, 5)
+
+    with pytest.raises(ValueError, match="Exported 4 documents but the index holds 5"):
+        await SearchManager(search_info).export_documents()
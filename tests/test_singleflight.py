@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+from core.singleflight import RequestCoalescer
+
+
+class SlowApproach:
+    def __init__(self, chunks=3, error=None):
+        self.calls = 0
+        self.chunks = chunks
+        self.error = error
+
+    def build_filter(self, overrides, auth_claims):
+        # Stands in for the access control filter, which depends on the user's groups
+        return " or ".join(f"groups/any(g:g eq '{group}')" for group in auth_claims.get("groups", [])) or None
+
+    async def run(self, messages, stream=False, session_state=None, context={}):
+        self.calls += 1
+        if stream:
+            return self.stream(messages)
+        await asyncio.sleep(0.01)
+        if self.error:
+            raise self.error
+        return {"answer": messages[-1]["content"], "call": self.calls}
+
+    async def stream(self, messages):
+        for index in range(self.chunks):
+            await asyncio.sleep(0.01)
+            yield {"delta": index}
+        if self.error:
+            raise self.error
+
+
+def question(content):
+    return [{"role": "user", "content": content}]
+
+
+@pytest.mark.asyncio
+async def test_identical_questions_share_answer():
+    coalescer = RequestCoalescer()
+    approach = SlowApproach()
+    first, second = await asyncio.gather(
+        coalescer.run(approach, question("What CSE classes are there?")),
+        coalescer.run(approach, question("  what cse classes   are there? ")),
+    )
+    assert first is second
+    assert approach.calls == 1
+    assert coalescer.results == {}
+
+    # Once the answer is done the next question runs again
+    await coalescer.run(approach, question("What CSE classes are there?"))
+    assert approach.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_different_questions_run_separately():
+    coalescer = RequestCoalescer()
+    approach = SlowApproach()
+    await asyncio.gather(
+        coalescer.run(approach, question("What CSE classes are there?")),
+        coalescer.run(approach, question("What CSE classes are there?"), context={"overrides": {"top": 5}}),
+        coalescer.run(
+            approach, question("What CSE classes are there?"), context={"auth_claims": {"groups": ["advisors"]}}
+        ),
+        coalescer.run(approach, question("What CSE classes are there?"), session_state="conversation"),
+        RequestCoalescer(enabled=False).run(approach, question("What CSE classes are there?")),
+    )
+    assert approach.calls == 5
+
+
+@pytest.mark.asyncio
+async def test_error_reaches_every_request():
+    coalescer = RequestCoalescer()
+    approach = SlowApproach(error=ValueError("Search is down"))
+    results = await asyncio.gather(
+        coalescer.run(approach, question("Who teaches CSE 332?")),
+        coalescer.run(approach, question("Who teaches CSE 332?")),
+        return_exceptions=True,
+    )
+    assert [str(result) for result in results] == ["Search is down", "Search is down"]
+    assert approach.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_request_doesnt_cancel_others():
+    coalescer = RequestCoalescer()
+    approach = SlowApproach()
+    first = asyncio.create_task(coalescer.run(approach, question("Who teaches CSE 332?")))
+    second = asyncio.create_task(coalescer.run(approach, question("Who teaches CSE 332?")))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert (await second)["answer"] == "Who teaches CSE 332?"
+    assert approach.calls == 1
+
+
+async def read_stream(coalescer, approach, delay=0):
+    await asyncio.sleep(delay)
+    events = []
+    async for event in await coalescer.run(approach, question("Plan my schedule"), stream=True):
+        events.append(event)
+    return events
+
+
+@pytest.mark.asyncio
+async def test_stream_fans_out():
+    coalescer = RequestCoalescer()
+    approach = SlowApproach(chunks=4)
+    # The late reader joins after some of the chunks were generated, and still gets all of them
+    first, late = await asyncio.gather(read_stream(coalescer, approach), read_stream(coalescer, approach, 0.025))
+    assert first == late == [{"delta": index} for index in range(4)]
+    assert approach.calls == 1
+    assert coalescer.streams == {}
+
+
+@pytest.mark.asyncio
+async def test_stream_error_reaches_every_reader():
+    coalescer = RequestCoalescer()
+    approach = SlowApproach(chunks=2, error=ValueError("OpenAI is down"))
+    results = await asyncio.gather(
+        read_stream(coalescer, approach), read_stream(coalescer, approach), return_exceptions=True
+    )
+    assert [str(result) for result in results] == ["OpenAI is down", "OpenAI is down"]
+    assert approach.calls == 1
@@ -0,0 +1,59 @@
+from approaches.approach import Document
+from approaches.sourcereducer import SourceReducer
+
+
+def document(id, embedding):
+    return Document(
+        id=id,
+        content=f"Content of {id}",
+        embedding=embedding,
+        image_embedding=None,
+        category=None,
+        sourcepage=f"{id}.html",
+        sourcefile=f"{id}.html",
+        oids=[],
+        groups=[],
+        captions=[],
+    )
+
+
+def ids(results):
+    return [result.id for result in results]
+
+
+def test_reduce_drops_near_duplicates():
+    reducer = SourceReducer()
+    results = [
+        document("cse333-lecture", [1.0, 0.0, 0.0]),
+        document("cse333-quiz", [0.99, 0.01, 0.0]),
+        document("cse351", [0.0, 1.0, 0.0]),
+        document("math126", [0.0, 0.0, 1.0]),
+    ]
+    assert reducer.candidates(2) == 4
+    assert ids(reducer.reduce(results, 3)) == ["cse333-lecture", "cse351", "math126"]
+    # Without enough distinct candidates, fewer results are returned rather than duplicates
+    assert ids(reducer.reduce(results[:2], 2)) == ["cse333-lecture"]
+
+
+def test_reduce_diversifies():
+    reducer = SourceReducer(duplicate_similarity=1.1, relevance_weight=0.5)
+    results = [
+        document("cse333", [1.0, 0.0]),
+        document("cse333-autumn", [0.9, 0.44]),
+        document("math126", [0.0, 1.0]),
+    ]
+    # The second result is close enough to the first that the less relevant but different third one goes before it
+    assert ids(reducer.reduce(results, 3)) == ["cse333", "math126", "cse333-autumn"]
+    assert ids(SourceReducer(duplicate_similarity=1.1, relevance_weight=1.0).reduce(results, 3)) == ids(results)
+
+
+def test_reduce_without_embeddings():
+    reducer = SourceReducer()
+    results = [
+        document("cse333", None),
+        document("cse351", []),
+        document("math126", [0.1, ...]),
+        document("info200", [0.1, 0.2]),
+    ]
+    assert ids(reducer.reduce(results, 3)) == ["cse333", "cse351", "math126"]
+    assert reducer.reduce([], 3) == []